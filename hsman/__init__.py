@@ -1,2 +1,20 @@
-from .api import get_datasets, open_dataset, view_datasets
-from hsman import config, ingest, scrape
+import importlib
+
+# the api pulls in the geospatial stack, so is only imported on first use
+_API = ['dataset_stats', 'get_datasets', 'iter_tiles', 'open_dataset',
+        'site_cube', 'view_datasets']
+_SUBMODULES = ['api', 'cli', 'compress', 'config', 'export', 'grid',
+               'ingest', 'manifest', 'metrics', 'plan', 'processing',
+               'scrape', 'serve', 'stats', 'workqueue']
+
+
+def __getattr__(name):
+    if name in _API:
+        return getattr(importlib.import_module('.api', __name__), name)
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + _API + _SUBMODULES)
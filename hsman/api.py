@@ -1,11 +1,11 @@
-import geopandas
+import functools
+import html
+import itertools
+import math
 import os
-import pandas as pd
-import pyproj
-import shapely
-import xarray
-import rioxarray
-from .config import DATA_PATH
+import numpy as np
+from .config import get_data_path
+from typing import NamedTuple
 import warnings
 
 
@@ -13,6 +13,11 @@ def get_datasets():
     """
     Return a pandas dataframe of bounding boxes
     """
+    import geopandas
+    import pandas as pd
+    import pyproj
+    import shapely
+
     def bounding_box(ds):
         """
         Retrieve bounding box in lon/lat
@@ -33,21 +38,21 @@ def get_datasets():
         ds['date'] = pd.to_datetime(ds['date'])
         return ds.sort_values(['Site', 'type'])
     # get all names that don't start with _ in data dir
-    names = os.listdir(DATA_PATH)
+    data_path = get_data_path()
+    names = os.listdir(data_path)
     names = [x for x in names if not x.startswith(('_', '.'))]
 
-    try:
+    inventory_path = os.path.join(data_path, '.inventory.gpkg')
+    if os.path.exists(inventory_path):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            gdf = geopandas.read_file(os.path.join(DATA_PATH,
-                                                   '.inventory.gpkg'))
+            gdf = geopandas.read_file(inventory_path)
         # gdf = gdf.set_index('dataset')
         # filter any names already present in gpkg
         names = [x for x in names if not (gdf.dataset == x).any()]
-    except geopandas.io.file.fiona.errors.DriverError:
+    else:
         # no file so all names need to be parsed
         gdf = None
-        pass
     if len(names) < 1:
         if gdf is not None:
             try:
@@ -67,7 +72,7 @@ def get_datasets():
     new_df = geopandas.pd.concat([gdf, new_df]).reset_index(drop=True)
     # save new file
     try:
-        new_df.to_file(os.path.join(DATA_PATH, '.inventory.gpkg'),
+        new_df.to_file(inventory_path,
                        driver="GPKG",
                        layer='dataset_bounding_boxes'
                        )
@@ -79,17 +84,38 @@ def get_datasets():
         return new_df
 
 
-def open_dataset(dataset, chunks=None, mode=None):
+def open_dataset(dataset, chunks=None, mode=None, overview_level=None):
     """
     Open a dataset
+
+    Parameters
+    ----------
+    dataset : str
+        dataset name
+    chunks : dict, optional
+        dask chunks of band, y and x. Image datasets default to chunks
+        aligned to the file blocks
+    mode : str, optional
+        'hsi', 'rgb' or 'path'. By default HSI is tried first. HSI datasets
+        ingested with the 'pca' store mode are reconstructed lazily, chunk
+        by chunk
+    overview_level : int, optional
+        read an internal overview of an image dataset (0 is the first
+        reduced resolution level), e.g. for map previews
     """
+    import xarray
+    import rioxarray
+    from .compress import is_compressed, open_compressed
+
+    data_path = get_data_path()
+
     def get_hsi_path(dataset):
-        dpath = os.path.abspath(os.path.join(DATA_PATH, dataset, "DATA"))
+        dpath = os.path.abspath(os.path.join(data_path, dataset, "DATA"))
         files = os.listdir(dpath)
         return [os.path.join(dpath, x) for x in files if x.endswith('.nc')]
 
     def get_rgb_path(dataset):
-        dpath = os.path.join(DATA_PATH, dataset, "DATA")
+        dpath = os.path.join(data_path, dataset, "DATA")
         flist = os.listdir(dpath)
         if len(flist) > 1:
             raise IOError('More than one file in image directory')
@@ -121,25 +147,28 @@ def open_dataset(dataset, chunks=None, mode=None):
             # works with original version
             def add_band_dim(dataset):
                 return dataset.expand_dims('band')
-            # define chunks
-            chunks = {'band': 1, 'x': 10000, 'y': 10000}
+            # band files have no band dimension
             ds = xarray.open_mfdataset(flist,
                                        preprocess=add_band_dim,
-                                       chunks=10000)
+                                       chunks={k: v for k, v in chunks.items()
+                                               if k != 'band'})
             # try to set crs
             return ds.chunk(chunks)
 
         def read_hsi_v2(flist):
             # works with the newer version
-            ds = xarray.open_mfdataset(flist,
-                                       chunks={'band':1, 'y':10000, 'x':10000}
-                                       )
+            ds = xarray.open_mfdataset(flist, chunks=chunks)
             ds = ds.assign_coords(
                 {'wavelength': ('band', ds.wavelength.values)}
                 )
             return ds
 
         flist = get_hsi_path(dataset)
+        compressed = is_compressed(flist)
+        if compressed is not None:
+            return open_compressed(compressed, chunks)
+        if chunks is None:
+            chunks = {'band': 1, 'x': 10000, 'y': 10000}
 
         # try original version first
         try:
@@ -151,11 +180,12 @@ def open_dataset(dataset, chunks=None, mode=None):
 
 
     def open_image(dataset, chunks=None):
-        if chunks is None:
-            chunks = {'band': 1, 'x': 10000, 'y': 10000}
         fpath = get_rgb_path(dataset)
+        if chunks is None:
+            chunks = _image_chunks(fpath)
         return rioxarray.open_rasterio(fpath,
-                                    chunks=chunks)
+                                    chunks=chunks,
+                                    overview_level=overview_level)
     if mode is None:
         try:
             return open_hsi_dataset(dataset, chunks)
@@ -177,62 +207,527 @@ def open_dataset(dataset, chunks=None, mode=None):
         return open_image(dataset, chunks)
 
 
-def view_datasets():
+def site_cube(site, type, start=None, end=None, resolution=1.0, bbox=None,
+              crs=None):
+    """
+    Lazy time series cube of all datasets of one type at a site
+
+    Every dataset is resampled (nearest neighbour) onto a shared grid and
+    the bands are aligned on the wavelengths (rounded to 1 nm) that all
+    dates have in common. The index maps from each dataset to the grid are
+    cached in DATA_PATH/_cache/grids (or the scratch directory if the store
+    is read-only), so building the same cube again does no resampling setup
+    and no data is read until the cube is computed.
+
+    Parameters
+    ----------
+    site : str
+        site code as in the `Site` column of `get_datasets`
+    type : str
+        dataset type, e.g. 'VNIR'
+    start, end : str or datetime, optional
+        inclusive date range of the datasets
+    resolution : float, optional
+        pixel size of the cube in units of `crs`
+    bbox : tuple, optional
+        (min lon, min lat, max lon, max lat) of the cube, by default the
+        union of the datasets
+    crs : str, optional
+        CRS of the cube, by default that of the earliest dataset
+
+    Returns
+    -------
+    cube : xarray.DataArray
+        dask backed (time, band, y, x) array with a wavelength coordinate on
+        band and a dataset coordinate on time. Pixels outside a dataset are
+        NaN (0 for integer data)
+    """
+    import pandas as pd
+    import pyproj
+    import rioxarray
+    import xarray
+    from rasterio.warp import transform_bounds
+    from . import grid as _grid
+
+    dsets = get_datasets()
+    dsets = dsets[(dsets['Site'] == site) & (dsets['type'] == type)]
+    if start is not None:
+        dsets = dsets[dsets['date'] >= pd.to_datetime(start)]
+    if end is not None:
+        dsets = dsets[dsets['date'] <= pd.to_datetime(end)]
+    if bbox is not None:
+        dsets = dsets[dsets.intersects(_bbox_polygon(bbox))]
+    if len(dsets) < 1:
+        raise IOError(f'No {type} datasets found for site {site}')
+    dsets = dsets.sort_values('date')
+
+    sources = []
+    for name in dsets['dataset']:
+        array, src_crs = _cube_source(name)
+        sources.append((name, array, src_crs))
+
+    if crs is None:
+        crs = sources[0][2]
+    if bbox is not None:
+        bounds = transform_bounds('epsg:4326', crs, *bbox)
+    else:
+        boxes = [transform_bounds(c, crs, *_grid.source_bounds(a.x.values,
+                                                               a.y.values))
+                 for _, a, c in sources]
+        bounds = (min([b[0] for b in boxes]), min([b[1] for b in boxes]),
+                  max([b[2] for b in boxes]), max([b[3] for b in boxes]))
+    grid = _grid.target_grid(bounds, crs, resolution)
+
+    # wavelengths common to every date
+    rounded = [a.wavelength.values.round(0) for _, a, _ in sources]
+    common = functools.reduce(np.intersect1d, rounded)
+    if len(common) < 1:
+        raise ValueError('Datasets have no wavelengths in common')
+
+    arrays = []
+    for (name, array, src_crs), wl in zip(sources, rounded):
+        _, idx, _ = np.intersect1d(wl, common, return_indices=True)
+        array = array.isel(band=idx)
+        rows, cols = _grid.index_maps(name, array.x.values, array.y.values,
+                                      src_crs, grid)
+        array = _grid.regrid(array, rows, cols, grid)
+        arrays.append(array.assign_coords(
+            band=np.arange(1, len(common) + 1),
+            wavelength=('band', common)))
+
+    cube = xarray.concat(arrays, dim=pd.Index(dsets['date'].values,
+                                              name='time'),
+                         coords='minimal', compat='override',
+                         combine_attrs='drop_conflicts')
+    cube = cube.assign_coords(dataset=('time', dsets['dataset'].values))
+    cube.name = 'reflectance'
+    return cube.rio.write_crs(pyproj.CRS.from_wkt(grid.crs))
+
+
+class Tile(NamedTuple):
+    """A tile yielded by `iter_tiles`
+
+    `data` is a (band, y, x) array and `x`, `y` and `wavelength` its
+    coordinates. `row` and `col` are the offsets of the tile in the dataset.
+    """
+    dataset: str
+    data: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    wavelength: np.ndarray
+    row: int
+    col: int
+
+
+def iter_tiles(datasets, size, stride=None, bands=None, wavelengths=None,
+               shuffle=True, nodata_filter=0.5, seed=0, epoch=0,
+               block_mb=64, workers=4, prefetch=8):
+    """
+    Iterate square tiles of datasets, e.g. as training patches
+
+    Datasets are read in blocks that are whole storage chunks (netCDF
+    chunks, GeoTIFF blocks or full rows of contiguous files), so every
+    chunk is read once per epoch. Blocks are read by a thread pool ahead of
+    the consumer, with at most `prefetch` blocks in memory. Tiles lie within
+    a block: blocks are multiples of the stride, so tile positions are one
+    stride grid over the dataset, and tiles across block edges are skipped
+    (only possible when the stride is smaller than the tile size).
+
+    Parameters
+    ----------
+    datasets : list
+        dataset names
+    size : int
+        tile width and height in pixels
+    stride : int, optional
+        step between tiles, by default `size`
+    bands : list, optional
+        band numbers to read
+    wavelengths : list, optional
+        wavelengths (nm) of the bands to read, the nearest band of each
+        dataset is used
+    shuffle : bool, optional
+        shuffle the order of the blocks and of the tiles in a block. The
+        order only depends on `seed` and `epoch`
+    nodata_filter : float or callable, optional
+        largest fraction of nodata pixels (0 or NaN in every band) in a
+        tile, or a function of the tile data that returns True to keep it.
+        None keeps every tile
+    seed, epoch : int, optional
+        seed of the shuffle, combined with the epoch so every epoch has its
+        own reproducible order
+    block_mb : int, optional
+        target size of a read block
+    workers : int, optional
+        number of reading threads
+    prefetch : int, optional
+        number of blocks read ahead
+
+    Yields
+    ------
+    tile : Tile
+    """
+    import collections
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    if stride is None:
+        stride = size
+    rng = np.random.default_rng([seed, epoch])
+
+    sources = {}
+    plan = []
+    for name in datasets:
+        array, _ = _cube_source(name)
+        chunks = _storage_chunks(array)
+        if wavelengths is not None:
+            wl = array.wavelength.values
+            idx = [int(np.abs(wl - w).argmin()) for w in wavelengths]
+            array = array.isel(band=idx)
+        elif bands is not None:
+            array = array.sel(band=bands)
+        sources[name] = array
+        blocks = _tile_blocks(array.shape, chunks, size,
+                              array.dtype.itemsize, block_mb, stride)
+        plan += [(name, b) for b in blocks]
+    if shuffle:
+        plan = [plan[i] for i in rng.permutation(len(plan))]
+
+    def read(item):
+        name, (r0, r1, c0, c1) = item
+        block = sources[name].isel(y=slice(r0, r1), x=slice(c0, c1))
+        # each worker computes its own block, so no nested thread pools
+        return item, block.compute(scheduler='synchronous')
+
+    with ThreadPoolExecutor(workers) as pool:
+        todo = iter(plan)
+        pending = collections.deque(
+            [pool.submit(read, x) for x in itertools.islice(todo,
+                                                            prefetch)])
+        try:
+            while pending:
+                (name, (r0, _, c0, _)), block = pending.popleft().result()
+                item = next(todo, None)
+                if item is not None:
+                    pending.append(pool.submit(read, item))
+                yield from _block_tiles(name, block, r0, c0, size, stride,
+                                        nodata_filter,
+                                        rng if shuffle else None)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def dataset_stats(dataset):
+    """
+    Per-band statistics of a dataset, as computed at ingest
+
+    No pixel data is read. Statistics come from METADATA/band_stats.json,
+    or for HSI datasets without one, from the band file attributes.
+
+    Parameters
+    ----------
+    dataset : str
+        dataset name
+
+    Returns
+    -------
+    stats : pandas.DataFrame
+        indexed by band with count, nodata_count, min, max, mean, std and
+        p1 ... p99 percentile columns, a histogram column of bin counts and
+        a histogram_range column of the (lower, upper) edges. HSI datasets
+        also have a wavelength column
+    """
+    import pandas as pd
+    from . import stats as _stats
+
+    dpath = os.path.join(get_data_path(), dataset)
+    if not os.path.exists(dpath):
+        raise IOError(f'Dataset {dataset} not found')
+    try:
+        bands = _stats.read_band_stats(dpath)
+    except FileNotFoundError:
+        bands = _stats_from_band_files(dpath)
+    if len(bands) < 1:
+        raise IOError(f'No band statistics found for {dataset}')
+
+    rows = []
+    for band, values in sorted(bands.items()):
+        row = dict(values, band=band)
+        for p, v in row.pop('percentiles', {}).items():
+            row[f'p{p}'] = v
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('band')
+
+
+def _stats_from_band_files(dataset_path):
+    # reads the statistics attributes of the band netCDF files
+    from netCDF4 import Dataset
+    from . import stats as _stats
+    dpath = os.path.join(dataset_path, 'DATA')
+    bands = {}
+    for fname in os.listdir(dpath):
+        if not fname.endswith('.nc'):
+            continue
+        with Dataset(os.path.join(dpath, fname)) as ds:
+            if 'reflectance' not in ds.variables:
+                # a compressed dataset, which always has band_stats.json
+                continue
+            var = ds.variables['reflectance']
+            attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+            if 'stats_count' not in attrs:
+                continue
+            band = int(ds.variables['band'][0])
+            bands[band] = dict(_stats.stats_from_attrs(attrs),
+                               wavelength=float(ds.variables['wavelength'][0]))
+    return bands
+
+
+def _cube_source(name, chunks=None):
+    # returns the (band, y, x) array of a dataset with a wavelength
+    # coordinate on band, and its CRS. Images use band numbers as wavelengths
+    import xarray
+    ds = open_dataset(name, chunks)
+    crs = ds.rio.crs
+    if isinstance(ds, xarray.Dataset):
+        array = ds['reflectance']
+        if 'time' in array.dims:
+            array = array.isel(time=0)
+    else:
+        array = ds
+    if 'wavelength' not in array.coords:
+        array = array.assign_coords(wavelength=('band',
+                                                array.band.values * 1.0))
+    return array.transpose('band', 'y', 'x'), crs
+
+
+def _storage_chunks(array):
+    # (rows, cols) of a storage chunk of a (band, y, x) array
+    encoding = array.encoding
+    if encoding.get('chunksizes'):
+        return tuple(encoding['chunksizes'][-2:])
+    if encoding.get('contiguous'):
+        return 1, array.sizes['x']
+    if 'source' in encoding:
+        import rasterio
+        with rasterio.open(encoding['source']) as src:
+            return src.block_shapes[0]
+    if array.chunks is not None:
+        return array.chunks[-2][0], array.chunks[-1][0]
+    return array.sizes['y'], array.sizes['x']
+
+
+def _tile_blocks(shape, chunks, size, itemsize, block_mb=64, stride=None):
+    # (row start, row end, col start, col end) of read blocks covering a
+    # (band, y, x) array. Blocks are whole chunks and whole strides, about
+    # block_mb and at least one tile in size
+    n_bands, height, width = shape
+    if stride is None:
+        stride = size
+    # least common multiples of the chunks and the stride
+    cy, cx = [c * stride // math.gcd(c, stride) for c in chunks]
+    area = max(1, block_mb * 2 ** 20 // (n_bands * itemsize))
+    if chunks[1] >= width:
+        # rows of a contiguous file are only read whole
+        by, bx = max(size, area // width), width
+    else:
+        by = bx = max(size, int(math.sqrt(area)))
+    by = math.ceil(by / cy) * cy
+    bx = math.ceil(bx / cx) * cx
+    return [(r, min(height, r + by), c, min(width, c + bx))
+            for r in range(0, height, by) for c in range(0, width, bx)]
+
+
+def _block_tiles(name, block, row, col, size, stride, nodata_filter,
+                 rng=None):
+    # yields the tiles of a block that pass the nodata filter
+    data = block.values
+    height, width = data.shape[-2:]
+    positions = [(r, c) for r in range(0, height - size + 1, stride)
+                 for c in range(0, width - size + 1, stride)]
+    if rng is not None:
+        positions = [positions[i] for i in rng.permutation(len(positions))]
+    if data.dtype.kind == 'f':
+        nodata = (np.isnan(data) | (data == 0)).all(axis=0)
+    else:
+        nodata = (data == 0).all(axis=0)
+    x = block.x.values
+    y = block.y.values
+    wavelength = block.wavelength.values
+    for r, c in positions:
+        tile = data[:, r:r + size, c:c + size]
+        if callable(nodata_filter):
+            if not nodata_filter(tile):
+                continue
+        elif nodata_filter is not None:
+            if nodata[r:r + size, c:c + size].mean() > nodata_filter:
+                continue
+        yield Tile(name, tile, x[c:c + size], y[r:r + size], wavelength,
+                   row + r, col + c)
+
+
+def _image_chunks(fpath, target=2048):
+    # dask chunks that are a whole number of file blocks for tiled images
+    import rasterio
+    with rasterio.open(fpath) as src:
+        block_y, block_x = src.block_shapes[0]
+        tiled = block_x < src.width
+    if not tiled:
+        return {'band': 1, 'x': 10000, 'y': 10000}
+    return {'band': 1,
+            'x': block_x * max(1, target // block_x),
+            'y': block_y * max(1, target // block_y)}
+
+
+def view_datasets(bbox=None, start=None, end=None, types=None,
+                  detail_zoom=12, zoom_start=6):
     """
     View available datasets on a folium map
+
+    Datasets are filtered before any GeoJSON is generated. Footprints are
+    simplified once, to the pixel size at `detail_zoom`, so they are coarser
+    than a screen pixel when zoomed in further. Centroids are drawn as
+    marker clusters. The serialized layers are cached against the inventory,
+    so reopening the map with the same filters does no GeoJSON work.
+
+    Parameters
+    ----------
+    bbox : tuple, optional
+        (min lon, min lat, max lon, max lat) that footprints must intersect
+    start, end : str or datetime, optional
+        inclusive date range of the datasets
+    types : list, optional
+        dataset types to show, e.g. ['VNIR', 'RGB']
+    detail_zoom : int, optional
+        zoom level at which simplified footprints are exact to a pixel
+    zoom_start : int, optional
+        initial zoom of the map
     """
     try:
         import folium
+        from folium.plugins import FastMarkerCluster
     except ModuleNotFoundError:
         raise RuntimeError("'folium' package must be installed to call this function")
 
-    # prepare dataset for plotting
-    dsets = get_datasets().drop(labels='date', axis='columns')
-    # dsets.reset_index(inplace=True)
-    dsets['dataset_type'] = dsets['dataset'].apply(lambda x: x.split('_')[1])
-
-    dsets2 = dsets.copy()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        dsets2['geometry'] = dsets2.geometry.centroid
-    dsets2 = dsets2.set_geometry('geometry')
+    layers = _view_layers(bbox, start, end, types, detail_zoom)
 
     def cstyle(x):
-        cols = {
-            'SWIR': '#1b9e77',
-            'VNIR': '#d95f02',
-            'DSM': '#7570b3',
-            'DTM': '#e7298a',
-            'RGB': '#66a61e'
-        }
         try:
-            c = cols[x['properties']['dataset_type']]
+            c = VIEW_COLOURS[x['properties']['dataset_type']]
         except KeyError:
             c = '#000000'
         return {'fillColor': c, 'color': c}
 
     # gjson = hsman.get_datasets().reset_index().to_json()
     m = folium.Map(location=[52.7, -2],
-                   zoom_start=6,
+                   zoom_start=zoom_start,
                    # tiles=maplayer,
                    height='80%',
                    attr='ESRI Aerial')
 
-    names = ['Shortwave IR (Hyspex)',
-             'Vis-NIR (Hyspex)',
-             'RGB aerial',
-             'Digital Surface Model',
-             'Digital Terrain Model']
-
-    for _dk, _name in zip(['SWIR', 'VNIR', 'RGB', 'DSM', 'DTM'], names):
-        _ds = dsets[dsets['dataset_type'] == _dk].to_json()
-        _ds2 = dsets2[dsets2['dataset_type'] == _dk].to_json()
-        _layer2 = folium.GeoJson(_ds2, name=_name, style_function=cstyle,
-                                 zoom_on_click=True)
-        _layer = folium.GeoJson(_ds, name=_name, style_function=cstyle,
+    # popup for each clustered centroid: data rows are [lat, lon, name] and
+    # the names are HTML escaped by _view_layers
+    callback = """function (row) {
+        var marker = L.marker(new L.LatLng(row[0], row[1]));
+        marker.bindPopup(row[2]);
+        return marker;
+    };"""
+
+    for _dk, _name in VIEW_LAYERS:
+        if _dk not in layers:
+            continue
+        footprints, centroids = layers[_dk]
+        _layer = folium.GeoJson(footprints, name=_name, style_function=cstyle,
                                 zoom_on_click=True)
-        folium.features.GeoJsonPopup(['dataset']).add_to(_layer2)
-        m.add_child(_layer2)
+        folium.features.GeoJsonPopup(['dataset']).add_to(_layer)
         m.add_child(_layer)
+        m.add_child(FastMarkerCluster(centroids, callback=callback,
+                                      name=f'{_name} (centres)'))
     folium.LayerControl(collapsed=False, ).add_to(m)
     return m
+
+
+VIEW_COLOURS = {
+    'SWIR': '#1b9e77',
+    'VNIR': '#d95f02',
+    'DSM': '#7570b3',
+    'DTM': '#e7298a',
+    'RGB': '#66a61e'
+}
+
+VIEW_LAYERS = [('SWIR', 'Shortwave IR (Hyspex)'),
+               ('VNIR', 'Vis-NIR (Hyspex)'),
+               ('RGB', 'RGB aerial'),
+               ('DSM', 'Digital Surface Model'),
+               ('DTM', 'Digital Terrain Model')]
+
+# serialized map layers keyed by inventory version and view arguments
+_VIEW_CACHE = {}
+
+
+def _view_layers(bbox=None, start=None, end=None, types=None,
+                 detail_zoom=12):
+    # returns {type: (footprint geojson, [[lat, lon, name], ...])} for the
+    # filtered datasets, with the names HTML escaped for popups, reusing the cache if the inventory is unchanged
+    import pandas as pd
+
+    key = (_inventory_version(),
+           None if bbox is None else tuple(bbox),
+           None if start is None else str(start),
+           None if end is None else str(end),
+           None if types is None else tuple(sorted(types)),
+           detail_zoom)
+    try:
+        return _VIEW_CACHE[key]
+    except KeyError:
+        pass
+
+    dsets = get_datasets()
+    dsets['dataset_type'] = dsets['dataset'].apply(lambda x: x.split('_')[1])
+    if types is not None:
+        dsets = dsets[dsets['dataset_type'].isin(types)]
+    if start is not None:
+        dsets = dsets[dsets['date'] >= pd.to_datetime(start)]
+    if end is not None:
+        dsets = dsets[dsets['date'] <= pd.to_datetime(end)]
+    if bbox is not None:
+        dsets = dsets[dsets.intersects(_bbox_polygon(bbox))]
+    # only the columns used on the map are serialized
+    dsets = dsets[['dataset', 'dataset_type', 'geometry']]
+
+    # one screen pixel at detail_zoom, in degrees
+    tolerance = 360 / (256 * 2 ** detail_zoom)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        centroids = dsets.geometry.centroid
+        dsets = dsets.set_geometry(
+            dsets.geometry.simplify(tolerance, preserve_topology=True))
+
+    layers = {}
+    for _dk in dsets['dataset_type'].unique():
+        mask = (dsets['dataset_type'] == _dk).values
+        points = [[p.y, p.x, html.escape(n)] for p, n in
+                  zip(centroids[mask], dsets['dataset'][mask])]
+        layers[_dk] = (dsets[mask].to_json(), points)
+    _VIEW_CACHE.clear()
+    _VIEW_CACHE[key] = layers
+    return layers
+
+
+def _inventory_version():
+    # changes whenever the inventory file or the dataset list changes
+    data_path = get_data_path()
+    try:
+        stat = os.stat(os.path.join(data_path, '.inventory.gpkg'))
+        version = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        version = None
+    names = tuple(sorted([x for x in os.listdir(data_path)
+                          if not x.startswith(('_', '.'))]))
+    return version, names
+
+
+def _bbox_polygon(bbox):
+    import shapely
+    return shapely.geometry.box(*bbox)
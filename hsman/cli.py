@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 import click
 from hsman import scrape, config
-from hsman import ingest as _ingest
 import logging
 import os
 
@@ -48,59 +47,160 @@ def init():
 @click.argument('directory',
                 type=click.Path('rb', file_okay=False,
                                 resolve_path=True))
-def ingest(directory):
+@click.option('--profile', is_flag=True,
+              help='Write per-stage timings to each dataset METADATA folder')
+@click.option('--prometheus-dir', default=None,
+              type=click.Path(file_okay=False, resolve_path=True),
+              help='Also write profiles to this Prometheus textfile '
+                   'collector directory')
+@click.option('--plan', is_flag=True,
+              help='Only report the datasets, sizes and estimated runtime '
+                   'from the file headers')
+@click.option('--distributed', is_flag=True,
+              help='Add the ingest jobs to a work queue for `hsman worker` '
+                   'processes instead of running them')
+@click.option('--queue', 'queue_file', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help='Work queue file, by default in the scratch directory')
+def ingest(directory, profile, prometheus_dir, plan, distributed,
+           queue_file):
     """
     Searches DIRECTORY for files matching the specification in the
     config and checks for any preprocessing steps necessary.
 
     Recipes with the 'RGB' and 'DSM' rasdaman_ingredients flag in the config
-    file will be copied directly.
+    file will be copied directly, or converted to Cloud Optimized GeoTIFF if
+    the recipe sets `image_format: cog`.
 
     'HSI' recipes will be first converted to NetCDF before ingestion. This also
     allows correct parsing of the wavelength dimension as well as infilling any
-    missing wavelengths with NODATA (removed during preprocessing).
+    missing wavelengths with NODATA (removed during preprocessing). A recipe
+    `mosaic` section selects a tiled, memory-capped mosaic and its overlap
+    rule in place of gdal_merge.py, and `wavelength_range`, `exclude_ranges`
+    and `bin_factor` subset and bin the bands that are ingested. A `store`
+    section with `mode: pca` stores the bands spectrally decorrelated in one
+    file, lossless or within `max_error`.
+
+    With --plan nothing is ingested. For each mission and recipe the number
+    of files and output bands, the output grid, scratch and store space and
+    an estimated runtime are printed. Estimates are calibrated from the
+    timings of earlier ingests run with --profile.
+
+    With --profile, wall time, CPU time, bytes read/written and peak memory
+    are recorded for each ingest stage and written to METADATA/ingest_profile.json
+    in each new dataset.
+
+    With --distributed, the missions are split into jobs (one per HSI band)
+    in a work queue on the shared filesystem and run by any number of
+    `hsman worker` processes, on any node that shares the store and the
+    scratch directory. Profiling is not available in this mode.
 
     This program generates all preprocessed data and files as specified in the
     config.
     After running this script, ingest into RASDAMAN by running the shell scipt
     `wcst_import_all.sh`. This is installed by default with this python module.
     """
+    # imported here so other commands don't load the geospatial stack
+    from hsman import ingest as _ingest
+
     # Arg parsing, check is a directory
     target_dir = click.format_filename(directory)
     if not os.path.isdir(target_dir):
         raise ValueError('{} is not a directory'.format(target_dir))
+    if plan:
+        from hsman import plan as _plan
+        click.echo(_plan.format_plan(_plan.plan_ingest(target_dir)))
+        return
+    if distributed:
+        from hsman import workqueue
+        queue = workqueue.WorkQueue(queue_file or workqueue.queue_path())
+        if profile:
+            logging.warning('--profile is ignored with --distributed')
     logging.info('Loading config...')
-    recipes = config.get_config()['raster_dataset_recipes']
+    conf = config.get_config()
+    recipes = conf['raster_dataset_recipes']
     if len(recipes) < 1:
         raise RuntimeError('No recipes supplied in config file')
     logging.info('{} recipes found'.format(len(recipes)))
     logging.info('Searching {} for relevant files...'.format(target_dir))
+    all_matches = scrape.find_all_dataset_files(target_dir, conf)
     for recipe_name, recipe in recipes.items():
         logging.info('Searching for files matching the {} recipe...'.format(
             recipe_name))
-        try:
-            _all_data = scrape.find_dataset_files(target_dir,
-                                                  recipe_name)['data_path']
-            # iterate all missions found
-            logging.info('Found {} missions with matching files'.format(
-                len(_all_data)))
-            for mission_name, data_files in _all_data.items():
-                logging.info('Processing recipe {} for mission {}...'.format(
-                    recipe_name, mission_name
-                ))
-                coverage_id = scrape.generate_coverage_id(mission_name,
-                                                          recipe['name'])
-                if recipe['ingest_type'] == 'hsi':
-                    _ingest.ingest_hsi(data_files, coverage_id)
-
-                if recipe['ingest_type'] == 'image':
-                    if len(data_files) == 1:
-                        _ingest.ingest_image(data_files[0], coverage_id)
-                    else:
-                        logging.warn('Could not ingest dataset as more than 1 file')
-        except ValueError:
+        if recipe_name not in all_matches:
             logging.info('No datasets found matching {} template'.format(
                 recipe_name))
+            continue
+        _all_data = all_matches[recipe_name]['data_path']
+        # iterate all missions found
+        logging.info('Found {} missions with matching files'.format(
+            len(_all_data)))
+        for mission_name, data_files in _all_data.items():
+            logging.info('Processing recipe {} for mission {}...'.format(
+                recipe_name, mission_name
+            ))
+            coverage_id = scrape.generate_coverage_id(mission_name,
+                                                      recipe['name'])
+            if recipe['ingest_type'] == 'hsi':
+                options = dict(
+                    transfer_mode=recipe.get('transfer_mode',
+                                           _ingest.HSI_TRANSFER_MODE),
+                    mosaic=recipe.get('mosaic'),
+                    wavelength_range=recipe.get('wavelength_range'),
+                    exclude_ranges=recipe.get('exclude_ranges'),
+                    bin_factor=recipe.get('bin_factor', 1),
+                    deinterleave=recipe.get('deinterleave', True),
+                    store=recipe.get('store'))
+                if distributed:
+                    _ingest.enqueue_hsi(queue, data_files, coverage_id,
+                                        **options)
+                else:
+                    _ingest.ingest_hsi(data_files, coverage_id, profile,
+                                       prometheus_dir, **options)
+
+            if recipe['ingest_type'] == 'image':
+                if len(data_files) == 1:
+                    options = dict(
+                        image_format=recipe.get('image_format', 'copy'),
+                        transfer_mode=recipe.get('transfer_mode',
+                                               _ingest.IMAGE_TRANSFER_MODE))
+                    if distributed:
+                        _ingest.enqueue_image(queue, data_files[0],
+                                              coverage_id, **options)
+                    else:
+                        _ingest.ingest_image(data_files[0], coverage_id,
+                                             profile, prometheus_dir,
+                                             **options)
+                else:
+                    logging.warn('Could not ingest dataset as more than 1 file')
+
+
+@hsman.command()
+@click.option('--queue', 'queue_file', default=None,
+              type=click.Path(dir_okay=False, resolve_path=True),
+              help='Work queue file, by default in the scratch directory')
+@click.option('--lease', default=300, show_default=True,
+              help='Seconds a job is held without a heartbeat before '
+                   'another worker can claim it')
+@click.option('--poll', default=10, show_default=True,
+              help='Seconds between checks for jobs that are not ready')
+def worker(queue_file, lease, poll):
+    """
+    Runs jobs queued by `hsman ingest --distributed` until none are left.
+
+    Start any number of workers on nodes that share the store and scratch
+    directory. Jobs are claimed atomically and held with heartbeats; jobs of
+    a worker that dies are run again once their lease expires.
+    """
+    from hsman import ingest as _ingest
+    from hsman import workqueue
+
+    queue = workqueue.WorkQueue(queue_file or workqueue.queue_path(),
+                                lease=lease)
+    n_jobs = workqueue.run_worker(queue, _ingest.JOB_HANDLERS, poll=poll)
+    logging.info(f'{n_jobs} jobs completed, queue: {queue.counts()}')
+    for job_id, kind, group, error in queue.errors():
+        logging.error(f'Job {job_id} ({kind}, {group}) failed: {error}')
 
 
 @hsman.command()
@@ -110,3 +210,116 @@ def clean():
     """
     config.remove_empty_datasets()
     logging.info('All empty datasets removed')
+
+
+@hsman.command()
+@click.argument('datasets', nargs=-1)
+@click.option('--full', is_flag=True,
+              help='Re-hash every file, even if size and mtime match')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of files read concurrently')
+@click.option('--create-missing', is_flag=True,
+              help='Create manifests for datasets that have none')
+def verify(datasets, full, workers, create_missing):
+    """
+    Checks the files of DATASETS (by default every dataset in the store)
+    against the checksum manifests written at ingest.
+
+    Files whose size and mtime match the manifest are skipped unless --full
+    is given.
+    """
+    from hsman import manifest
+
+    names = list(datasets) if len(datasets) > 0 else None
+    results = manifest.verify_datasets(names, full, workers, create_missing)
+    n_failed = 0
+    for name, files in results.items():
+        counts = {}
+        for status in files.values():
+            counts[status] = counts.get(status, 0) + 1
+        logging.info('{}: {}'.format(name, ', '.join(
+            ['{} {}'.format(v, k) for k, v in sorted(counts.items())])))
+        n_failed += sum([v for k, v in counts.items()
+                         if k in ['changed', 'mismatch', 'missing']])
+    if n_failed > 0:
+        raise RuntimeError(f'{n_failed} files failed verification')
+    logging.info('Verification complete')
+
+
+@hsman.command()
+@click.argument('dst_dir',
+                type=click.Path(file_okay=False, resolve_path=True))
+@click.argument('datasets', nargs=-1)
+@click.option('--site', default=None, help='Site code of the datasets')
+@click.option('--type', 'types', multiple=True,
+              help='Dataset type, e.g. VNIR. Can be given more than once')
+@click.option('--start', default=None, help='First date, e.g. 2021-06-01')
+@click.option('--end', default=None, help='Last date')
+@click.option('--bbox', nargs=4, type=float, default=None,
+              help='MIN_LON MIN_LAT MAX_LON MAX_LAT to clip to')
+@click.option('--wavelengths', default=None,
+              help='Comma separated wavelengths (nm) of the bands to export')
+@click.option('--bands', default=None,
+              help='Comma separated band numbers to export')
+@click.option('--crs', default=None, help='Output CRS, e.g. epsg:27700')
+@click.option('--resolution', type=float, default=None,
+              help='Output pixel size in units of the CRS')
+@click.option('--format', 'fmt', default='netcdf', show_default=True,
+              type=click.Choice(['netcdf', 'gtiff', 'zarr']))
+@click.option('--workers', default=4, show_default=True,
+              help='Number of chunks computed concurrently')
+@click.option('--block-mb', default=64, show_default=True,
+              help='Target size of a chunk of all exported bands (MB)')
+def export(dst_dir, datasets, site, types, start, end, bbox, wavelengths,
+           bands, crs, resolution, fmt, workers, block_mb):
+    """
+    Exports DATASETS, or the datasets matching --site, --type, --start,
+    --end and --bbox, to files in DST_DIR.
+
+    Datasets are clipped to --bbox and subset to --wavelengths or --bands.
+    With --crs or --resolution they are resampled (nearest neighbour) onto
+    a grid snapped to the resolution. Outputs are tiled and compressed
+    netCDF, GeoTIFF or Zarr (with the zarr package installed), computed and
+    written chunk by chunk with bounded memory. Each output appears only
+    once it is complete.
+    """
+    from hsman import export as _export
+
+    def numbers(value, type):
+        return None if value is None else [type(x) for x in value.split(',')]
+
+    paths = _export.export_datasets(
+        dst_dir, list(datasets) or None, site=site, types=list(types) or None,
+        start=start, end=end, bbox=bbox, wavelengths=numbers(wavelengths,
+                                                             float),
+        bands=numbers(bands, int), crs=crs, resolution=resolution,
+        format=fmt, workers=workers, block_mb=block_mb)
+    logging.info(f'{len(paths)} datasets exported to {dst_dir}')
+
+
+@hsman.command()
+@click.option('--port', default=8000, show_default=True)
+@click.option('--workers', default=4, show_default=True,
+              help='Number of tiles rendered concurrently')
+@click.option('--memory-cache', default=256, show_default=True,
+              help='In-memory tile cache size (MB)')
+@click.option('--disk-cache', default=2048, show_default=True,
+              help='On-disk tile cache size (MB)')
+@click.option('--allow-origin', default=None,
+              help='Origin of a web map allowed to read tiles across '
+                   'origins (CORS), e.g. http://localhost:3000')
+def serve(port, workers, memory_cache, disk_cache, allow_origin):
+    """
+    Serves datasets in the store as XYZ tiles on localhost for QGIS and web
+    maps, e.g.
+
+        http://127.0.0.1:8000/DATASET/{z}/{x}/{y}.png?wavelengths=650,550,450
+
+    Composites are chosen with `bands` or `wavelengths` (1 or 3 values) and
+    stretched with `vmin` and `vmax`. The server only listens on 127.0.0.1,
+    and other web pages cannot read its responses unless their origin is
+    given with --allow-origin.
+    """
+    from hsman import serve as _serve
+    _serve.serve(port, workers, memory_cache, disk_cache,
+                 allow_origin=allow_origin)
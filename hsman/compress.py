@@ -0,0 +1,356 @@
+"""Submodule for the spectrally decorrelated (PCA) store mode
+
+A compressed HSI dataset is a single netCDF file holding a spectral basis
+and mean, the leading component images and a quantized integer residual.
+Component images are integers in units of half the residual step, as the
+residual takes up any error of the prediction. Bands are reconstructed as
+
+    round(mean + basis.T @ (scores * step / 2)) + residual * step
+
+which is exact for integer data when step is 1 (lossless) and within
+max_error of the ingested values otherwise.
+"""
+
+import functools
+import logging
+import math
+
+import numpy as np
+from netCDF4 import Dataset
+
+COMPRESSED_SUFFIX = '_pca.nc'
+STORE_MODES = ['bands', 'pca']
+DEFAULT_COMPONENTS = 8
+# pixels sampled to fit the basis
+FIT_SAMPLES = 200000
+# on-disk chunk size of the component and residual images
+CHUNK_SIZE = 512
+# band attributes that are not shared by the whole dataset
+_BAND_ATTRS = ('stats_', 'source_wavelengths', '_FillValue', 'grid_mapping',
+               'long_name')
+
+
+def compress_bands(band_paths, dst_fpath, max_error=0,
+                   n_components=DEFAULT_COMPONENTS, max_memory_mb=512,
+                   seed=0):
+    """Write ingested band files as one spectrally decorrelated file
+
+    The basis is fitted to a random sample of rows, then the bands are read
+    in row blocks of all bands and the component images and residual are
+    written. Pixels that are 0 in every band are stored as nodata.
+
+    Parameters
+    ----------
+    band_paths : list
+        band netCDF files in band order, as written by the ingest
+    dst_fpath : path-like
+        output netCDF file
+    max_error : float, optional
+        largest absolute difference between a reconstructed and an
+        ingested value. 0 is lossless and requires integer data
+    n_components : int, optional
+        number of component images
+    max_memory_mb : int, optional
+        memory cap of the row blocks
+    seed : int, optional
+        seed of the row sample used to fit the basis
+
+    Returns
+    -------
+    max_abs_error : float
+        the largest error of the reconstruction, measured while writing
+    """
+    sources = [Dataset(x) for x in band_paths]
+    try:
+        variables = [x.variables['reflectance'] for x in sources]
+        for v in variables:
+            v.set_auto_maskandscale(False)
+        shape = variables[0].shape
+        dtype = variables[0].dtype
+        if any([v.shape != shape or v.dtype != dtype for v in variables]):
+            raise ValueError('band files differ in shape or data type')
+        step = quantization_step(dtype, max_error)
+        mean, basis, sample = _fit_basis(variables, n_components, seed)
+
+        n_bands, width = len(variables), shape[1]
+        # float64 data, prediction and residual of every band per pixel
+        per_row = width * (n_bands * 24 + basis.shape[0] * 8)
+        rows = max(1, max_memory_mb * 2 ** 20 // per_row)
+        if rows >= CHUNK_SIZE:
+            rows = rows // CHUNK_SIZE * CHUNK_SIZE
+
+        # the narrowest integer types that hold the sample's component
+        # images and residual with headroom, deflate packs these best. If
+        # any block does not fit, the file is written again with int32
+        scores, residual, _ = encode_block(sample[:, None, :], mean, basis,
+                                           step)
+        types = (_int_type(2 * np.abs(scores).max(initial=0)),
+                 _int_type(2 * np.abs(residual).max(initial=0)))
+        try:
+            max_abs_error = _write_compressed(dst_fpath, sources, mean,
+                                              basis, step, rows, types)
+        except OverflowError:
+            logging.debug(f'{types} too narrow, compressing with int32')
+            max_abs_error = _write_compressed(dst_fpath, sources, mean,
+                                              basis, step, rows,
+                                              ('i4', 'i4'))
+        with Dataset(dst_fpath, 'a') as dst:
+            dst.setncattr('max_error', float(max_error))
+            dst.setncattr('max_abs_error', max_abs_error)
+    finally:
+        for x in sources:
+            x.close()
+    logging.debug(f'Compressed {len(band_paths)} bands, max error '
+                  f'{max_abs_error}')
+    return max_abs_error
+
+
+def open_compressed(fpath, chunks=None):
+    """Open a compressed dataset with lazily reconstructed bands
+
+    Parameters
+    ----------
+    fpath : path-like
+        file written by `compress_bands`
+    chunks : dict, optional
+        dask chunks of band, y and x. Each chunk reads the component images
+        once and only the residual of its own bands
+
+    Returns
+    -------
+    ds : xarray.Dataset
+        with a (band, y, x) reflectance variable like the band files
+    """
+    import dask.array as da
+    import pyproj
+    import rioxarray  # noqa: F401, registers the rio accessor
+    import xarray
+
+    if chunks is None:
+        chunks = {'band': 1, 'y': CHUNK_SIZE * 4, 'x': CHUNK_SIZE * 4}
+    src = xarray.open_dataset(fpath, mask_and_scale=False,
+                              chunks={'band': chunks.get('band', 1),
+                                      'component': -1,
+                                      'y': chunks.get('y', -1),
+                                      'x': chunks.get('x', -1)})
+    dtype = np.dtype(src.attrs['dtype'])
+    step = float(src.attrs['quantization_step'])
+    residual = src['residual'].data
+    band_chunks = residual.chunks[0]
+    mean = da.from_array(src['mean'].values, chunks=(band_chunks,))
+    basis = da.from_array(src['basis'].values, chunks=(-1, band_chunks))
+    data = da.blockwise(functools.partial(reconstruct_block, step=step,
+                                          dtype=dtype), 'byx',
+                        residual, 'byx', src['scores'].data, 'kyx',
+                        src['valid'].data, 'yx', mean, 'b', basis, 'kb',
+                        concatenate=True, dtype=dtype,
+                        meta=np.empty((0, 0, 0), dtype))
+
+    attrs = {k: v for k, v in src['residual'].attrs.items()
+             if k != 'grid_mapping'}
+    reflectance = xarray.DataArray(
+        data, dims=('band', 'y', 'x'), attrs=attrs,
+        coords={'band': src['band'].values, 'y': src['y'].values,
+                'x': src['x'].values,
+                'wavelength': ('band', src['wavelength'].values)})
+    reflectance.encoding['chunksizes'] = \
+        src['residual'].encoding.get('chunksizes')
+    ds = xarray.Dataset({'reflectance': reflectance}, attrs=src.attrs)
+    crs = src[src['residual'].attrs['grid_mapping']].attrs['spatial_ref']
+    return ds.rio.write_crs(pyproj.CRS.from_wkt(crs))
+
+
+def is_compressed(file_paths):
+    """Returns the compressed file among a dataset's files, or None"""
+    for x in file_paths:
+        if str(x).endswith(COMPRESSED_SUFFIX):
+            return x
+    return None
+
+
+def quantization_step(dtype, max_error):
+    """Residual quantization step that keeps errors within max_error"""
+    if max_error < 0:
+        raise ValueError('max_error must not be negative')
+    if np.dtype(dtype).kind in 'iu':
+        # integer residuals are rounded to the nearest multiple of an odd
+        # step, so they are at most floor(step / 2) off
+        return 2 * int(math.floor(max_error)) + 1
+    if max_error == 0:
+        raise ValueError('lossless compression requires integer data, '
+                         'set max_error')
+    return 2.0 * max_error
+
+
+def encode_block(data, mean, basis, step):
+    """Component images, quantized residual and valid mask of a block
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (band, y, x) block of every band
+    mean, basis : numpy.ndarray
+        (band,) mean and (component, band) basis
+    step : number
+        quantization step
+
+    Returns
+    -------
+    scores : numpy.ndarray
+        (component, y, x) int64, in units of step / 2
+    residual : numpy.ndarray
+        (band, y, x) int64
+    valid : numpy.ndarray
+        (y, x) uint8, 0 where every band is 0
+    """
+    valid = (data != 0).any(axis=0)
+    centred = data.astype('f8') - mean[:, None, None]
+    scores = np.round(np.tensordot(basis, centred, axes=(1, 0)) / (step / 2))
+    scores[:, ~valid] = 0
+    scores = scores.astype('i8')
+    pred = _predict(mean, basis, scores, step)
+    if data.dtype.kind in 'iu':
+        pred = np.round(pred)
+    residual = np.round((data - pred) / step)
+    residual[:, ~valid] = 0
+    return scores, residual.astype('i8'), valid.astype('u1')
+
+
+def reconstruct_block(residual, scores, valid, mean, basis, step, dtype):
+    """Bands of a block from its component images and residual
+
+    Returns
+    -------
+    data : numpy.ndarray
+        (band, y, x) array of dtype, 0 where not valid
+    """
+    dtype = np.dtype(dtype)
+    out = _predict(mean, basis, scores, step)
+    if dtype.kind in 'iu':
+        out = np.round(out)
+    out += residual * step
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        np.clip(out, info.min, info.max, out=out)
+    out[:, valid == 0] = 0
+    return out.astype(dtype)
+
+
+def _predict(mean, basis, scores, step):
+    # mean + basis.T @ (scores * step / 2) with elementwise operations only,
+    # so that the result of every pixel is the same whatever the block it is
+    # in. The lossless mode relies on the reader reproducing the writer
+    pred = np.empty((len(mean),) + scores.shape[1:], 'f8')
+    pred[:] = mean[:, None, None]
+    for k in range(basis.shape[0]):
+        pred += basis[k][:, None, None] * (scores[k] * (step / 2))
+    return pred
+
+
+def _write_compressed(dst_fpath, sources, mean, basis, step, rows, types):
+    # encodes the bands in blocks of rows and returns the largest error.
+    # types are the integer types of the component images and residual
+    variables = [x.variables['reflectance'] for x in sources]
+    dtype = variables[0].dtype
+    max_abs_error = 0.0
+    with _create_compressed_netcdf(dst_fpath, sources[0], sources,
+                                   basis.shape[0], types) as dst:
+        dst.setncattr('dtype', dtype.str)
+        dst.setncattr('quantization_step', step)
+        dst.variables['mean'][:] = mean
+        dst.variables['basis'][:] = basis
+        for r0 in range(0, variables[0].shape[0], rows):
+            r1 = min(variables[0].shape[0], r0 + rows)
+            data = np.stack([v[r0:r1] for v in variables])
+            scores, residual, valid = encode_block(data, mean, basis, step)
+            for name, values in [('scores', scores),
+                                 ('residual', residual)]:
+                var = dst.variables[name]
+                if np.abs(values).max(initial=0) > np.iinfo(var.dtype).max:
+                    raise OverflowError(f'{name} does not fit {var.dtype}')
+                var[:, r0:r1] = values
+            dst.variables['valid'][r0:r1] = valid
+            out = reconstruct_block(residual, scores, valid, mean, basis,
+                                    step, dtype)
+            error = np.abs(out.astype('f8') - data)
+            max_abs_error = max(max_abs_error, float(error.max()))
+    return max_abs_error
+
+
+def _int_type(max_value):
+    for t in ['i1', 'i2', 'i4']:
+        if max_value <= np.iinfo(t).max:
+            return t
+    return 'i8'
+
+
+def _fit_basis(variables, n_components, seed):
+    # mean and leading eigenvectors of the band covariance, fitted to a
+    # random sample of rows. Also returns the (band, pixel) sample of valid
+    # pixels
+    height, width = variables[0].shape
+    n_rows = min(height, max(1, math.ceil(FIT_SAMPLES / width)))
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(height, n_rows, replace=False))
+    sample = np.stack([v[rows, :] for v in variables]).reshape(
+        len(variables), -1).astype('f8')
+    sample = sample[:, (sample != 0).any(axis=0)]
+    n_components = max(1, min(n_components, len(variables)))
+    if sample.shape[1] < 2:
+        logging.warning('Too few valid pixels to fit a spectral basis')
+        return (np.zeros(len(variables)),
+                np.zeros((n_components, len(variables))), sample)
+    mean = sample.mean(axis=1)
+    cov = np.cov(sample)
+    _, vectors = np.linalg.eigh(np.atleast_2d(cov))
+    basis = vectors[:, ::-1][:, :n_components].T
+    return mean, np.ascontiguousarray(basis), sample
+
+
+def _create_compressed_netcdf(dst_fpath, template, sources, n_components,
+                              types=('i4', 'i4')):
+    # compressed file with the coordinates and grid mapping of the band
+    # files. Component images and residual are integers of types with
+    # shuffle and deflate, which packs small values into few bytes
+    ref = template.variables['reflectance']
+    height, width = ref.shape
+    dst = Dataset(dst_fpath, 'w', format='NETCDF4')
+    for k in template.ncattrs():
+        dst.setncattr(k, template.getncattr(k))
+    dst.setncattr('hsman_store', 'pca')
+    dst.createDimension('band', len(sources))
+    dst.createDimension('component', n_components)
+    dst.createDimension('y', height)
+    dst.createDimension('x', width)
+
+    for name in ['x', 'y']:
+        src = template.variables[name]
+        var = dst.createVariable(name, src.dtype, src.dimensions)
+        var.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        var[:] = src[:]
+    band = dst.createVariable('band', 'i4', ('band',))
+    band[:] = [int(x.variables['band'][0]) for x in sources]
+    wavelength = dst.createVariable('wavelength', 'f8', ('band',))
+    wavelength[:] = [float(x.variables['wavelength'][0]) for x in sources]
+
+    grid_mapping = ref.getncattr('grid_mapping')
+    src = template.variables[grid_mapping]
+    var = dst.createVariable(grid_mapping, src.dtype)
+    var.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+
+    dst.createVariable('mean', 'f8', ('band',))
+    dst.createVariable('basis', 'f8', ('component', 'band'))
+    tile = (min(height, CHUNK_SIZE), min(width, CHUNK_SIZE))
+    dst.createVariable('scores', types[0], ('component', 'y', 'x'),
+                       chunksizes=(1,) + tile, zlib=True, shuffle=True)
+    residual = dst.createVariable('residual', types[1], ('band', 'y', 'x'),
+                                  chunksizes=(1,) + tile, zlib=True,
+                                  shuffle=True)
+    dst.createVariable('valid', 'u1', ('y', 'x'), chunksizes=tile,
+                       zlib=True)
+    # the shared band metadata, e.g. acquisition time, goes on the residual
+    for k in ref.ncattrs():
+        if not k.startswith(_BAND_ATTRS):
+            residual.setncattr(k, ref.getncattr(k))
+    residual.setncattr('grid_mapping', grid_mapping)
+    return dst
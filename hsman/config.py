@@ -2,18 +2,25 @@
 All configuration file generation and handling
 """
 
+import copy
 import logging
 import os
 import shutil
 import yaml
 
+# use the libyaml loader where available
+_Loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+# parsed config files keyed by path, stored with (mtime, size)
+_CONFIG_CACHE = {}
+
 
 def get_datasets():
     _check_data_path()
-    _datasets = os.listdir(DATA_PATH)
+    data_path = get_data_path()
+    _datasets = os.listdir(data_path)
     datasets = {}
     for obj in _datasets:
-        ds_path = os.path.join(DATA_PATH, obj)
+        ds_path = os.path.join(data_path, obj)
         # if a directory and contains DATA dir
         if os.path.isdir(ds_path) and os.path.exists(os.path.join(ds_path,
                                                                   'DATA')):
@@ -25,24 +32,37 @@ def get_config(config=None):
     """
     Loads the config, by default available in the install directory
 
+    The parsed file is cached and only read again if its mtime or size
+    changes.
+
     Parameters
     ----------
     config : str, dict
         path to config file or config-like dictionary
     """
-    _check_user_installed()
     if type(config) == dict:
         return config
-    try:
-        with open(config, 'r') as file:
-            logging.debug('Using default config')
-            return yaml.load(file, Loader=yaml.FullLoader)
+    if config is None:
+        _check_user_installed()
+        logging.debug('Using default config')
+        config = CONFIG_PATH
+    return copy.deepcopy(_load_config(config))
+
+
+def get_data_path():
+    """
+    Returns the absolute path of the data store from the config
+    """
+    return os.path.abspath(os.path.expanduser(
+        get_config()['hsman_data_path']))
+
 
-    # if None supplied
-    except TypeError:
-        with open(CONFIG_PATH, 'r') as file:
-            logging.debug('Using default config')
-            return yaml.load(file, Loader=yaml.FullLoader)
+def get_scratch_path():
+    """
+    Returns the first usable scratch directory from the config, creating it
+    if necessary
+    """
+    return _make_scratch(get_config())
 
 
 def logger():
@@ -110,14 +130,31 @@ def update_config(updates):
         dictionary with config parameters to add/replace
     """
     config = get_config()
-    new_config = config.update(updates)
+    config.update(updates)
     with open(CONFIG_PATH, 'w') as file:
-        return yaml.dump(new_config, file, Loader=yaml.FullLoader)
+        return yaml.dump(config, file)
+
+
+def _load_config(path):
+    # returns the cached parse of a config file unless it has changed
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    try:
+        cached_key, cached = _CONFIG_CACHE[path]
+        if cached_key == key:
+            return cached
+    except KeyError:
+        pass
+    with open(path, 'r') as file:
+        config = yaml.load(file, Loader=_Loader)
+    _CONFIG_CACHE[path] = (key, config)
+    return config
 
 
 def _check_data_path():
-    if not os.path.isdir(DATA_PATH):
-        os.makedirs(DATA_PATH)
+    data_path = get_data_path()
+    if not os.path.isdir(data_path):
+        os.makedirs(data_path)
 
 
 def _check_user_installed():
@@ -138,7 +175,7 @@ def _create_default_config():
 
 def _logging_params():
     try:
-        level = CONFIG['logging_level']
+        level = get_config()['logging_level']
     except KeyError:
         level = 'logging.INFO'
     if level is None:
@@ -146,10 +183,9 @@ def _logging_params():
     return eval(level), os.path.join(USER_PATH, 'hsman.log')
 
 
-# post install (requires CONFIG to be loaded)
-def _make_scratch():
+def _make_scratch(config):
     try:
-        sp = CONFIG['scratch_directory']
+        sp = config['scratch_directory']
     except KeyError:
         # linux default
         sp = ['/tmp/.hsman']
@@ -165,9 +201,17 @@ def _make_scratch():
     return s
 
 
+def __getattr__(name):
+    # config dependent values are only loaded when first requested
+    if name == 'CONFIG':
+        return get_config()
+    if name == 'DATA_PATH':
+        return get_data_path()
+    if name == 'SCRATCH_PATH':
+        return get_scratch_path()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 INSTALL_PATH = os.path.abspath(os.path.dirname(__file__))
 USER_PATH = os.path.abspath(os.path.join(os.environ['HOME'], '.hsman'))
 CONFIG_PATH = os.path.join(USER_PATH, 'config.yaml')
-CONFIG = get_config()
-DATA_PATH = os.path.abspath(os.path.expanduser(CONFIG['hsman_data_path']))
-SCRATCH_PATH = _make_scratch()
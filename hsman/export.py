@@ -0,0 +1,333 @@
+"""Submodule for exporting subsets of datasets, e.g. for partners
+
+Exports are computed and written chunk by chunk (see
+`processing.write_netcdf`), so a dataset of any size is streamed with
+bounded memory, and written to a temporary file (or Zarr store) that is
+moved into place when complete. Outputs are tiled and compressed, with
+tiles aligned to the chunks so that every tile is written once.
+"""
+
+import logging
+import math
+import os
+import shutil
+
+import numpy as np
+
+from .api import _cube_source
+from .processing import write_netcdf, _computed_blocks, _spectral_chunks
+
+EXPORT_FORMATS = {'netcdf': '.nc', 'gtiff': '.tif', 'zarr': '.zarr'}
+# tile size of the outputs, chunks are multiples of it
+TILE_SIZE = 512
+
+
+def export_datasets(dst_dir, datasets=None, site=None, types=None,
+                    start=None, end=None, bbox=None, wavelengths=None,
+                    bands=None, crs=None, resolution=None, format='netcdf',
+                    workers=4, prefetch=4, block_mb=64):
+    """
+    Export datasets, or their subsets, to files
+
+    Datasets are given by name or selected from the inventory by site,
+    type, date and footprint. Each is clipped to `bbox` and subset to
+    bands before any data is read. If a CRS or resolution is given,
+    datasets are resampled (nearest neighbour) onto a grid snapped to the
+    resolution, using the cached index maps of `hsman.grid`.
+
+    Parameters
+    ----------
+    dst_dir : path-like
+        output directory, created if needed. Files are named after the
+        datasets
+    datasets : list, optional
+        dataset names. If None, the datasets selected by site, types, start,
+        end and bbox
+    site : str, optional
+        site code as in the `Site` column of `get_datasets`
+    types : list, optional
+        dataset types, e.g. ['VNIR', 'SWIR']
+    start, end : str or datetime, optional
+        inclusive date range of the datasets
+    bbox : tuple, optional
+        (min lon, min lat, max lon, max lat) to clip the datasets to
+    wavelengths : list, optional
+        wavelengths (nm) of the bands to export, the nearest band of each
+        dataset is used
+    bands : list, optional
+        band numbers to export
+    crs : str, optional
+        CRS of the outputs, by default that of each dataset
+    resolution : float, optional
+        pixel size of the outputs in units of their CRS, by default that
+        of each dataset
+    format : str, optional
+        'netcdf', 'gtiff' (tiled GeoTIFF) or 'zarr' (needs the zarr
+        package)
+    workers : int, optional
+        number of threads computing chunks
+    prefetch : int, optional
+        number of chunks computed ahead of the writer
+    block_mb : int, optional
+        target size of a chunk of all the exported bands
+
+    Returns
+    -------
+    paths : list
+        written files
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'format {format} not recognised')
+    if datasets is None:
+        datasets = select_datasets(site, types, start, end, bbox)
+    elif isinstance(datasets, str):
+        datasets = [datasets]
+    if len(datasets) < 1:
+        raise IOError('No datasets to export')
+    os.makedirs(dst_dir, exist_ok=True)
+
+    paths = []
+    for name in datasets:
+        array = export_array(name, bbox, wavelengths, bands, crs,
+                             resolution, block_mb)
+        fpath = os.path.join(dst_dir, name + EXPORT_FORMATS[format])
+        logging.info(f'Exporting {name} {dict(array.sizes)} to {fpath}')
+        if format == 'netcdf':
+            write_netcdf(array, fpath, workers, prefetch)
+        elif format == 'zarr':
+            write_zarr(array, fpath, workers, prefetch)
+        else:
+            write_geotiff(array, fpath, workers, prefetch)
+        paths.append(fpath)
+    return paths
+
+
+def select_datasets(site=None, types=None, start=None, end=None, bbox=None):
+    """
+    Names of the datasets in the inventory matching every given filter,
+    see `export_datasets`
+    """
+    import pandas as pd
+    from .api import get_datasets, _bbox_polygon
+
+    dsets = get_datasets()
+    if site is not None:
+        dsets = dsets[dsets['Site'] == site]
+    if types is not None:
+        dsets = dsets[dsets['type'].isin(types)]
+    if start is not None:
+        dsets = dsets[dsets['date'] >= pd.to_datetime(start)]
+    if end is not None:
+        dsets = dsets[dsets['date'] <= pd.to_datetime(end)]
+    if bbox is not None:
+        dsets = dsets[dsets.intersects(_bbox_polygon(bbox))]
+    return list(dsets['dataset'])
+
+
+def export_array(name, bbox=None, wavelengths=None, bands=None, crs=None,
+                 resolution=None, block_mb=64):
+    """
+    Lazy (band, y, x) array of a dataset as it is exported, see
+    `export_datasets`
+
+    Returns
+    -------
+    array : xarray.DataArray
+        dask backed, in chunks that are whole output tiles of about
+        `block_mb`, with the CRS written by rioxarray
+    """
+    from rasterio.warp import transform_bounds
+    from . import grid as _grid
+
+    # opening is lazy, so the layout is read first to choose the chunks
+    array, src_crs = _cube_source(name)
+    image = np.array_equal(array.wavelength.values, array.band.values)
+    idx = _band_index(array, wavelengths, bands)
+    chunks = _spectral_chunks(array, block_mb, len(idx),
+                              array.dtype.itemsize)
+    array, src_crs = _cube_source(name, chunks)
+    array = array.isel(band=idx)
+    if image:
+        # images have band numbers as wavelengths
+        array = array.drop_vars('wavelength')
+
+    if crs is None and resolution is None:
+        if bbox is not None:
+            array = _clip(array, transform_bounds('epsg:4326', src_crs,
+                                                  *bbox))
+        dst_crs = src_crs
+    else:
+        dst_crs = src_crs if crs is None else crs
+        if resolution is None:
+            resolution = abs(float(array.x[1] - array.x[0]))
+        if bbox is not None:
+            bounds = transform_bounds('epsg:4326', dst_crs, *bbox)
+        else:
+            bounds = transform_bounds(src_crs, dst_crs, *_grid.source_bounds(
+                array.x.values, array.y.values))
+        grid = _grid.target_grid(bounds, dst_crs, resolution)
+        rows, cols = _grid.index_maps(name, array.x.values, array.y.values,
+                                      src_crs, grid)
+        array = _grid.regrid(array, rows, cols, grid)
+
+    if array.sizes['x'] < 1 or array.sizes['y'] < 1:
+        raise ValueError(f'{name} does not intersect the bbox')
+    array = array.chunk(_tile_chunks(array.shape, array.dtype.itemsize,
+                                     block_mb))
+    array.name = 'reflectance'
+    return array.rio.write_crs(dst_crs)
+
+
+def write_geotiff(array, fpath, workers=4, prefetch=4):
+    """
+    Compute a lazy array and write it to a tiled, deflate compressed
+    GeoTIFF
+
+    Chunks are computed by a thread pool and written by the calling thread,
+    as in `processing.write_netcdf`. Chunks should be whole tiles
+    (multiples of TILE_SIZE). Band wavelengths are written as band
+    descriptions.
+
+    Parameters
+    ----------
+    array : xarray.DataArray
+        (band, y, x) or (y, x) array with a CRS set with rioxarray
+    fpath : path-like
+        output file
+    workers : int, optional
+        number of computing threads
+    prefetch : int, optional
+        number of chunks computed ahead of the writer
+
+    Returns
+    -------
+    fpath : path-like
+    """
+    import rasterio
+    import rioxarray  # noqa: F401, registers the rio accessor
+
+    if 'band' not in array.dims:
+        array = array.expand_dims('band')
+    array = array.transpose('band', 'y', 'x')
+    dtype = array.dtype
+    profile = dict(
+        driver='GTiff', dtype=dtype, count=array.sizes['band'],
+        width=array.sizes['x'], height=array.sizes['y'],
+        crs=array.rio.crs, transform=array.rio.transform(),
+        nodata=np.nan if dtype.kind == 'f' else 0, tiled=True,
+        blockxsize=TILE_SIZE, blockysize=TILE_SIZE, compress='deflate',
+        predictor=3 if dtype.kind == 'f' else 2, BIGTIFF='IF_SAFER')
+    tmp_fpath = f'{fpath}.tmp'
+    try:
+        with rasterio.open(tmp_fpath, 'w', **profile) as dst:
+            if 'wavelength' in array.coords:
+                for i, wl in enumerate(array.wavelength.values):
+                    dst.set_band_description(i + 1, f'{wl:g} nm')
+                dst.update_tags(wavelength=','.join(
+                    [f'{x:g}' for x in array.wavelength.values]))
+            for (r0, r1, c0, c1), values in _computed_blocks(
+                    array, workers, prefetch):
+                dst.write(values, window=rasterio.windows.Window(
+                    c0, r0, c1 - c0, r1 - r0))
+    except BaseException:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    os.replace(tmp_fpath, fpath)
+    return fpath
+
+
+def write_zarr(array, fpath, workers=4, prefetch=4):
+    """
+    Compute a lazy array and write it to a Zarr store
+
+    The store metadata and coordinates are written first, then each chunk
+    is written into its region as it is computed, as in
+    `processing.write_netcdf`. Zarr chunks are (1, TILE_SIZE, TILE_SIZE),
+    so every array chunk is a whole number of them. The store is written
+    next to `fpath` and moved into place when complete.
+
+    Parameters
+    ----------
+    array : xarray.DataArray
+        (band, y, x) or (y, x) array in chunks of whole tiles
+    fpath : path-like
+        output store directory
+    workers : int, optional
+        number of computing threads
+    prefetch : int, optional
+        number of chunks computed ahead of the writer
+
+    Returns
+    -------
+    fpath : path-like
+    """
+    try:
+        import zarr
+    except ModuleNotFoundError:
+        raise RuntimeError("'zarr' package must be installed to export to "
+                           "Zarr")
+
+    if 'band' not in array.dims:
+        array = array.expand_dims('band')
+    array = array.transpose('band', 'y', 'x')
+    name = array.name or 'data'
+    chunks = (1, min(TILE_SIZE, array.sizes['y']),
+              min(TILE_SIZE, array.sizes['x']))
+    fill = np.nan if array.dtype.kind == 'f' else 0
+    tmp_fpath = f'{fpath}.tmp'
+    if os.path.exists(tmp_fpath):
+        shutil.rmtree(tmp_fpath)
+    try:
+        # the data is only written by region, as it is computed
+        array.to_dataset(name=name).to_zarr(
+            tmp_fpath, mode='w', compute=False,
+            encoding={name: {'chunks': chunks, '_FillValue': fill}})
+        var = zarr.open_group(tmp_fpath, mode='r+')[name]
+        for (r0, r1, c0, c1), values in _computed_blocks(
+                array, workers, prefetch):
+            var[:, r0:r1, c0:c1] = values
+    except BaseException:
+        shutil.rmtree(tmp_fpath, ignore_errors=True)
+        raise
+    # a directory can only be replaced once the old one is moved aside
+    if os.path.exists(fpath):
+        os.replace(fpath, f'{fpath}.old')
+    os.replace(tmp_fpath, fpath)
+    shutil.rmtree(f'{fpath}.old', ignore_errors=True)
+    return fpath
+
+
+def _band_index(array, wavelengths=None, bands=None):
+    # positions of the exported bands
+    if wavelengths is not None:
+        wl = array.wavelength.values
+        return [int(np.abs(wl - w).argmin()) for w in wavelengths]
+    if bands is not None:
+        band = list(array.band.values)
+        missing = [b for b in bands if b not in band]
+        if missing:
+            raise ValueError(f'Bands {missing} not found')
+        return [band.index(b) for b in bands]
+    return list(range(array.sizes['band']))
+
+
+def _tile_chunks(shape, itemsize, block_mb):
+    # dask chunks of all bands of about block_mb, in whole output tiles
+    n_bands, height, width = shape
+    area = max(1, int(block_mb * 2 ** 20) // (n_bands * itemsize))
+    side = math.ceil(int(math.sqrt(area)) / TILE_SIZE) * TILE_SIZE
+    return {'band': -1, 'y': min(side, height), 'x': min(side, width)}
+
+
+def _clip(array, bounds):
+    # pixels with centres within (left, bottom, right, top)
+    left, bottom, right, top = bounds
+    x = array.x.values
+    y = array.y.values
+    cols = np.flatnonzero((x >= left) & (x <= right))
+    rows = np.flatnonzero((y >= bottom) & (y <= top))
+    if len(cols) < 1 or len(rows) < 1:
+        return array.isel(y=slice(0, 0), x=slice(0, 0))
+    return array.isel(y=slice(rows[0], rows[-1] + 1),
+                      x=slice(cols[0], cols[-1] + 1))
@@ -0,0 +1,216 @@
+"""Submodule for shared target grids and cached nearest neighbour index maps
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+from .config import get_data_path, get_scratch_path
+
+# rows of the target grid transformed at once for reprojected index maps
+BLOCK_ROWS = 512
+
+
+class Grid(NamedTuple):
+    """A north-up target grid
+
+    `left` and `top` are the outer edges of the grid and `resolution` is the
+    pixel size in units of `crs` (a WKT string).
+    """
+    crs: str
+    left: float
+    top: float
+    resolution: float
+    width: int
+    height: int
+
+    @property
+    def x(self):
+        return self.left + (np.arange(self.width) + 0.5) * self.resolution
+
+    @property
+    def y(self):
+        return self.top - (np.arange(self.height) + 0.5) * self.resolution
+
+    @property
+    def bounds(self):
+        return (self.left, self.top - self.height * self.resolution,
+                self.left + self.width * self.resolution, self.top)
+
+    @property
+    def transform(self):
+        import rasterio
+        return rasterio.Affine(self.resolution, 0, self.left,
+                               0, -self.resolution, self.top)
+
+
+def target_grid(bounds, crs, resolution):
+    """Grid covering bounds, snapped to multiples of the resolution
+
+    Parameters
+    ----------
+    bounds : tuple
+        (left, bottom, right, top) in `crs`
+    crs : str or CRS
+        coordinate reference system of the grid
+    resolution : float
+        pixel size in units of `crs`
+
+    Returns
+    -------
+    grid : Grid
+    """
+    import pyproj
+    left, bottom, right, top = bounds
+    left = math.floor(left / resolution) * resolution
+    bottom = math.floor(bottom / resolution) * resolution
+    right = math.ceil(right / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    return Grid(pyproj.CRS.from_user_input(crs).to_wkt(), float(left),
+                float(top), float(resolution),
+                int(round((right - left) / resolution)),
+                int(round((top - bottom) / resolution)))
+
+
+def source_bounds(x, y):
+    """Outer (left, bottom, right, top) of a regular grid of pixel centres"""
+    dx = abs(x[1] - x[0]) if len(x) > 1 else 0
+    dy = abs(y[1] - y[0]) if len(y) > 1 else 0
+    return (float(x.min() - dx / 2), float(y.min() - dy / 2),
+            float(x.max() + dx / 2), float(y.max() + dy / 2))
+
+
+def index_maps(name, x, y, crs, grid, cache_dir=None):
+    """Nearest neighbour source rows and columns for each target pixel
+
+    When the source and target CRS match the maps are separable and 1D
+    (rows per target row, columns per target column), otherwise they are 2D
+    arrays of the target grid shape. Pixels outside the source are -1. Maps
+    are cached as .npz files keyed by the source and target grids, so
+    repeated calls do no resampling setup. The cache is only an
+    optimisation: if the store is read-only, maps are cached in the scratch
+    directory instead, and if no cache can be written they are not cached.
+
+    Parameters
+    ----------
+    name : str
+        dataset name, used in the cache file name
+    x, y : numpy.ndarray
+        regularly spaced pixel centre coordinates of the source
+    crs : str or CRS
+        source coordinate reference system
+    grid : Grid
+        target grid
+    cache_dir : path-like, optional
+        by default DATA_PATH/_cache/grids, falling back to grids/ in the
+        scratch directory
+
+    Returns
+    -------
+    rows, cols : numpy.ndarray
+    """
+    import pyproj
+    src_crs = pyproj.CRS.from_user_input(crs)
+    key = json.dumps([name, src_crs.to_wkt(), _axis(x), _axis(y),
+                      list(grid)])
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    fname = f'{name}_{digest}.npz'
+    for path in _cache_dirs(cache_dir):
+        try:
+            with np.load(os.path.join(path, fname)) as cached:
+                return cached['rows'], cached['cols']
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            pass
+
+    logging.debug(f'Computing index maps for {name}')
+    if src_crs == pyproj.CRS.from_wkt(grid.crs):
+        rows = _nearest(grid.y, y)
+        cols = _nearest(grid.x, x)
+    else:
+        transformer = pyproj.Transformer.from_crs(grid.crs, src_crs,
+                                                  always_xy=True)
+        rows = np.empty((grid.height, grid.width), 'i4')
+        cols = np.empty((grid.height, grid.width), 'i4')
+        gx = grid.x
+        for start in range(0, grid.height, BLOCK_ROWS):
+            gy = grid.y[start:start + BLOCK_ROWS]
+            xx, yy = np.meshgrid(gx, gy)
+            sx, sy = transformer.transform(xx, yy)
+            rows[start:start + len(gy)] = _nearest(sy, y)
+            cols[start:start + len(gy)] = _nearest(sx, x)
+        # a pixel is only inside the source if both indexes are
+        outside = (rows < 0) | (cols < 0)
+        rows[outside] = -1
+        cols[outside] = -1
+
+    for path in _cache_dirs(cache_dir):
+        fpath = os.path.join(path, fname)
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(fpath + '.tmp', 'wb') as f:
+                np.savez(f, rows=rows, cols=cols)
+            os.replace(fpath + '.tmp', fpath)
+            break
+        except OSError as e:
+            logging.debug(f'Could not cache index maps in {path} ({e})')
+    return rows, cols
+
+
+def regrid(array, rows, cols, grid, fill=None):
+    """Lazily resample a (..., y, x) DataArray onto a grid using index maps
+    from `index_maps`
+
+    Returns
+    -------
+    array : xarray.DataArray
+        with x and y coordinates of the grid, `fill` outside the source (by
+        default NaN for floating point arrays and 0 otherwise)
+    """
+    import xarray
+    if fill is None:
+        fill = np.nan if array.dtype.kind == 'f' else 0
+    r = np.where(rows < 0, 0, rows)
+    c = np.where(cols < 0, 0, cols)
+    if rows.ndim == 1:
+        out = array.isel(y=r, x=c)
+        valid = (rows >= 0)[:, None] & (cols >= 0)[None, :]
+    else:
+        out = array.isel(y=xarray.DataArray(r, dims=('y', 'x')),
+                         x=xarray.DataArray(c, dims=('y', 'x')))
+        valid = rows >= 0
+    out = out.drop_vars(['x', 'y'], errors='ignore')
+    out = out.where(xarray.DataArray(valid, dims=('y', 'x')), fill)
+    return out.assign_coords(x=grid.x, y=grid.y)
+
+
+def grid_cache_path():
+    # get_datasets skips names starting with _, so this is not a dataset
+    return os.path.join(get_data_path(), '_cache', 'grids')
+
+
+def _cache_dirs(cache_dir=None):
+    # index map cache directories in order of preference
+    if cache_dir is not None:
+        yield cache_dir
+        return
+    yield grid_cache_path()
+    yield os.path.join(get_scratch_path(), 'grids')
+
+
+def _nearest(values, axis):
+    # index of the nearest pixel centre of a regular axis, -1 outside
+    step = axis[1] - axis[0] if len(axis) > 1 else 1
+    idx = np.floor((values - axis[0]) / step + 0.5)
+    idx = np.where((idx >= 0) & (idx < len(axis)), idx, -1)
+    return idx.astype('i4')
+
+
+def _axis(values):
+    # compact description of a regular axis for cache keys
+    step = float(values[1] - values[0]) if len(values) > 1 else 0.0
+    return [float(values[0]), step, len(values)]
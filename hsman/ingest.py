@@ -5,26 +5,44 @@ import os
 import shutil
 import rasterio
 import numpy as np
-import rioxarray
 import functools
+import hashlib
 import subprocess
 import datetime
 import logging
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
 from netCDF4 import Dataset
+from typing import NamedTuple
 import tempfile
 
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
 
-from .config import DATA_PATH, logger, SCRATCH_PATH
-logger()
+# linux ioctl to clone (reflink) a file on copy-on-write filesystems
+FICLONE = 0x40049409
+TRANSFER_MODES = ['auto', 'copy', 'hardlink', 'reflink', 'move']
+# HSI bands are written to scratch and can be moved, images are left in place
+HSI_TRANSFER_MODE = 'move'
+IMAGE_TRANSFER_MODE = 'auto'
+MOSAIC_OVERLAPS = ['first', 'last', 'mean', 'min-angle']
 
 
-if "PYTEST_CURRENT_TEST" in os.environ:
-    # import pytest
-    SCRATCH_PATH = os.path.join(tmp_path, 'SCRATCH')
-    DATA_PATH = os.path.join(tmp_path, 'DATA')
+from .compress import COMPRESSED_SUFFIX, DEFAULT_COMPONENTS, STORE_MODES, \
+    compress_bands
+from .config import get_data_path, get_scratch_path
+from .manifest import Manifest, copy_and_hash, hash_file
+from .metrics import IngestProfiler, NullProfiler, file_size, run_command
+from .stats import BandStats, stats_attrs, write_band_stats
 
 
-def ingest_image(file_path, dataset_name):
+def ingest_image(file_path, dataset_name, profile=False,
+                 prometheus_dir=None, image_format='copy',
+                 transfer_mode=IMAGE_TRANSFER_MODE):
     """Ingest a single image file (e.g. tif)
 
     Parameters
@@ -33,21 +51,61 @@ def ingest_image(file_path, dataset_name):
         file path of input tif
     dataset_name : str
         name to use for folder and file names
+    image_format : str, optional
+        'copy' stores the file unchanged. 'cog' converts it to a tiled,
+        compressed Cloud Optimized GeoTIFF with internal overviews
+    transfer_mode : str, optional
+        how a 'copy' format file is put in the store: copy, hardlink,
+        reflink or move. 'auto' reflinks where the store filesystem supports
+        it and copies otherwise. Note a hardlink shares permissions with the
+        source, so the source also becomes read only
+    profile : bool, optional
+        if True, write a performance report to the METADATA folder
+    prometheus_dir : path-like, optional
+        if profiling, also write the summary to this Prometheus textfile
+        collector directory
     """
     logging.info(f'Ingesting {dataset_name} using image pipeline')
-    dst, _ = _make_dataset_folder(dataset_name)
+    dst, name = _make_dataset_folder(dataset_name)
+    profiler = IngestProfiler(name) if profile else NullProfiler()
+    profiler.input_bytes = file_size(file_path)
+    manifest = Manifest(dst)
     new_fpath = os.path.join(dst,
                              'DATA',
                              os.path.basename(file_path))
-    # move to directory
-    shutil.copyfile(file_path, new_fpath)
+    if image_format not in ['cog', 'copy']:
+        raise ValueError(f'image_format {image_format} not recognised')
+    # the pixel values are the same in the store, so the statistics are read
+    # from the source before it is moved, and the transfer or conversion
+    # reads it from the page cache
+    with profiler.stage('band_stats') as rec:
+        stats = _image_stats(file_path)
+        rec['bytes_read'] = file_size(file_path)
+    if image_format == 'cog':
+        new_fpath = os.path.splitext(new_fpath)[0] + '.tif'
+        with profiler.stage('cog_convert') as rec:
+            _convert_to_cog(file_path, new_fpath, record=rec)
+            rec['bytes_read'] = file_size(file_path)
+            rec['bytes_written'] = file_size(new_fpath)
+        with profiler.stage('checksum') as rec:
+            manifest.add(new_fpath, hash_file(new_fpath))
+            rec['bytes_read'] = file_size(new_fpath)
+    else:
+        # move to directory
+        _store_file(file_path, new_fpath, transfer_mode, manifest, profiler)
+    write_band_stats(dst, stats)
     # change permissions to read only
     os.chmod(new_fpath, 0o555)
+    manifest.save()
+    _write_profile(profiler, dst, prometheus_dir)
     logging.info(f'Ingestion of {dataset_name} complete!')
     return dst
 
 
-def ingest_hsi(file_paths, dataset_name):
+def ingest_hsi(file_paths, dataset_name, profile=False, prometheus_dir=None,
+               transfer_mode=HSI_TRANSFER_MODE, mosaic=None,
+               wavelength_range=None, exclude_ranges=None, bin_factor=1,
+               deinterleave=True, store=None):
     """Ingest a list of HSI files
 
     Parameters
@@ -56,75 +114,526 @@ def ingest_hsi(file_paths, dataset_name):
         list of file paths for inputfiles
     dataset_name : str
         name to use for folder and file names
+    profile : bool, optional
+        if True, record wall time, CPU time, bytes read/written and the peak
+        RSS of the process and of the GDAL tools for each stage per band and
+        flightline, and write a report to the METADATA folder
+    prometheus_dir : path-like, optional
+        if profiling, also write the summary to this Prometheus textfile
+        collector directory
+    transfer_mode : str, optional
+        how band files are put in the store from scratch (see
+        `ingest_image`). 'auto' renames when scratch and store share a
+        filesystem and copies otherwise
+    mosaic : dict, optional
+        how flightlines are mosaicked. By default gdal_merge.py, which holds
+        the whole band in memory and keeps the last flightline where they
+        overlap. {'method': 'tiled', 'overlap': 'last',
+        'max_memory_mb': 512} streams the mosaic in tiles with a memory cap;
+        overlap is one of 'first', 'last', 'mean' or 'min-angle'
+    wavelength_range : list, optional
+        [min, max] wavelength (nm) of the bands to ingest
+    exclude_ranges : list, optional
+        list of [min, max] wavelength ranges (nm) to leave out, e.g. water
+        absorption bands
+    bin_factor : int, optional
+        number of adjacent bands averaged into each ingested band. Bands are
+        only binned within contiguous runs of the selected bands and any
+        remainder at the end of a run is dropped
+    deinterleave : bool, optional
+        write band sequential copies of BIL and BIP ENVI inputs to scratch
+        before the band loop. Each band extraction then reads only that
+        band, instead of the whole file
+    store : dict, optional
+        how the bands are stored. By default one netCDF file per band.
+        {'mode': 'pca', 'max_error': 0, 'n_components': 8,
+        'max_memory_mb': 512} stores a spectral basis, component images and
+        a quantized residual in one file (see `compress.compress_bands`),
+        lossless when max_error is 0. The band files are kept in scratch
+        until every band is written
     """
     logging.info(f'Ingesting {dataset_name} using HSI pipeline')
+    compressed = _store_mode(store) == 'pca'
     # use temporary directory context handler
     # generate dataset folder
-    dst, name = _make_dataset_folder(dataset_name, DATA_PATH)
+    dst, name = _make_dataset_folder(dataset_name)
+    profiler = IngestProfiler(name) if profile else NullProfiler()
+    profiler.input_bytes = sum([file_size(x) for x in file_paths])
+    manifest = Manifest(dst)
+
+    # read the metadata of every input once for all stages
+    with profiler.stage('metadata'):
+        file_paths = _get_file_metadata(file_paths)
 
-    # generate band idx and wavelengths
-    band_idxs, wavelengths = _get_common_idx(file_paths)
+    band_idxs, wavelengths, band_metadata = _band_plan(
+        file_paths, wavelength_range, exclude_ranges, bin_factor)
+
+    # iterate the bands and generate band slice files one at a time
+    n_bands = len(wavelengths)
+    profiler.n_bands = n_bands
+    scratch_path = get_scratch_path()
+    deinterleave_dir = tempfile.mkdtemp(dir=scratch_path,
+                                        prefix='deinterleave_')
+    band_dir = tempfile.mkdtemp(dir=scratch_path, prefix='bands_') \
+        if compressed else None
+    band_files = []
+    band_stats = {}
+    try:
+        if deinterleave and n_bands > 1:
+            file_paths = _deinterleave_files(file_paths, deinterleave_dir,
+                                             profiler, band_idxs)
+        for i in range(n_bands):
+            logging.info('Processing band {}/{} (wavelength={}nm)'.format(
+                i + 1,
+                n_bands,
+                wavelengths[i]
+            ))
+            _new_file, band_stats[i + 1] = _ingest_band(
+                file_paths, dst, band_idxs[:, i], wavelengths[i], i + 1,
+                band_metadata[i], manifest, profiler, mosaic=mosaic,
+                transfer_mode=transfer_mode, keep_dir=band_dir)
+            band_files.append(_new_file)
+        if compressed:
+            _compress_store(band_files, dst, name, store, manifest, profiler,
+                            transfer_mode)
+    finally:
+        shutil.rmtree(deinterleave_dir, ignore_errors=True)
+        if band_dir is not None:
+            shutil.rmtree(band_dir, ignore_errors=True)
+
+    write_band_stats(dst, band_stats)
+    manifest.save()
+    _write_profile(profiler, dst, prometheus_dir)
+    os.chmod(dst, 0o555)
+    logging.info(f'Ingestion of {dataset_name} complete!')
+    return dst
+
+
+def enqueue_hsi(queue, file_paths, dataset_name,
+                transfer_mode=HSI_TRANSFER_MODE,
+                mosaic=None, wavelength_range=None, exclude_ranges=None,
+                bin_factor=1, deinterleave=True, store=None):
+    """Add the jobs of an HSI ingest to a work queue
+
+    Only the file headers are read. The dataset folder is created straight
+    away and the jobs are: de-interleaving the inputs, one job per band and
+    a final job that writes the statistics and manifest (and compresses the
+    bands), in that order. Any `hsman worker` can run them, so intermediate
+    files go in a work folder in the scratch directory, which must be shared
+    by the nodes. The options are those of `ingest_hsi`.
+
+    Parameters
+    ----------
+    queue : workqueue.WorkQueue
+        queue to add the jobs to
+    file_paths : list-like
+        list of file paths for inputfiles
+    dataset_name : str
+        name to use for folder and file names
+
+    Returns
+    -------
+    dst : str
+        path of the dataset, which is the group of the jobs
+    """
+    compressed = _store_mode(store) == 'pca'
+    dst, name = _make_dataset_folder(dataset_name)
+    records = _get_file_metadata(file_paths)
+    band_idxs, wavelengths, band_metadata = _band_plan(
+        records, wavelength_range, exclude_ranges, bin_factor)
+    work_dir = tempfile.mkdtemp(dir=get_scratch_path(), prefix=f'{name}_')
+    common = {'dataset': dst, 'paths': [x.path for x in records],
+              'work_dir': work_dir}
+
+    jobs = []
+    if deinterleave and len(wavelengths) > 1:
+        jobs.append(('hsi_prepare', dict(common, bands=band_idxs), 0))
+    for i in range(len(wavelengths)):
+        jobs.append(('hsi_band', dict(common, band=band_idxs[:, i],
+                                      wavelength=wavelengths[i],
+                                      new_band=i + 1,
+                                      metadata=band_metadata[i],
+                                      mosaic=mosaic,
+                                      transfer_mode=transfer_mode,
+                                      keep=compressed), 1))
+    jobs.append(('hsi_finalize', dict(common, name=name, store=store,
+                                      transfer_mode=transfer_mode), 2))
+    queue.add(jobs, group=dst)
+    logging.info(f'Queued {len(jobs)} jobs for {name}')
+    return dst
+
+
+def enqueue_image(queue, file_path, dataset_name, image_format='copy',
+                  transfer_mode=IMAGE_TRANSFER_MODE):
+    """Add an image ingest to a work queue as a single job, see
+    `ingest_image`"""
+    payload = {'path': os.path.abspath(file_path), 'name': dataset_name,
+               'image_format': image_format, 'transfer_mode': transfer_mode}
+    queue.add([('image', payload, 0)], group=f'image:{dataset_name}')
+
+
+def _store_mode(store):
+    # validated store mode of an HSI recipe
+    mode = (store or {}).get('mode', 'bands')
+    if mode not in STORE_MODES:
+        raise ValueError(f'store mode {mode} not recognised')
+    return mode
+
+
+def _band_plan(records, wavelength_range=None, exclude_ranges=None,
+               bin_factor=1):
+    # per file band indexes, wavelengths and netCDF attributes of each
+    # ingested band
+    band_idxs, wavelengths = _get_common_idx(records)
+    band_idxs, wavelengths, source_wavelengths = _select_bands(
+        band_idxs, wavelengths, wavelength_range, exclude_ranges, bin_factor)
 
     # For testing only, make a small version
     if "PYTEST_CURRENT_TEST" in os.environ:
         band_idxs = band_idxs[:,:3]
         wavelengths = wavelengths[:3]
+        source_wavelengths = source_wavelengths[:3]
 
     # get all metadata
-    metadata = _get_other_metadata(file_paths)
-    metadata['acquisition_start_time'] = _get_collect_time(file_paths).isoformat()
+    metadata = _get_other_metadata(records)
+    metadata['acquisition_start_time'] = _get_collect_time(records).isoformat()
+    metadata.update(_spectral_metadata(wavelength_range, exclude_ranges,
+                                       bin_factor))
+    band_metadata = []
+    for i in range(len(wavelengths)):
+        band_metadata.append(dict(metadata))
+        if bin_factor > 1:
+            band_metadata[-1]['source_wavelengths'] = source_wavelengths[i]
+    return band_idxs, wavelengths, band_metadata
 
-    # iterate the bands and generate band slice files one at a time
-    n_bands = len(wavelengths)
-    for i in range(n_bands):
-        with tempfile.TemporaryDirectory(dir=SCRATCH_PATH) as temp_dir:
-            new_band_idx = i+1
-            band_idx = band_idxs[:, i]
-            wavelength = wavelengths[i]
-            logging.info('Processing band {}/{} (wavelength={}nm)'.format(
-                new_band_idx,
-                n_bands,
-                wavelength
-            ))
-            _new_file = _merge_band(file_paths, temp_dir, band_idx, metadata,
-                                    wavelength, new_band_idx)
 
-            logging.info('Band complete... Transferring to store...')
-            _dst = os.path.join(dst, 'DATA', os.path.basename(_new_file))
+def _ingest_band(file_paths, dst, band_idx, wavelength, new_band_idx,
+                 metadata, manifest, profiler, mosaic=None,
+                 transfer_mode=HSI_TRANSFER_MODE, keep_dir=None):
+    # merges one band in scratch and puts it in the dataset at dst, or in
+    # keep_dir when the bands are compressed afterwards. Returns the path of
+    # the band file and its statistics
+    with tempfile.TemporaryDirectory(dir=get_scratch_path()) as temp_dir:
+        stats = BandStats()
+        _new_file = _merge_band(file_paths, temp_dir, band_idx, metadata,
+                                wavelength, new_band_idx, profiler=profiler,
+                                mosaic=mosaic, stats=stats)
+        stats = dict(stats.to_dict(), wavelength=float(wavelength))
+        if keep_dir is not None:
+            # kept until all bands can be compressed together
+            _dst = os.path.join(keep_dir, os.path.basename(_new_file))
             shutil.move(_new_file, _dst)
-            os.chmod(_dst, 0o555)
+            return _dst, stats
 
-    os.chmod(dst, 0o555)
-    logging.info(f'Ingestion of {dataset_name} complete!')
+        logging.info('Band complete... Transferring to store...')
+        _dst = os.path.join(dst, 'DATA', os.path.basename(_new_file))
+        if os.path.exists(_dst):
+            # left by an earlier attempt of a distributed band job
+            os.remove(_dst)
+        # scratch files are discarded, so auto can always move
+        mode = 'move' if transfer_mode == 'auto' else transfer_mode
+        _store_file(_new_file, _dst, mode, manifest, profiler,
+                    band=new_band_idx)
+        os.chmod(_dst, 0o555)
+    return _dst, stats
+
+
+def _compress_store(band_files, dst, name, store, manifest, profiler,
+                    transfer_mode=HSI_TRANSFER_MODE):
+    # compresses the kept band files into the dataset at dst
+    logging.info('Compressing bands...')
+    with tempfile.TemporaryDirectory(dir=get_scratch_path()) as temp_dir:
+        _new_file = os.path.join(temp_dir, name + COMPRESSED_SUFFIX)
+        with profiler.stage('compress') as rec:
+            rec['max_abs_error'] = compress_bands(
+                band_files, _new_file,
+                max_error=store.get('max_error', 0),
+                n_components=store.get('n_components', DEFAULT_COMPONENTS),
+                max_memory_mb=store.get('max_memory_mb', 512))
+            rec['bytes_read'] = sum([file_size(x) for x in band_files])
+            rec['bytes_written'] = file_size(_new_file)
+        _dst = os.path.join(dst, 'DATA', os.path.basename(_new_file))
+        mode = 'move' if transfer_mode == 'auto' else transfer_mode
+        _store_file(_new_file, _dst, mode, manifest, profiler)
+        os.chmod(_dst, 0o555)
+    return _dst
+
+
+def _run_prepare_job(job, queue):
+    # de-interleaves the inputs of an ingest into its work folder
+    p = job.payload
+    deinterleave_dir = os.path.join(p['work_dir'], 'deinterleave')
+    os.makedirs(deinterleave_dir, exist_ok=True)
+    records = _deinterleave_files(_get_file_metadata(p['paths']),
+                                  deinterleave_dir, NullProfiler(),
+                                  p.get('bands'))
+    return {'paths': [x.path for x in records]}
+
+
+def _run_band_job(job, queue):
+    # merges and stores one band of an ingest
+    p = job.payload
+    prepared = queue.results(job.group, kind='hsi_prepare')
+    paths = prepared[0]['result']['paths'] if prepared else p['paths']
+    keep_dir = None
+    if p['keep']:
+        keep_dir = os.path.join(p['work_dir'], 'bands')
+        os.makedirs(keep_dir, exist_ok=True)
+    # a worker usually runs many bands of the same inputs
+    records = _cached_file_metadata(tuple(paths))
+    manifest = Manifest(p['dataset'])
+    path, stats = _ingest_band(
+        records, p['dataset'], np.asarray(p['band']), p['wavelength'],
+        p['new_band'], p['metadata'], manifest, NullProfiler(),
+        mosaic=p['mosaic'], transfer_mode=p['transfer_mode'],
+        keep_dir=keep_dir)
+    return {'band': p['new_band'], 'path': path, 'stats': stats,
+            'manifest': manifest.files}
+
+
+def _run_finalize_job(job, queue):
+    # writes the statistics and manifest of an ingest, after compressing
+    # the bands if they were kept
+    p = job.payload
+    bands = sorted([x['result'] for x in
+                    queue.results(job.group, kind='hsi_band')],
+                   key=lambda x: x['band'])
+    manifest = Manifest(p['dataset'])
+    for x in bands:
+        manifest.files.update(x['manifest'])
+    if _store_mode(p['store']) == 'pca':
+        _compress_store([x['path'] for x in bands], p['dataset'], p['name'],
+                        p['store'], manifest, NullProfiler(),
+                        p['transfer_mode'])
+    write_band_stats(p['dataset'], {x['band']: x['stats'] for x in bands})
+    manifest.save()
+    os.chmod(p['dataset'], 0o555)
+    shutil.rmtree(p['work_dir'], ignore_errors=True)
+    logging.info(f"Ingestion of {p['name']} complete!")
+    return {'n_bands': len(bands)}
+
+
+def _run_image_job(job, queue):
+    p = job.payload
+    return {'dataset': ingest_image(p['path'], p['name'],
+                                    image_format=p['image_format'],
+                                    transfer_mode=p['transfer_mode'])}
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_file_metadata(paths):
+    return _get_file_metadata(list(paths))
+
+
+# workqueue handlers of the jobs added by enqueue_hsi and enqueue_image
+JOB_HANDLERS = {'hsi_prepare': _run_prepare_job,
+                'hsi_band': _run_band_job,
+                'hsi_finalize': _run_finalize_job,
+                'image': _run_image_job}
+
+
+def _deinterleave_files(records, dst, profiler, band_idxs=None):
+    # band sequential copies of the BIL/BIP ENVI records, others unchanged.
+    # Only the bands of band_idxs (one row per record) are written
+    out = []
+    for i, record in enumerate(records):
+        try:
+            _find_envi_header(record.path)
+            is_envi = True
+        except FileNotFoundError:
+            # e.g. a pixel interleaved GeoTIFF read through GDAL
+            is_envi = False
+        if is_envi and record.interleave in ['bil', 'bip'] and \
+                record.data_type in ENVI_DTYPES:
+            logging.info(f'De-interleaving {record.path}')
+            with profiler.stage('deinterleave',
+                                flightline=record.path) as rec:
+                bands = None if band_idxs is None \
+                    else np.unique(band_idxs[i])
+                new_record = _deinterleave_envi(record, dst, bands)
+                rec['bytes_read'] = file_size(record.path)
+                # the copy is sparse, only the written planes use space
+                n_written = record.bands if bands is None else len(bands)
+                rec['bytes_written'] = file_size(new_record.path) \
+                    * n_written // record.bands
+            record = new_record
+        out.append(record)
+    return out
+
+
+def _transfer_file(src, dst, mode='auto', hasher=None):
+    # puts src in the store at dst and returns the method actually used.
+    # hardlink, reflink and move fall back to copying when they are not
+    # possible (e.g. across filesystems). If a hasher is given, copies
+    # update it as the data is streamed
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f'transfer_mode {mode} not recognised')
+    if mode == 'auto':
+        mode = 'reflink' if _same_filesystem(src, dst) else 'copy'
+
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            logging.debug(f'hardlink failed ({e}), copying instead')
+    elif mode == 'reflink':
+        try:
+            _reflink(src, dst)
+            return 'reflink'
+        except OSError as e:
+            logging.debug(f'reflink failed ({e}), copying instead')
+    elif mode == 'move':
+        if _same_filesystem(src, dst):
+            os.rename(src, dst)
+            return 'move'
+        _copy_file(src, dst, hasher)
+        os.remove(src)
+        return 'copy'
+
+    _copy_file(src, dst, hasher)
+    return 'copy'
+
+
+def _copy_file(src, dst, hasher=None):
+    if hasher is None:
+        shutil.copyfile(src, dst)
+    else:
+        copy_and_hash(src, dst, hasher)
+
+
+def _store_file(src, dst, mode, manifest, profiler, band=None):
+    # transfer a file into the store and add its checksum to the manifest.
+    # copies are hashed while streaming, anything else is hashed in place
+    hasher = manifest.new_hash()
+    with profiler.stage('transfer', band=band) as rec:
+        used = _transfer_file(src, dst, mode, hasher)
+        rec['mode'] = used
+        if used == 'copy':
+            rec['bytes_read'] = rec['bytes_written'] = file_size(dst)
+    if used != 'copy':
+        with profiler.stage('checksum', band=band) as rec:
+            hash_file(dst, hasher)
+            rec['bytes_read'] = file_size(dst)
+    manifest.add(dst, hasher.hexdigest())
+
+
+def _same_filesystem(src, dst):
+    return os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+
+
+def _transfer_copies(src_dir, dst_dir, mode):
+    # whether _transfer_file from src_dir into dst_dir copies the data.
+    # Renames, links and reflinks only work within one filesystem (reflink
+    # support of the filesystem itself is assumed)
+    if mode == 'copy':
+        return True
+    return _device(src_dir) != _device(dst_dir)
+
+
+def _device(path):
+    # device of path, or of its nearest existing parent
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def _reflink(src, dst):
+    # clone the file extents so no data is copied (btrfs, xfs, ...)
+    if fcntl is None:
+        raise OSError('reflink not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def _convert_to_cog(src, dst, block_size=512, compress='DEFLATE',
+                    cache_mb=256, record=None):
+    # writes a tiled, compressed COG with internal overviews. GDAL streams
+    # the conversion through a block cache of cache_mb megabytes. The peak
+    # memory of GDAL is recorded in the profiler stage record, if given
+    tmp = os.path.join(os.path.dirname(dst), '~' + os.path.basename(dst))
+    config = ['--config', 'GDAL_CACHEMAX', str(cache_mb)]
+    command = ['gdal_translate', '-of', 'COG',
+               '-co', f'BLOCKSIZE={block_size}',
+               '-co', f'COMPRESS={compress}',
+               '-co', 'PREDICTOR=YES',
+               '-co', 'OVERVIEWS=AUTO',
+               '-co', 'BIGTIFF=IF_SAFER',
+               '-co', 'NUM_THREADS=ALL_CPUS'] + config + [src, tmp]
+    logging.debug(f'Converting {src} to COG')
+    try:
+        if _gdal_has_driver('COG'):
+            run_command(command, record)
+        else:
+            # GDAL < 3.1 has no COG driver, so tile, add overviews and copy
+            # them in front of the data as the COG driver does
+            logging.debug('COG driver unavailable, writing tiled GeoTIFF')
+            with tempfile.TemporaryDirectory(dir=get_scratch_path()) as tdir:
+                tiled = os.path.join(tdir, 'tiled.tif')
+                command = ['gdal_translate', '-of', 'GTiff',
+                           '-co', 'TILED=YES',
+                           '-co', 'BIGTIFF=IF_SAFER'] + config + [src, tiled]
+                run_command(command, record)
+                command = ['gdaladdo', '-r', 'average'] + config + [tiled]
+                run_command(command, record)
+                with rasterio.open(src) as f:
+                    kind = np.dtype(f.dtypes[0]).kind
+                command = ['gdal_translate', '-of', 'GTiff',
+                           '-co', 'TILED=YES',
+                           '-co', f'BLOCKXSIZE={block_size}',
+                           '-co', f'BLOCKYSIZE={block_size}',
+                           '-co', f'COMPRESS={compress}',
+                           '-co', f"PREDICTOR={3 if kind == 'f' else 2}",
+                           '-co', 'COPY_SRC_OVERVIEWS=YES',
+                           '-co', 'BIGTIFF=IF_SAFER'] + config + [tiled, tmp]
+                run_command(command, record)
+        # only a complete file is ever visible in the store
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
     return dst
 
 
-def _get_common_idx(file_paths):
-    def _get_all_wavelengths(file_paths):
-        # returns a list of lists of all wavelengths in a file for a list of files
-        def _get_wavelengths(band_names):
-            bn = band_names.split(',')
-            try:
-                bn = [float(x.split(' ')[0], 0) for x in bn]
-            except ValueError:
-                bn = [float(x.split(' ')[1][4:-1], 0) for x in bn]
-            return np.array(bn)
-
-        wlens = []
-        for file in file_paths:
-            ar = rioxarray.open_rasterio(file, cache=False)
-            try:
-                # usually the wavelength dimension is available
-                wlens.append(ar.wavelength.values)
-            except AttributeError:
-                # sometimes this is missing so need to parse from band names
-                wlens.append(_get_wavelengths(ar.attrs['band_names']))
-        return wlens
+@functools.lru_cache()
+def _gdal_has_driver(name):
+    # whether the GDAL command line tools list the raster driver
+    formats = subprocess.run(['gdal_translate', '--formats'], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    return any(line.split()[:1] == [name]
+               for line in formats.stdout.splitlines())
+
+
+def _write_profile(profiler, dst, prometheus_dir=None):
+    # write the profile report to METADATA and optionally to prometheus
+    if not profiler.enabled:
+        return
+    profiler.finish()
+    profiler.write_report(os.path.join(dst, 'METADATA'))
+    if prometheus_dir is not None:
+        profiler.write_prometheus(prometheus_dir)
+    summary = profiler.summary()
+    logging.info('Throughput: {:.1f} MB/s, {:.1f} bands/min'.format(
+        summary['throughput_mb_per_s'], summary['bands_per_min']))
+    # timings calibrate the runtime estimates of `hsman ingest --plan`
+    from .plan import update_calibration
+    try:
+        update_calibration(profiler.records)
+    except OSError as e:
+        logging.debug(f'Could not update ingest calibration: {e}')
+
 
+def _get_common_idx(file_paths):
     # function generates the band args to retrieve only bands common to
     # whole dataset
     # rounds all the wavelength coords to nearest integer value
-    wlen_list = _get_all_wavelengths(file_paths)
+    wlen_list = [x.wavelengths for x in _get_file_metadata(file_paths)]
     rounded = [x.round(0) for x in wlen_list]
     common = functools.reduce(np.intersect1d, rounded)
     out = []
@@ -148,34 +657,15 @@ def _get_collect_time(file_paths):
         return datetime.datetime(year, month, day, 0, 0, 0)
 
     dtimes = []
-    for fpath in file_paths:
-        attrs = rioxarray.open_rasterio(fpath, cache=False).attrs
-        try:
-            d = attrs['acquisition_date'].split('-')
-        except KeyError:
-            logging.debug('acquisition_date not in metadata')
-            return _estimate_collect_time(fpath)
-
-        try:
-            t = attrs['acquisition_start_time'].split(':')
-        except KeyError:
-            logging.debug('acquisition_start_time not in metadata')
-            return _estimate_collect_time(fpath)
-        d = [int(x) for x in d]
-        t = [int(x) for x in t]
-        dtimes.append(datetime.datetime(*d, *t))
+    for record in _get_file_metadata(file_paths):
+        if record.acquisition_time is None:
+            return _estimate_collect_time(record.path)
+        dtimes.append(record.acquisition_time)
     return min(dtimes)
 
 
 def _get_other_metadata(file_paths):
     # return a metadata dictionary with flightline/georeferencing removed
-    def _retrieve_file_metadata(fpath):
-        with rasterio.open(fpath, 'r') as f:
-            tags = f.tags(ns='ENVI')
-        if len(tags) > 0:
-            return tags
-        raise RuntimeError('no ENVI tags found')
-
     remove = ['acquisition_date',
               'acquisition_start_time',
               'acquisition_time',
@@ -187,22 +677,310 @@ def _get_other_metadata(file_paths):
               'y_start']
 
     meta = {}
-    for f in file_paths:
-        try:
-            # return only the first successful retrieval
-            meta = _retrieve_file_metadata(f)
+    for record in _get_file_metadata(file_paths):
+        # return only the first successful retrieval
+        if len(record.tags) > 0:
+            meta = dict(record.tags)
             break
 
-        except RuntimeError:
-            continue
-
     # remove any removal keys
     [meta.pop(x, None) for x in remove]
     return meta
 
 
+class FileMetadata(NamedTuple):
+    """Metadata of a single input flightline, read once per ingest"""
+    path: str
+    wavelengths: np.ndarray
+    band_names: list
+    acquisition_time: datetime.datetime
+    crs: str
+    geotransform: tuple
+    interleave: str
+    samples: int
+    lines: int
+    bands: int
+    data_type: int
+    byte_order: int
+    header_offset: int
+    tags: dict
+
+
+# ENVI data type codes to numpy dtypes
+ENVI_DTYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2',
+               13: 'u4', 14: 'i8', 15: 'u8'}
+
+
+def _get_file_metadata(file_paths, max_workers=None):
+    # returns a FileMetadata record for each file path, reading the files in
+    # parallel. Records already in the list are passed through unchanged
+    if all([isinstance(x, FileMetadata) for x in file_paths]):
+        return list(file_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_read_file_metadata, file_paths))
+
+
+def _read_file_metadata(fpath):
+    # read from the ENVI header text where possible, otherwise use GDAL
+    if isinstance(fpath, FileMetadata):
+        return fpath
+    try:
+        return _read_envi_metadata(fpath)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        logging.debug(f'Reading {fpath} metadata with GDAL ({e})')
+        return _read_gdal_metadata(fpath)
+
+
+def _find_envi_header(fpath):
+    # ENVI headers are either file.hdr or file.img.hdr
+    for hdr in [os.path.splitext(fpath)[0] + '.hdr', fpath + '.hdr']:
+        if os.path.isfile(hdr):
+            return hdr
+    raise FileNotFoundError(f'No ENVI header found for {fpath}')
+
+
+def _parse_envi_header(hdr_path):
+    # returns a dictionary of raw header values. Keys have spaces replaced
+    # with underscores, as in the GDAL ENVI metadata domain
+    with open(hdr_path, 'r', errors='replace') as f:
+        lines = f.read().splitlines()
+    if len(lines) < 1 or not lines[0].strip().startswith('ENVI'):
+        raise ValueError(f'{hdr_path} is not an ENVI header')
+
+    header = {}
+    key = None
+    for line in lines[1:]:
+        if key is not None:
+            # continuation of a multi-line {...} value
+            header[key] += ' ' + line.strip()
+            if '}' in line:
+                key = None
+            continue
+        if '=' not in line:
+            continue
+        k, v = line.split('=', 1)
+        k = k.strip().replace(' ', '_')
+        v = v.strip()
+        header[k] = v
+        if v.startswith('{') and '}' not in v:
+            key = k
+    return header
+
+
+def _envi_list(value):
+    # splits a {a, b, c} header value into a list of strings
+    return [x.strip() for x in value.strip().strip('{}').split(',')
+            if len(x.strip()) > 0]
+
+
+def _envi_wavelengths(header):
+    try:
+        return np.array([float(x) for x in _envi_list(header['wavelength'])])
+    except KeyError:
+        # parse from band names, e.g. Band 001(414.58157)
+        bn = _envi_list(header['band_names'])
+        return np.array([float(re.search(r'\(([\d.]+)\)', x).group(1))
+                         for x in bn])
+
+
+def _envi_acquisition_time(header):
+    try:
+        d = [int(x) for x in header['acquisition_date'].split('-')]
+        t = [int(float(x)) for x in
+             header['acquisition_start_time'].split(':')]
+    except (KeyError, ValueError):
+        return None
+    return datetime.datetime(*d, *t)
+
+
+def _envi_geotransform(header):
+    # GDAL style geotransform from the map info field, including rotation
+    info = _envi_list(header['map_info'])
+    ref_x, ref_y, easting, northing, x_size, y_size = \
+        [float(x) for x in info[1:7]]
+    rotation = 0.0
+    for x in info:
+        if x.replace(' ', '').startswith('rotation='):
+            rotation = float(x.split('=')[1])
+    cos_a = math.cos(math.radians(rotation))
+    sin_a = math.sin(math.radians(rotation))
+    gt = [0, cos_a * x_size, sin_a * y_size,
+          0, sin_a * x_size, -cos_a * y_size]
+    gt[0] = easting - (ref_x - 1) * gt[1] - (ref_y - 1) * gt[2]
+    gt[3] = northing - (ref_x - 1) * gt[4] - (ref_y - 1) * gt[5]
+    return tuple(gt)
+
+
+def _envi_crs(header):
+    # returns 'epsg:XXXX' where possible, otherwise the WKT string
+    info = _envi_list(header['map_info'])
+    if 'coordinate_system_string' in header:
+        from rasterio.crs import CRS
+        wkt = header['coordinate_system_string'].strip()[1:-1]
+        epsg = CRS.from_wkt(wkt).to_epsg()
+        if epsg is not None:
+            return f'epsg:{epsg}'
+        return wkt
+    if info[0] == 'UTM' and info[9] == 'WGS-84':
+        zone = int(info[7])
+        if info[8].lower() == 'north':
+            return f'epsg:{32600 + zone}'
+        return f'epsg:{32700 + zone}'
+    raise ValueError('Could not determine CRS from ENVI header')
+
+
+def _read_envi_metadata(fpath):
+    header = _parse_envi_header(_find_envi_header(fpath))
+    try:
+        band_names = _envi_list(header['band_names'])
+    except KeyError:
+        band_names = []
+    # GDAL drops any entry containing '=' from the ENVI domain
+    tags = {k: v for k, v in header.items() if '=' not in v}
+    return FileMetadata(
+        path=fpath,
+        wavelengths=_envi_wavelengths(header),
+        band_names=band_names,
+        acquisition_time=_envi_acquisition_time(header),
+        crs=_envi_crs(header),
+        geotransform=_envi_geotransform(header),
+        interleave=header['interleave'].lower(),
+        samples=int(header['samples']),
+        lines=int(header['lines']),
+        bands=int(header['bands']),
+        data_type=int(header['data_type']),
+        byte_order=int(header.get('byte_order', 0)),
+        header_offset=int(header.get('header_offset', 0)),
+        tags=tags
+    )
+
+
+def _envi_memmap(record, mode='r'):
+    # memory maps an ENVI file in its storage order using its header
+    dtype = np.dtype(ENVI_DTYPES[record.data_type]).newbyteorder(
+        '>' if record.byte_order == 1 else '<')
+    shape = {'bsq': (record.bands, record.lines, record.samples),
+             'bil': (record.lines, record.bands, record.samples),
+             'bip': (record.lines, record.samples, record.bands)}
+    return np.memmap(record.path, dtype=dtype, mode=mode,
+                     offset=record.header_offset,
+                     shape=shape[record.interleave])
+
+
+def _deinterleave_envi(record, dst, bands=None, block_bytes=2 ** 26):
+    """Write a band sequential copy of a BIL or BIP ENVI file
+
+    The source is memory mapped and transposed a block of lines at a time,
+    so it is read once and memory use is bounded by `block_bytes`. The
+    header is copied with the interleave and header offset updated.
+
+    If `bands` is given, only those planes are transposed and written. The
+    copy keeps the band numbering of the source, the other planes are left
+    as holes of the sparse output file.
+
+    Parameters
+    ----------
+    record : FileMetadata
+        metadata of an ENVI file
+    dst : path-like
+        output directory (usually in scratch)
+    bands : array-like, optional
+        raster band numbers (from 1) to write, defaults to all bands
+    block_bytes : int, optional
+        approximate size of the blocks of lines transposed at once
+
+    Returns
+    -------
+    record : FileMetadata
+        metadata of the band sequential copy
+    """
+    # files of the same name from different directories get distinct copies
+    digest = hashlib.sha1(os.path.abspath(record.path).encode()).hexdigest()
+    name = os.path.basename(record.path)
+    new_path = os.path.join(dst, f'{digest[:8]}_{name}')
+    new_record = record._replace(path=new_path, interleave='bsq',
+                                 header_offset=0)
+    src = _envi_memmap(record)
+    out = _envi_memmap(new_record, mode='w+')
+    line_bytes = record.samples * record.bands * src.dtype.itemsize
+    block_lines = max(1, block_bytes // line_bytes)
+    idx = slice(None) if bands is None else np.unique(bands) - 1
+    for row in range(0, record.lines, block_lines):
+        block = src[row:row + block_lines]
+        if record.interleave == 'bil':
+            out[idx, row:row + block_lines] = block[:, idx].transpose(1, 0, 2)
+        else:
+            out[idx, row:row + block_lines] = \
+                block[:, :, idx].transpose(2, 0, 1)
+    out.flush()
+    del src, out
+
+    with open(_find_envi_header(record.path), 'r', errors='replace') as f:
+        header = f.read()
+    header = re.sub(r'(?im)^\s*interleave\s*=.*$', 'interleave = bsq', header)
+    header = re.sub(r'(?im)^\s*header offset\s*=.*$', 'header offset = 0',
+                    header)
+    with open(os.path.splitext(new_path)[0] + '.hdr', 'w') as f:
+        f.write(header)
+    return new_record
+
+
+def _read_gdal_metadata(fpath):
+    import rioxarray
+
+    def _get_wavelengths(band_names):
+        bn = band_names.split(',')
+        try:
+            bn = [float(x.split(' ')[0], 0) for x in bn]
+        except ValueError:
+            bn = [float(x.split(' ')[1][4:-1], 0) for x in bn]
+        return np.array(bn)
+
+    ar = rioxarray.open_rasterio(fpath, cache=False)
+    try:
+        # usually the wavelength dimension is available
+        wavelengths = ar.wavelength.values
+    except AttributeError:
+        # sometimes this is missing so need to parse from band names
+        wavelengths = _get_wavelengths(ar.attrs['band_names'])
+
+    with rasterio.open(fpath, 'r') as src:
+        tags = src.tags(ns='ENVI')
+        crs = f'epsg:{src.crs.to_epsg()}'
+        geotransform = src.transform.to_gdal()
+        interleave = src.interleaving.name.lower() \
+            if src.interleaving is not None else 'bsq'
+        band_names = list(src.descriptions)
+        samples, lines, bands = src.width, src.height, src.count
+        dtype = np.dtype(src.dtypes[0]).str[1:]
+
+    # equivalent ENVI code for dtype ('pixel' interleave is bip)
+    data_type = {v: k for k, v in ENVI_DTYPES.items()}.get(dtype, 0)
+    interleave = {'pixel': 'bip', 'line': 'bil', 'band': 'bsq'}.get(
+        interleave, interleave)
+
+    return FileMetadata(
+        path=fpath,
+        wavelengths=wavelengths,
+        band_names=band_names,
+        acquisition_time=_envi_acquisition_time(tags),
+        crs=crs,
+        geotransform=tuple(geotransform),
+        interleave=interleave,
+        samples=samples,
+        lines=lines,
+        bands=bands,
+        data_type=data_type,
+        byte_order=int(tags.get('byte_order', 0)),
+        header_offset=int(tags.get('header_offset', 0)),
+        tags=tags
+    )
+
+
 # function for setting up dir structure
-def _make_dataset_folder(name, dst=DATA_PATH):
+def _make_dataset_folder(name, dst=None):
+    if dst is None:
+        dst = get_data_path()
     new_name = name
     i = 1
     while os.path.exists(os.path.join(dst, new_name)):
@@ -216,9 +994,11 @@ def _make_dataset_folder(name, dst=DATA_PATH):
 
 
 # functions for generating new files
-def _unrotate_hsi(file_paths, dst, band='all'):
+def _unrotate_hsi(file_paths, dst, band='all', profiler=None):
     # returns a list of file paths of unrotated
     output_files = []
+    if profiler is None:
+        profiler = NullProfiler()
 
     # somnetimes it is necessary to specify the band number separately for each
     # file in the dataset
@@ -229,28 +1009,45 @@ def _unrotate_hsi(file_paths, dst, band='all'):
     else:
         band = [band] * len(file_paths)
 
-    for input_file, _band in zip(file_paths, band):
+    for record, _band in zip(_get_file_metadata(file_paths), band):
+        input_file = record.path
+        crs = record.crs
         fname = f'unrotated_{os.path.basename(input_file)}'
-        # Open the input file using rasterio
-        with rasterio.open(input_file) as src:
-            crs = f'epsg:{src.crs.to_epsg()}'
         # for now use gdal_translate to extract a single band, then
         fname_short, _ext = os.path.splitext(fname)
+        intermediate = []
         # skip the next step if all bands to be included
-        if _band != 'all':
+        if not (isinstance(_band, str) and _band == 'all'):
             command = ['gdal_translate']
 
             output_file1 = os.path.join(dst, '~' + fname_short + _ext)
-            # assume an integer band index (1...n)
-
+            # assume an integer band index (1...n), or an array of band
+            # indexes to be averaged into one band
+            _bands = [int(x) for x in np.atleast_1d(_band)]
+            for b in _bands:
+                command += ['-b', str(b)]
             command += [
-                    '-b', str(int(_band)),
                     input_file,
                     output_file1
                 ]
             logging.debug('generating unrotated file {}'.format(output_file1))
-            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            with profiler.stage('gdal_translate', band=_band,
+                                flightline=record.path) as rec:
+                run_command(command, rec)
+                rec['bytes_read'] = _band_read_bytes(record, len(_bands))
+                rec['bytes_written'] = file_size(output_file1)
             input_file = output_file1
+            intermediate.append(output_file1)
+            if len(_bands) > 1:
+                output_file2 = os.path.join(dst, '~binned_' + fname_short
+                                            + '.tif')
+                with profiler.stage('bin', band=_band,
+                                    flightline=record.path) as rec:
+                    _average_bands(output_file1, output_file2)
+                    rec['bytes_read'] = file_size(output_file1)
+                    rec['bytes_written'] = file_size(output_file2)
+                input_file = output_file2
+                intermediate.append(output_file2)
 
         output_file = os.path.join(dst, fname_short + _ext)
 
@@ -264,22 +1061,148 @@ def _unrotate_hsi(file_paths, dst, band='all'):
             ]
 
         # Run the command using subprocess
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with profiler.stage('gdalwarp', band=_band,
+                            flightline=record.path) as rec:
+            run_command(command, rec)
+            rec['bytes_read'] = file_size(input_file)
+            rec['bytes_written'] = file_size(output_file)
 
-        # Cleanup intermediate file
-        try:
-            os.remove(output_file1)
-        except UnboundLocalError:
-            pass
+        # Cleanup intermediate files
+        for _file in intermediate:
+            os.remove(_file)
 
         # Return the output file path
         output_files.append(output_file)
     return output_files
 
 
+def _band_read_bytes(record, n_bands=1):
+    # estimate of source bytes read to extract n bands. Every band
+    # extraction reads the whole file unless it is band sequential
+    size = file_size(record.path)
+    if record.interleave == 'bsq' and record.bands > 0:
+        return min(size, size // record.bands * n_bands)
+    return size
+
+
+def _select_bands(band_idxs, wavelengths, wavelength_range=None,
+                  exclude_ranges=None, bin_factor=1):
+    # applies the spectral subset/binning options of a recipe to the output
+    # of _get_common_idx. Returns band indexes of shape (files, bands), or
+    # (files, bands, bin_factor) when binning, the wavelength of each output
+    # band and the source wavelengths averaged into each output band
+    bin_factor = int(bin_factor)
+    if bin_factor < 1:
+        raise ValueError('bin_factor must be a positive integer')
+    keep = np.ones(len(wavelengths), dtype=bool)
+    if wavelength_range is not None:
+        lo, hi = wavelength_range
+        keep &= (wavelengths >= lo) & (wavelengths <= hi)
+    for lo, hi in exclude_ranges or []:
+        keep &= ~((wavelengths >= lo) & (wavelengths <= hi))
+
+    selected = np.flatnonzero(keep)
+    if bin_factor == 1:
+        groups = selected[:, None]
+    else:
+        # bin within runs of adjacent bands so no bin spans an excluded range
+        runs = np.split(selected, np.flatnonzero(np.diff(selected) > 1) + 1)
+        groups = [run[i:i + bin_factor] for run in runs
+                  for i in range(0, len(run) - bin_factor + 1, bin_factor)]
+        groups = np.array(groups, dtype=int).reshape(-1, bin_factor)
+        dropped = len(selected) - groups.size
+        if dropped > 0:
+            logging.info(f'{dropped} bands left over from binning dropped')
+    if len(groups) == 0:
+        raise ValueError('No bands left after spectral subsetting')
+    logging.info('{} of {} bands selected, binned by {}'.format(
+        groups.size, len(wavelengths), bin_factor))
+
+    source_wavelengths = wavelengths[groups]
+    if bin_factor == 1:
+        return band_idxs[:, groups[:, 0]], wavelengths[groups[:, 0]], \
+            source_wavelengths
+    return band_idxs[:, groups], source_wavelengths.mean(axis=1), \
+        source_wavelengths
+
+
+def _spectral_metadata(wavelength_range=None, exclude_ranges=None,
+                       bin_factor=1):
+    # records the spectral options of an ingest as netcdf attributes
+    meta = {'spectral_bin_factor': int(bin_factor)}
+    if wavelength_range is not None:
+        meta['spectral_wavelength_range'] = [float(x)
+                                             for x in wavelength_range]
+    if exclude_ranges:
+        # flattened [min1, max1, min2, max2, ...]
+        meta['spectral_exclude_ranges'] = [float(x) for r in exclude_ranges
+                                           for x in r]
+    return meta
+
+
+def _average_bands(src_fpath, dst_fpath, block_size=1024):
+    # averages all bands of a raster into a single band GeoTIFF, ignoring
+    # zero (nodata) values, one block of rows at a time
+    with rasterio.open(src_fpath) as src:
+        profile = src.profile
+        profile.update(driver='GTiff', count=1, nodata=0)
+        dtype = np.dtype(src.dtypes[0])
+        with rasterio.open(dst_fpath, 'w', **profile) as dst:
+            for row in range(0, src.height, block_size):
+                window = ((row, min(row + block_size, src.height)),
+                          (0, src.width))
+                data = src.read(window=window).astype('f8')
+                count = (data != 0).sum(axis=0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = np.where(count > 0,
+                                    data.sum(axis=0) / count, 0)
+                if dtype.kind in 'iu':
+                    mean = np.rint(mean)
+                dst.write(mean.astype(dtype), 1, window=window)
+    return dst_fpath
+
+
+def _variable_stats(variable, stats, block_rows=1024):
+    # updates stats from a 2D netCDF variable, a block of rows at a time.
+    # Returns the number of bytes read
+    variable.set_auto_maskandscale(False)
+    n_rows = variable.shape[0]
+    for row in range(0, n_rows, block_rows):
+        stats.update(variable[row:row + block_rows])
+    variable.set_auto_maskandscale(True)
+    return variable.size * variable.dtype.itemsize
+
+
+def _image_stats(fpath, block_bytes=2 ** 24):
+    # statistics of every band of an image, reading blocks of whole rows.
+    # Returns {band: stats dict}
+    with rasterio.open(fpath) as src:
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+        block_rows = max(1, block_bytes // (src.width * src.count * itemsize))
+        stats = [BandStats(nodata=src.nodata) for _ in range(src.count)]
+        for row in range(0, src.height, block_rows):
+            window = ((row, min(row + block_rows, src.height)),
+                      (0, src.width))
+            data = src.read(window=window)
+            for band_stats, band in zip(stats, data):
+                band_stats.update(band)
+    return {i + 1: x.to_dict() for i, x in enumerate(stats)}
+
+
 def _merge_band(file_paths, dst, band, meta, new_band_wavelength,
-                new_band_index=None):
+                new_band_index=None, profiler=None, mosaic=None,
+                stats=None):
     # generates a netcdf file for a band combinatio
+    # mosaic is None (gdal_merge, last file wins) or a dict of
+    # {'method': 'tiled', 'overlap': ..., 'max_memory_mb': ...}
+    # stats is a BandStats filled with the statistics of the band, which
+    # are also written to the band attributes
+    if profiler is None:
+        profiler = NullProfiler()
+    if stats is None:
+        stats = BandStats()
+    if mosaic is None:
+        mosaic = {'method': 'gdal_merge'}
 
     try:
         len(band)
@@ -298,23 +1221,40 @@ def _merge_band(file_paths, dst, band, meta, new_band_wavelength,
     with tempfile.TemporaryDirectory() as temp_dir:
         # rotate files and write to a temp array on disk
         logging.debug('generating unrotated files..')
-        unrotated_file_paths = _unrotate_hsi(file_paths, temp_dir, band)
+        unrotated_file_paths = _unrotate_hsi(file_paths, temp_dir, band,
+                                             profiler=profiler)
         logging.debug('Merging unrotated files into NetCDF..')
         # unrotated_file_paths = file_paths # for testing only
-        command = ['gdal_merge.py',
-                   '-init', '0',
-                   '-o', dst_fpath,
-                   '-of', 'netCDF',
-                   '-n', '0',
-                   ]
-        command += unrotated_file_paths
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        if mosaic.get('method', 'gdal_merge') == 'tiled':
+            with profiler.stage('mosaic', band=new_band_index) as rec:
+                _mosaic_band(unrotated_file_paths, dst_fpath,
+                             overlap=mosaic.get('overlap', 'last'),
+                             max_memory_mb=mosaic.get('max_memory_mb', 512),
+                             records=_get_file_metadata(file_paths),
+                             stats=stats)
+                rec['bytes_read'] = sum([file_size(x)
+                                         for x in unrotated_file_paths])
+                rec['bytes_written'] = file_size(dst_fpath)
+        else:
+            command = ['gdal_merge.py',
+                       '-init', '0',
+                       '-o', dst_fpath,
+                       '-of', 'netCDF',
+                       '-n', '0',
+                       ]
+            command += unrotated_file_paths
+            with profiler.stage('gdal_merge', band=new_band_index) as rec:
+                run_command(command, rec)
+                rec['bytes_read'] = sum([file_size(x)
+                                         for x in unrotated_file_paths])
+                rec['bytes_written'] = file_size(dst_fpath)
     # rename the band
     # Open the NetCDF4 dataset using a context handler
         logging.debug('NetCDF generated:')
         # logging.debug(print(rioxarray.open_rasterio(dst_fpath)))
     logging.debug('Updating variables...')
-    with Dataset(dst_fpath, 'r+') as dataset:
+    with profiler.stage('netcdf_attributes', band=new_band_index) as rec, \
+            Dataset(dst_fpath, 'r+') as dataset:
         # Rename the variable
         dataset.renameVariable('Band1', 'reflectance')
 
@@ -333,7 +1273,218 @@ def _merge_band(file_paths, dst, band, meta, new_band_wavelength,
         for k, v in meta.items():
             reflectance_var.setncattr(k, v)
 
+        # the tiled mosaic accumulates statistics as it writes.
+        # gdal_merge writes in a subprocess, so its output is read back
+        # once, from scratch before it is moved to the store
+        if stats.count + stats.nodata_count == 0:
+            rec['bytes_read'] = _variable_stats(reflectance_var, stats)
+        for k, v in stats_attrs(stats.to_dict()).items():
+            reflectance_var.setncattr(k, v)
+
         # Synchronize changes to the file
         dataset.sync()
+        rec['bytes_written'] = file_size(dst_fpath)
 
     return dst_fpath
+
+
+def _mosaic_band(input_paths, dst_fpath, overlap='last', max_memory_mb=512,
+                 records=None, stats=None):
+    """Mosaic single band rasters into a NetCDF file one tile at a time
+
+    The output grid follows gdal_merge.py (union of the inputs at the pixel
+    size of the first input, 0 is nodata) and the file has the same layout,
+    so it can be used in place of the gdal_merge output. Only the windows of
+    the inputs that intersect a tile are read and each tile is written
+    straight to the output, so peak memory depends on `max_memory_mb` rather
+    than the extent of the mission.
+
+    Parameters
+    ----------
+    input_paths : list
+        north-up single band rasters in the same CRS
+    dst_fpath : path-like
+        output NetCDF file
+    overlap : str, optional
+        rule for pixels covered by more than one input. One of 'first',
+        'last' (as gdal_merge.py), 'mean' or 'min-angle' (the input whose
+        pixel is closest to nadir, i.e. the centre of its swath)
+    max_memory_mb : int, optional
+        cap on the memory used by the tile buffers and the GDAL block cache
+    records : list, optional
+        FileMetadata of the original flightlines in the same order as
+        `input_paths`, required for 'min-angle'
+    stats : BandStats, optional
+        updated with each tile as it is written
+
+    Returns
+    -------
+    dst_fpath : str
+    """
+    if overlap not in MOSAIC_OVERLAPS:
+        raise ValueError(f'overlap must be one of {MOSAIC_OVERLAPS}')
+    if overlap == 'min-angle' and records is None:
+        raise ValueError('min-angle overlap requires the flightline records')
+
+    # a quarter of the budget goes to the GDAL block cache
+    cache_mb = max(16, max_memory_mb // 4)
+    with rasterio.Env(GDAL_CACHEMAX=cache_mb):
+        sources = [rasterio.open(x) for x in input_paths]
+        try:
+            transform, width, height = _mosaic_grid(sources)
+            dtype = np.dtype(sources[0].dtypes[0])
+            tile = _mosaic_tile_size(dtype, max_memory_mb - cache_mb)
+            logging.debug(f'Mosaicking {len(sources)} files into '
+                          f'{width}x{height} grid in {tile}px tiles')
+            with _create_mosaic_netcdf(dst_fpath, sources[0].crs, transform,
+                                       width, height, dtype) as dataset:
+                out = dataset.variables['Band1']
+                for row in range(0, height, tile):
+                    for col in range(0, width, tile):
+                        window = ((row, min(row + tile, height)),
+                                  (col, min(col + tile, width)))
+                        data = _mosaic_tile(sources, transform, window,
+                                            dtype, overlap, records)
+                        if stats is not None:
+                            stats.update(data)
+                        # rows are stored bottom-up like GDAL's netCDF driver
+                        out[height - window[0][1]:height - row,
+                            col:window[1][1]] = data[::-1]
+        finally:
+            for src in sources:
+                src.close()
+    return dst_fpath
+
+
+def _mosaic_grid(sources):
+    # output transform and size as computed by gdal_merge.py
+    ulx = min([x.bounds.left for x in sources])
+    uly = max([x.bounds.top for x in sources])
+    lrx = max([x.bounds.right for x in sources])
+    lry = min([x.bounds.bottom for x in sources])
+    psize_x, psize_y = sources[0].transform.a, sources[0].transform.e
+    width = int((lrx - ulx) / psize_x + 0.5)
+    height = int((lry - uly) / psize_y + 0.5)
+    transform = rasterio.Affine(psize_x, 0, ulx, 0, psize_y, uly)
+    return transform, width, height
+
+
+def _mosaic_tile_size(dtype, max_memory_mb):
+    # square tile edge (multiple of 256) whose buffers fit in the budget.
+    # per pixel: output and read buffers, float64 sum, count/score, mask
+    # and the float64 copy made by the band statistics
+    per_pixel = 2 * dtype.itemsize + 8 + 8 + 8 + 1
+    pixels = max(max_memory_mb, 1) * 2 ** 20 / per_pixel
+    return max(256, int(math.sqrt(pixels)) // 256 * 256)
+
+
+def _mosaic_placement(src, transform):
+    # (row_off, col_off, height, width) of a source in the output grid,
+    # rounded as in gdal_merge.py
+    col_off = int((src.bounds.left - transform.c) / transform.a + 0.1)
+    row_off = int((src.bounds.top - transform.f) / transform.e + 0.1)
+    width = int((src.bounds.right - transform.c) / transform.a + 0.5) \
+        - col_off
+    height = int((src.bounds.bottom - transform.f) / transform.e + 0.5) \
+        - row_off
+    return row_off, col_off, height, width
+
+
+def _mosaic_tile(sources, transform, window, dtype, overlap, records=None):
+    # reads the intersecting part of every source and combines one tile
+    (r0, r1), (c0, c1) = window
+    shape = (r1 - r0, c1 - c0)
+    out = np.zeros(shape, dtype)
+    if overlap == 'mean':
+        total = np.zeros(shape, 'f8')
+        count = np.zeros(shape, 'u4')
+    elif overlap == 'min-angle':
+        best = np.full(shape, np.inf, 'f8')
+
+    for i, src in enumerate(sources):
+        row_off, col_off, height, width = _mosaic_placement(src, transform)
+        # intersection with the tile in output pixels
+        ir0, ir1 = max(r0, row_off), min(r1, row_off + height)
+        ic0, ic1 = max(c0, col_off), min(c1, col_off + width)
+        if ir0 >= ir1 or ic0 >= ic1:
+            continue
+        # matching source window, scaled if the pixel sizes differ
+        sy, sx = src.height / height, src.width / width
+        src_window = rasterio.windows.Window(
+            (ic0 - col_off) * sx, (ir0 - row_off) * sy,
+            (ic1 - ic0) * sx, (ir1 - ir0) * sy)
+        data = src.read(1, window=src_window,
+                        out_shape=(ir1 - ir0, ic1 - ic0),
+                        resampling=rasterio.enums.Resampling.nearest)
+        valid = data != 0
+        tile = (slice(ir0 - r0, ir1 - r0), slice(ic0 - c0, ic1 - c0))
+        if overlap == 'last':
+            out[tile][valid] = data[valid]
+        elif overlap == 'first':
+            valid &= out[tile] == 0
+            out[tile][valid] = data[valid]
+        elif overlap == 'mean':
+            total[tile][valid] += data[valid]
+            count[tile][valid] += 1
+        else:
+            score = _nadir_distance(records[i], transform, ir0, ir1, ic0,
+                                    ic1)
+            valid &= score < best[tile]
+            best[tile][valid] = score[valid]
+            out[tile][valid] = data[valid]
+
+    if overlap == 'mean':
+        filled = count > 0
+        mean = total[filled] / count[filled]
+        if dtype.kind in 'iu':
+            mean = np.rint(mean)
+        out[filled] = mean.astype(dtype)
+    return out
+
+
+def _nadir_distance(record, transform, r0, r1, c0, c1):
+    # distance in pixels from the centre of the flightline swath for the
+    # centres of a block of output pixels, using the original (rotated)
+    # geotransform of the flightline
+    rows, cols = np.mgrid[r0:r1, c0:c1] + 0.5
+    x = transform.c + cols * transform.a
+    y = transform.f + rows * transform.e
+    gt = record.geotransform
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    sample = (gt[5] * (x - gt[0]) - gt[2] * (y - gt[3])) / det
+    return np.abs(sample - record.samples / 2)
+
+
+def _create_mosaic_netcdf(dst_fpath, crs, transform, width, height, dtype):
+    # empty NetCDF with the variables and attributes GDAL's netCDF driver
+    # writes, so that it is interchangeable with the gdal_merge.py output
+    import pyproj
+    dataset = Dataset(dst_fpath, 'w', format='NETCDF4')
+    dataset.setncattr('Conventions', 'CF-1.5')
+    dataset.setncattr('GDAL_AREA_OR_POINT', 'Area')
+    dataset.createDimension('x', width)
+    dataset.createDimension('y', height)
+
+    wkt = crs.to_wkt()
+    cf = pyproj.CRS.from_wkt(wkt).to_cf()
+    grid_mapping = cf.get('grid_mapping_name', 'crs')
+    crs_var = dataset.createVariable(grid_mapping, 'S1')
+    for k, v in cf.items():
+        crs_var.setncattr(k, v)
+    crs_var.setncattr('spatial_ref', wkt)
+    crs_var.setncattr('GeoTransform', ' '.join(
+        [repr(x) for x in transform.to_gdal()]))
+
+    x = dataset.createVariable('x', 'f8', ('x',))
+    x.setncattr('standard_name', 'projection_x_coordinate')
+    x.setncattr('long_name', 'x coordinate of projection')
+    x[:] = transform.c + (np.arange(width) + 0.5) * transform.a
+    y = dataset.createVariable('y', 'f8', ('y',))
+    y.setncattr('standard_name', 'projection_y_coordinate')
+    y.setncattr('long_name', 'y coordinate of projection')
+    y[:] = (transform.f + (np.arange(height) + 0.5) * transform.e)[::-1]
+
+    band = dataset.createVariable('Band1', dtype, ('y', 'x'), fill_value=0)
+    band.setncattr('long_name', 'GDAL Band Number 1')
+    band.setncattr('grid_mapping', grid_mapping)
+    return dataset
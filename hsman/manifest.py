@@ -0,0 +1,255 @@
+"""Submodule for dataset checksum manifests and store verification
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import get_datasets
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_ALGORITHM = 'sha256'
+# large reads let hashlib release the GIL, so threads hash in parallel
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class Manifest:
+    """Checksums, sizes and mtimes of the files in one dataset
+
+    Parameters
+    ----------
+    dataset_path : path-like
+        path of the dataset folder in the store
+    algorithm : str, optional
+        any hashlib algorithm name
+    """
+    def __init__(self, dataset_path, algorithm=DEFAULT_ALGORITHM):
+        self.dataset_path = dataset_path
+        self.algorithm = algorithm
+        self.files = {}
+
+    @property
+    def path(self):
+        return os.path.join(self.dataset_path, 'METADATA', MANIFEST_NAME)
+
+    def new_hash(self):
+        """Returns an empty hash object for this manifest's algorithm"""
+        return hashlib.new(self.algorithm)
+
+    def add(self, fpath, digest):
+        """Record the checksum of a file in the dataset
+
+        Parameters
+        ----------
+        fpath : path-like
+            path of the file in the store
+        digest : str
+            hex digest of the file contents
+        """
+        stat = os.stat(fpath)
+        self.files[self._key(fpath)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'checksum': digest,
+            'verified': _now()
+        }
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'algorithm': self.algorithm, 'files': self.files}, f,
+                      indent=2)
+        os.replace(self.path + '.tmp', self.path)
+        return self.path
+
+    @classmethod
+    def load(cls, dataset_path):
+        """Read the manifest of a dataset
+
+        Raises
+        ------
+        FileNotFoundError
+            if the dataset has no manifest
+        """
+        manifest = cls(dataset_path)
+        with open(manifest.path, 'r') as f:
+            content = json.load(f)
+        manifest.algorithm = content['algorithm']
+        manifest.files = content['files']
+        return manifest
+
+    def _key(self, fpath):
+        return os.path.relpath(fpath, self.dataset_path)
+
+
+def hash_file(fpath, hasher=None, algorithm=DEFAULT_ALGORITHM):
+    """Hash a file in large chunks
+
+    Parameters
+    ----------
+    fpath : path-like
+        file to hash
+    hasher : hashlib object, optional
+        hash to update, by default a new one is created
+    algorithm : str, optional
+        hashlib algorithm used when no hasher is given
+
+    Returns
+    -------
+    digest : str
+        hex digest
+    """
+    if hasher is None:
+        hasher = hashlib.new(algorithm)
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def copy_and_hash(src, dst, hasher):
+    """Copy a file, updating hasher with the data as it is streamed
+
+    Returns
+    -------
+    dst : str
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            fdst.write(chunk)
+    return dst
+
+
+def create_manifest(dataset_path, algorithm=DEFAULT_ALGORITHM,
+                    max_workers=4):
+    """Hash every file in the DATA folder of an existing dataset and save a
+    manifest
+
+    Returns
+    -------
+    manifest : Manifest
+    """
+    manifest = Manifest(dataset_path, algorithm)
+    data_path = os.path.join(dataset_path, 'DATA')
+    files = [os.path.join(data_path, x) for x in sorted(os.listdir(data_path))
+             if not x.startswith('.')]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        digests = pool.map(lambda x: hash_file(x, algorithm=algorithm), files)
+        for fpath, digest in zip(files, digests):
+            manifest.add(fpath, digest)
+    manifest.save()
+    return manifest
+
+
+def verify_datasets(names=None, full=False, max_workers=4,
+                    create_missing=False):
+    """Check the files of datasets in the store against their manifests
+
+    Files whose size and mtime match the manifest are skipped unless `full`
+    is set. All files of all datasets are hashed in one thread pool.
+
+    Parameters
+    ----------
+    names : list, optional
+        dataset names, by default all datasets in the store
+    full : bool, optional
+        re-hash every file
+    max_workers : int, optional
+        number of files read concurrently
+    create_missing : bool, optional
+        create manifests for datasets that have none
+
+    Returns
+    -------
+    results : dict
+        dataset name to a dict of file to status. Status is one of 'ok',
+        'skipped', 'changed', 'mismatch', 'missing' or 'no manifest'
+    """
+    datasets = get_datasets()
+    if names is None:
+        names = sorted(datasets)
+    results = {}
+    manifests = {}
+    for name in names:
+        try:
+            dataset_path = datasets[name]
+        except KeyError:
+            raise ValueError(f'dataset {name} not found')
+        try:
+            manifests[name] = Manifest.load(dataset_path)
+        except FileNotFoundError:
+            if create_missing:
+                logging.info(f'Creating manifest for {name}')
+                create_manifest(dataset_path, max_workers=max_workers)
+                results[name] = {'': 'created'}
+            else:
+                results[name] = {'': 'no manifest'}
+
+    tasks = []
+    for name, manifest in manifests.items():
+        results[name] = {}
+        for key, entry in manifest.files.items():
+            fpath = os.path.join(manifest.dataset_path, key)
+            status = _quick_check(fpath, entry)
+            if status == 'skipped' and full:
+                status = None
+            if status is None:
+                tasks.append((name, key, fpath))
+            else:
+                results[name][key] = status
+
+    def _check(task):
+        name, key, fpath = task
+        manifest = manifests[name]
+        try:
+            mtime_ns = os.stat(fpath).st_mtime_ns
+            digest = hash_file(fpath, algorithm=manifest.algorithm)
+        except FileNotFoundError:
+            # removed since the quick check
+            return 'missing'
+        if digest == manifest.files[key]['checksum']:
+            # e.g. touched or copied with a new mtime, so the next quick
+            # check can skip it
+            manifest.files[key]['mtime_ns'] = mtime_ns
+            manifest.files[key]['verified'] = _now()
+            return 'ok'
+        return 'mismatch'
+
+    updated = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for (name, key, _), status in zip(tasks, pool.map(_check, tasks)):
+            results[name][key] = status
+            if status == 'ok':
+                updated.add(name)
+            elif status == 'mismatch':
+                logging.error(f'Checksum mismatch: {name}/{key}')
+
+    # record verification times and the mtimes of files that still match
+    for name in sorted(updated):
+        manifest = manifests[name]
+        try:
+            manifest.save()
+        except OSError:
+            logging.debug(f'Could not update manifest of {name}')
+    return results
+
+
+def _quick_check(fpath, entry):
+    # returns a status from size and mtime alone, or None if the file needs
+    # hashing
+    try:
+        stat = os.stat(fpath)
+    except FileNotFoundError:
+        return 'missing'
+    if stat.st_size != entry['size']:
+        return 'changed'
+    if stat.st_mtime_ns != entry['mtime_ns']:
+        return None
+    return 'skipped'
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
@@ -0,0 +1,343 @@
+"""Submodule for ingest instrumentation and performance reports
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# seconds between samples of the resident set size during a stage
+RSS_INTERVAL = 0.05
+
+
+class IngestProfiler:
+    """Records wall time, CPU time, bytes read/written and peak memory for
+    each stage of an ingest.
+
+    Stages are recorded with the `stage` context manager. The yielded record
+    is a dictionary, and the caller may add `bytes_read` and `bytes_written`
+    to it before the stage exits. CPU time includes any waited subprocesses
+    (e.g. the GDAL command line tools). `peak_rss` is the largest resident
+    set size of this process sampled during the stage, and
+    `child_peak_rss` the largest peak of the subprocesses run with
+    `run_command` in the stage (0 where they cannot be sampled). The process lifetime peak is reported once
+    per ingest.
+
+    Parameters
+    ----------
+    dataset_name : str
+        name of the dataset being ingested
+    """
+    enabled = True
+
+    def __init__(self, dataset_name):
+        self.dataset_name = dataset_name
+        self.records = []
+        self.n_bands = 0
+        self.input_bytes = 0
+        self._start_time = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._end = None
+
+    @contextlib.contextmanager
+    def stage(self, name, band=None, flightline=None):
+        record = {'stage': name,
+                  'band': _to_builtin(band),
+                  'flightline': flightline,
+                  'bytes_read': 0,
+                  'bytes_written': 0}
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        record['child_peak_rss'] = 0
+        sampler = _RSSSampler()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = _cpu_time() - cpu
+            record['peak_rss'] = sampler.stop()
+            self.records.append(record)
+
+    def finish(self):
+        """Mark the end of the ingest"""
+        self._end = time.perf_counter()
+
+    def summary(self):
+        """Returns per-stage totals and overall throughput
+
+        Returns
+        -------
+        summary : dict
+        """
+        end = self._end if self._end is not None else time.perf_counter()
+        wall = end - self._start
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {'count': 0,
+                                               'wall_time': 0.0,
+                                               'cpu_time': 0.0,
+                                               'bytes_read': 0,
+                                               'bytes_written': 0,
+                                               'peak_rss': 0,
+                                               'child_peak_rss': 0})
+            s['count'] += 1
+            s['wall_time'] += r['wall_time']
+            s['cpu_time'] += r['cpu_time']
+            s['bytes_read'] += r['bytes_read']
+            s['bytes_written'] += r['bytes_written']
+            s['peak_rss'] = max(s['peak_rss'], r['peak_rss'])
+            s['child_peak_rss'] = max(s['child_peak_rss'],
+                                      r['child_peak_rss'])
+        return {
+            'dataset': self.dataset_name,
+            'start_time': self._start_time.isoformat(),
+            'wall_time': wall,
+            'n_bands': self.n_bands,
+            'input_bytes': self.input_bytes,
+            'throughput_mb_per_s': _safe_div(self.input_bytes / 1e6, wall),
+            'bands_per_min': _safe_div(self.n_bands, wall / 60),
+            'peak_rss': _peak_rss(),
+            'stages': stages
+        }
+
+    def write_report(self, dst):
+        """Write the full JSON report to a directory
+
+        Parameters
+        ----------
+        dst : path-like
+            directory (usually the dataset METADATA folder)
+
+        Returns
+        -------
+        path : str
+            path of the report
+        """
+        report = self.summary()
+        report['records'] = self.records
+        fpath = os.path.join(dst, 'ingest_profile.json')
+        with open(fpath, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f'Ingest profile written to {fpath}')
+        return fpath
+
+    def write_prometheus(self, dst):
+        """Write the summary in the Prometheus textfile collector format
+
+        Parameters
+        ----------
+        dst : path-like
+            textfile collector directory
+
+        Returns
+        -------
+        path : str
+            path of the .prom file
+        """
+        summary = self.summary()
+        label = 'dataset="{}"'.format(_escape(self.dataset_name))
+        lines = []
+
+        def metric(name, help, mtype, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {mtype}')
+            for labels, value in samples:
+                lines.append(f'{name}{{{labels}}} {value}')
+
+        stage_metrics = [
+            ('wall_time', 'seconds_total', 'Wall time spent in ingest stage',
+             'counter'),
+            ('cpu_time', 'cpu_seconds_total', 'CPU time spent in ingest stage',
+             'counter'),
+            ('bytes_read', 'read_bytes_total', 'Bytes read by ingest stage',
+             'counter'),
+            ('bytes_written', 'written_bytes_total',
+             'Bytes written by ingest stage', 'counter'),
+            ('peak_rss', 'peak_rss_bytes',
+             'Peak resident set size of the ingest process in stage',
+             'gauge'),
+            ('child_peak_rss', 'child_peak_rss_bytes',
+             'Peak resident set size of subprocesses of stage', 'gauge')
+        ]
+        for key, suffix, help, mtype in stage_metrics:
+            samples = [(label + ',stage="{}"'.format(_escape(k)), v[key])
+                       for k, v in summary['stages'].items()]
+            metric(f'hsman_ingest_stage_{suffix}', help, mtype, samples)
+
+        metric('hsman_ingest_duration_seconds', 'Total ingest wall time',
+               'gauge', [(label, summary['wall_time'])])
+        metric('hsman_ingest_peak_rss_bytes', 'Peak resident set size',
+               'gauge', [(label, summary['peak_rss'])])
+        metric('hsman_ingest_throughput_mb_per_second',
+               'Input megabytes ingested per second',
+               'gauge', [(label, summary['throughput_mb_per_s'])])
+        metric('hsman_ingest_bands_per_minute', 'Bands ingested per minute',
+               'gauge', [(label, summary['bands_per_min'])])
+
+        os.makedirs(dst, exist_ok=True)
+        fpath = os.path.join(dst, f'hsman_ingest_{self.dataset_name}.prom')
+        # the collector may read at any time, so write then rename
+        with open(fpath + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(fpath + '.tmp', fpath)
+        return fpath
+
+
+class NullProfiler:
+    """Profiler with the same interface as IngestProfiler that records
+    nothing"""
+    enabled = False
+    n_bands = 0
+    input_bytes = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, band=None, flightline=None):
+        yield {}
+
+    def finish(self):
+        pass
+
+
+def file_size(fpath):
+    """Returns the size of a file in bytes, or 0 if it cannot be read"""
+    try:
+        return os.path.getsize(fpath)
+    except (OSError, TypeError):
+        return 0
+
+
+def run_command(command, record=None, stdout=subprocess.DEVNULL):
+    """Run a command like `subprocess.run(check=True)`, recording its peak
+    resident set size
+
+    The peak is the high-water mark of the command's own memory, sampled
+    every RSS_INTERVAL seconds while it runs (on linux). ru_maxrss of a
+    child cannot be used, as it starts from the RSS of this process when the
+    child is spawned.
+
+    Parameters
+    ----------
+    command : list
+        program and arguments
+    record : dict, optional
+        stage record (see `IngestProfiler.stage`). Its `child_peak_rss` is
+        raised to the peak of the command
+    stdout : optional
+        as in `subprocess.run`, but not a pipe
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        if the command exits with a non-zero status
+    """
+    peak = 0
+    with subprocess.Popen(command, stdout=stdout) as process:
+        while True:
+            peak = max(peak, _child_hwm(process.pid))
+            try:
+                process.wait(RSS_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+    if record is not None:
+        record['child_peak_rss'] = max(record.get('child_peak_rss', 0), peak)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def _child_hwm(pid):
+    # peak resident set size of a running process in bytes, 0 if unknown
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class _RSSSampler:
+    # samples the resident set size of this process in a thread until
+    # stopped, so that peaks within a stage are seen even when they are
+    # below an earlier peak of the process
+    def __init__(self, interval=None):
+        self.peak = _current_rss()
+        self._interval = RSS_INTERVAL if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, _current_rss())
+
+    def stop(self):
+        # returns the peak in bytes, 0 where the RSS cannot be read
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _current_rss())
+        return self.peak
+
+
+def _current_rss():
+    # current resident set size in bytes, 0 if unknown (non linux)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _cpu_time():
+    if resource is None:
+        return time.process_time()
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss():
+    # returns the peak resident set size in bytes
+    if resource is None:
+        return 0
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on mac, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def _to_builtin(x):
+    # numpy scalars and arrays to json serialisable types
+    try:
+        return x.tolist()
+    except AttributeError:
+        return x
+
+
+def _safe_div(a, b):
+    if b == 0:
+        return 0.0
+    return a / b
+
+
+def _escape(x):
+    return str(x).replace('\\', '\\\\').replace('"', '\\"')
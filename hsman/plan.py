@@ -0,0 +1,356 @@
+"""Submodule for planning ingests: sizes, scratch space and runtime estimates
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+
+from . import scrape
+from .config import USER_PATH, get_config, get_data_path, get_scratch_path
+from .metrics import file_size
+
+CALIBRATION_NAME = 'ingest_calibration.json'
+# weight of the newest run in the calibrated rates
+CALIBRATION_ALPHA = 0.3
+# uncalibrated throughput of each stage (MB/s), or seconds per call for
+# stages that move no data
+DEFAULT_MB_PER_S = {'deinterleave': 200, 'gdal_translate': 150, 'bin': 200,
+                    'gdalwarp': 40, 'gdal_merge': 80, 'mosaic': 80,
+                    'netcdf_attributes': 300, 'transfer': 300,
+                    'checksum': 500, 'cog_convert': 40, 'band_stats': 300,
+                    'compress': 60}
+DEFAULT_SECONDS_PER_CALL = {'metadata': 0.05, 'transfer': 0.01}
+
+
+def plan_ingest(directory, config=None):
+    """Plan the ingest of a directory without reading any pixel data
+
+    Uses the same file search as `hsman ingest` and reads only the file
+    headers.
+
+    Parameters
+    ----------
+    directory : path-like
+        directory to search for datasets
+    config : dict, optional
+        hsman config, by default the user config
+
+    Returns
+    -------
+    plan : list
+        one dictionary per recipe and mission with the number of files,
+        output bands, output grid, input bytes, peak scratch bytes, store
+        bytes, peak merge memory and estimated seconds
+    """
+    if config is None:
+        config = get_config()
+    calibration = load_calibration()
+    matches = scrape.find_all_dataset_files(directory, config)
+    plan = []
+    for recipe_name, recipe in config['raster_dataset_recipes'].items():
+        missions = matches.get(recipe_name, {}).get('data_path', {})
+        for mission_name, data_files in missions.items():
+            dataset = scrape.generate_coverage_id(mission_name,
+                                                  recipe['name'])
+            if recipe['ingest_type'] == 'hsi':
+                row = _plan_hsi(data_files, recipe)
+            elif recipe['ingest_type'] == 'image':
+                row = _plan_image(data_files, recipe)
+            else:
+                continue
+            row.update({'recipe': recipe_name, 'mission': mission_name,
+                        'dataset': dataset, 'n_files': len(data_files)})
+            row['seconds'] = estimate_seconds(row.pop('stages'), calibration)
+            plan.append(row)
+    return plan
+
+
+def format_plan(plan):
+    """Returns the plan as a text table with totals"""
+    header = '{:<40} {:>5} {:>6} {:>13} {:>10} {:>10} {:>10} {:>10}'
+    lines = [header.format('dataset', 'files', 'bands', 'grid', 'input',
+                           'scratch', 'store', 'time')]
+    for row in plan:
+        grid = '{}x{}'.format(*row['grid'])
+        lines.append(header.format(
+            row['dataset'], row['n_files'], row['n_bands'], grid,
+            _human_bytes(row['input_bytes']),
+            _human_bytes(row['scratch_bytes']),
+            _human_bytes(row['store_bytes']),
+            _human_seconds(row['seconds'])))
+    lines.append(header.format(
+        'total', sum([x['n_files'] for x in plan]),
+        sum([x['n_bands'] for x in plan]), '',
+        _human_bytes(sum([x['input_bytes'] for x in plan])),
+        _human_bytes(max([x['scratch_bytes'] for x in plan] + [0])),
+        _human_bytes(sum([x['store_bytes'] for x in plan])),
+        _human_seconds(sum([x['seconds'] for x in plan]))))
+    return '\n'.join(lines)
+
+
+def estimate_seconds(stages, calibration=None):
+    """Estimated runtime of a list of stages
+
+    Parameters
+    ----------
+    stages : list
+        (stage name, number of calls, bytes) tuples
+    calibration : dict, optional
+        output of `load_calibration`
+
+    Returns
+    -------
+    seconds : float
+    """
+    if calibration is None:
+        calibration = load_calibration()
+    rates = calibration.get('stages', {})
+    total = 0.0
+    for name, calls, nbytes in stages:
+        rate = rates.get(name, {})
+        if nbytes > 0:
+            per_byte = rate.get('seconds_per_byte')
+            if per_byte is None:
+                per_byte = 1 / (DEFAULT_MB_PER_S.get(name, 100) * 1e6)
+            total += nbytes * per_byte
+        else:
+            per_call = rate.get('seconds_per_call',
+                                DEFAULT_SECONDS_PER_CALL.get(name, 0.0))
+            total += calls * per_call
+    return total
+
+
+def calibration_path():
+    # the calibration is per user/node, as throughput depends on hardware
+    return get_config().get('calibration_path',
+                            os.path.join(USER_PATH, CALIBRATION_NAME))
+
+
+def load_calibration(path=None):
+    """Read the calibrated stage rates, or an empty calibration"""
+    if path is None:
+        path = calibration_path()
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'runs': 0, 'stages': {}, 'output_ratio': {}}
+
+
+def update_calibration(records, path=None):
+    """Update the calibrated stage rates with the records of a profiled
+    ingest (see `metrics.IngestProfiler`)
+
+    Each stage has seconds per byte, from calls that read or wrote data,
+    and seconds per call, from calls that did not. Rates are exponentially
+    weighted towards the newest run.
+
+    Returns
+    -------
+    calibration : dict
+    """
+    if path is None:
+        path = calibration_path()
+    calibration = load_calibration(path)
+    totals = {}
+    for r in records:
+        nbytes = max(r.get('bytes_read', 0), r.get('bytes_written', 0))
+        t = totals.setdefault(r['stage'], [0.0, 0, 0.0, 0])
+        if nbytes > 0:
+            t[0] += r['wall_time']
+            t[1] += nbytes
+        else:
+            t[2] += r['wall_time']
+            t[3] += 1
+        ratio_name = {'cog_convert': 'image_cog',
+                      'compress': 'hsi_pca'}.get(r['stage'])
+        if ratio_name is not None and r.get('bytes_read', 0) > 0:
+            _ewma(calibration.setdefault('output_ratio', {}), ratio_name,
+                  r['bytes_written'] / r['bytes_read'])
+
+    stages = calibration.setdefault('stages', {})
+    for name, (seconds, nbytes, call_seconds, calls) in totals.items():
+        rate = stages.setdefault(name, {})
+        if nbytes > 0:
+            _ewma(rate, 'seconds_per_byte', seconds / nbytes)
+        if calls > 0:
+            _ewma(rate, 'seconds_per_call', call_seconds / calls)
+    calibration['runs'] = calibration.get('runs', 0) + 1
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return calibration
+
+
+def _plan_hsi(file_paths, recipe):
+    # sizes and stage byte counts of an HSI ingest from the file headers
+    from .ingest import _get_file_metadata, _get_common_idx, _select_bands, \
+        _transfer_copies, ENVI_DTYPES, HSI_TRANSFER_MODE
+
+    records = _get_file_metadata(file_paths)
+    band_idxs, wavelengths = _get_common_idx(records)
+    bin_factor = int(recipe.get('bin_factor', 1))
+    band_idxs, wavelengths, _ = _select_bands(
+        band_idxs, wavelengths, recipe.get('wavelength_range'),
+        recipe.get('exclude_ranges'), bin_factor)
+    n_bands = len(wavelengths)
+
+    itemsize = np.dtype(ENVI_DTYPES.get(records[0].data_type, 'u2')).itemsize
+    width, height, warped = _hsi_grid(records)
+    band_bytes = width * height * itemsize
+    input_bytes = sum([file_size(x.path) for x in records])
+
+    # bytes read per band by each stage, as recorded by the profiler
+    deinterleave_bytes = 0
+    deinterleave_scratch = 0
+    translate = 0
+    for x, idxs in zip(records, band_idxs):
+        size = file_size(x.path)
+        sequential = x.interleave == 'bsq'
+        if not sequential and recipe.get('deinterleave', True) \
+                and n_bands > 1 and _has_envi_header(x.path):
+            deinterleave_bytes += size
+            # only the selected bands are written to the copy
+            deinterleave_scratch += size * len(np.unique(idxs)) \
+                // max(x.bands, 1)
+            sequential = True
+        if sequential:
+            translate += min(size, size // max(x.bands, 1) * bin_factor)
+        else:
+            translate += size
+    extracted = [x.samples * x.lines * itemsize for x in records]
+    warped_bytes = [w * h * itemsize for w, h in warped]
+    mosaic = recipe.get('mosaic') or {}
+    tiled = mosaic.get('method', 'gdal_merge') == 'tiled'
+    compressed = (recipe.get('store') or {}).get('mode') == 'pca'
+    store_bytes = n_bands * band_bytes
+    if compressed:
+        # uncompressed until calibrated from a previous pca ingest
+        store_bytes = int(store_bytes * load_calibration().get(
+            'output_ratio', {}).get('hsi_pca', 1.0))
+
+    stages = [('metadata', 1, 0),
+              ('deinterleave', len(records), deinterleave_bytes),
+              ('gdal_translate', n_bands * len(records), n_bands * translate),
+              ('gdalwarp', n_bands * len(records),
+               n_bands * sum(extracted)),
+              ('mosaic' if tiled else 'gdal_merge', n_bands,
+               n_bands * sum(warped_bytes)),
+              ('netcdf_attributes', n_bands, n_bands * band_bytes),
+              ('transfer', 1 if compressed else n_bands,
+               store_bytes if _transfer_copies(
+                   get_scratch_path(), get_data_path(),
+                   recipe.get('transfer_mode', HSI_TRANSFER_MODE)) else 0),
+              ('checksum', 1 if compressed else n_bands, store_bytes)]
+    if bin_factor > 1:
+        stages.append(('bin', n_bands * len(records),
+                       n_bands * sum(extracted) * bin_factor))
+    if compressed:
+        stages.append(('compress', 1, n_bands * band_bytes))
+
+    # deinterleaved copies live for the whole ingest, the rest per band
+    # unless all bands are kept for compression
+    scratch = deinterleave_scratch + max(extracted) * (bin_factor + 1) \
+        + sum(warped_bytes) + band_bytes
+    if compressed:
+        scratch += (n_bands - 1) * band_bytes + store_bytes
+    if tiled:
+        merge_memory = mosaic.get('max_memory_mb', 512) * 2 ** 20
+    else:
+        # gdal_merge.py holds the whole band
+        merge_memory = band_bytes
+    return {'ingest_type': 'hsi', 'n_bands': n_bands,
+            'grid': (width, height), 'input_bytes': input_bytes,
+            'scratch_bytes': scratch, 'store_bytes': store_bytes,
+            'merge_memory_bytes': merge_memory, 'stages': stages}
+
+
+def _hsi_grid(records):
+    # estimated mosaic size and unrotated size of each flightline. The
+    # unrotated pixel size is chosen as gdalwarp does, keeping the length of
+    # the pixel diagonal, and the mosaic uses the first pixel size like
+    # gdal_merge.py
+    boxes = []
+    warped = []
+    resolution = None
+    for x in records:
+        gt = x.geotransform
+        cols = np.array([0, x.samples, 0, x.samples])
+        rows = np.array([0, 0, x.lines, x.lines])
+        xs = gt[0] + cols * gt[1] + rows * gt[2]
+        ys = gt[3] + cols * gt[4] + rows * gt[5]
+        w, h = xs.max() - xs.min(), ys.max() - ys.min()
+        res = math.hypot(gt[1] + gt[2], gt[4] + gt[5]) / math.sqrt(2)
+        if resolution is None:
+            resolution = res
+        boxes.append((xs.min(), ys.min(), xs.max(), ys.max()))
+        warped.append((int(w / res + 0.5), int(h / res + 0.5)))
+    left = min([b[0] for b in boxes])
+    bottom = min([b[1] for b in boxes])
+    right = max([b[2] for b in boxes])
+    top = max([b[3] for b in boxes])
+    return (int((right - left) / resolution + 0.5),
+            int((top - bottom) / resolution + 0.5), warped)
+
+
+def _plan_image(file_paths, recipe):
+    # sizes and stage byte counts of an image ingest
+    import rasterio
+    from .ingest import _transfer_copies, IMAGE_TRANSFER_MODE
+    input_bytes = file_size(file_paths[0])
+    with rasterio.open(file_paths[0]) as src:
+        grid = (src.width, src.height)
+        n_bands = src.count
+    if recipe.get('image_format', 'copy') == 'cog':
+        # uncompressed until calibrated from a previous cog ingest
+        ratio = load_calibration().get('output_ratio', {}).get('image_cog',
+                                                               1.0)
+        store_bytes = int(input_bytes * ratio)
+        stages = [('cog_convert', 1, input_bytes)]
+    else:
+        store_bytes = input_bytes
+        copies = _transfer_copies(
+            os.path.dirname(os.path.abspath(file_paths[0])), get_data_path(),
+            recipe.get('transfer_mode', IMAGE_TRANSFER_MODE))
+        stages = [('transfer', 1, input_bytes if copies else 0)]
+    stages += [('checksum', 1, store_bytes), ('band_stats', 1, store_bytes)]
+    return {'ingest_type': 'image', 'n_bands': n_bands, 'grid': grid,
+            'input_bytes': input_bytes, 'scratch_bytes': 0,
+            'store_bytes': store_bytes, 'merge_memory_bytes': 0,
+            'stages': stages}
+
+
+def _has_envi_header(fpath):
+    from .ingest import _find_envi_header
+    try:
+        _find_envi_header(fpath)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _ewma(rates, key, value):
+    # exponentially weighted update of rates[key]
+    if key in rates:
+        value = (1 - CALIBRATION_ALPHA) * rates[key] \
+            + CALIBRATION_ALPHA * value
+    rates[key] = value
+
+
+def _human_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1000 or unit == 'TB':
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1000
+
+
+def _human_seconds(s):
+    if s < 60:
+        return f'{s:.0f} s'
+    if s < 3600:
+        return f'{s / 60:.1f} min'
+    return f'{s / 3600:.1f} h'
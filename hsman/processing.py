@@ -0,0 +1,674 @@
+"""Submodule for per-pixel spectral processing
+
+Kernels work on the band axis of many pixels at once: a chunk of a cube is
+a (pixels, band) matrix and every transform is a batch of array operations
+over it, never a loop over pixels. Functions take a dataset name or a
+(band, y, x) array with a wavelength coordinate and return lazy dask backed
+arrays, chunked so that a chunk of float64 spectra is about `chunk_mb`.
+Library spectra are matched the same way, as matrix products of a chunk of
+pixels with the whole library. `write_netcdf` computes and writes a result
+chunk by chunk.
+
+Pixels that are 0 in every band, or NaN in any band, are nodata and NaN in
+the outputs.
+"""
+
+import collections
+import itertools
+import math
+import os
+
+import numpy as np
+
+from .api import _cube_source, _storage_chunks
+
+# on-disk chunk size of written results
+CHUNK_SIZE = 512
+MATCH_METRICS = ['sam', 'sid', 'correlation']
+# smallest value of a spectrum in the information divergence
+_SID_EPS = 1e-9
+
+
+def continuum_removed(data, chunk_mb=64):
+    """
+    Continuum removed spectra
+
+    The continuum of a spectrum is its upper convex hull over wavelength.
+    Hulls of a whole chunk are built together by a monotone chain scan over
+    the bands.
+
+    Parameters
+    ----------
+    data : str or xarray.DataArray
+        dataset name or (band, y, x) array with a wavelength coordinate
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+
+    Returns
+    -------
+    result : xarray.DataArray
+        lazy float32 (band, y, x) array of reflectance over continuum
+    """
+    array = _open_spectra(data, chunk_mb)
+    return _apply(_continuum_removed, array,
+                  wavelength=array.wavelength.values)
+
+
+def savgol(data, window, order, deriv=0, chunk_mb=64):
+    """
+    Savitzky-Golay smoothing or derivative of spectra
+
+    Each band is the value (or derivative) at its wavelength of the least
+    squares polynomial through the `window` nearest bands, using the actual
+    wavelengths, so unevenly spaced bands are handled. Windows are shifted
+    inwards at the ends of the spectrum. The fits only depend on the
+    wavelengths, so they are a single (band, band) matrix applied to every
+    pixel.
+
+    Parameters
+    ----------
+    data : str or xarray.DataArray
+        dataset name or (band, y, x) array with a wavelength coordinate
+    window : int
+        number of bands in a fit
+    order : int
+        polynomial order, less than `window`
+    deriv : int, optional
+        derivative order, in reflectance units per nm ** deriv
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+
+    Returns
+    -------
+    result : xarray.DataArray
+        lazy float32 (band, y, x) array
+    """
+    array = _open_spectra(data, chunk_mb)
+    matrix = savgol_matrix(array.wavelength.values, window, order, deriv)
+    return _apply(_matmul, array, matrix=matrix)
+
+
+def band_depth(data, center, left=None, right=None, chunk_mb=64):
+    """
+    Depth of an absorption feature
+
+    With `left` and `right` shoulders the continuum is the line between
+    them, and only those three bands are read. Otherwise it is the
+    continuum of `continuum_removed`.
+
+    Parameters
+    ----------
+    data : str or xarray.DataArray
+        dataset name or (band, y, x) array with a wavelength coordinate
+    center : float
+        wavelength (nm) of the feature, the nearest band is used
+    left, right : float, optional
+        wavelengths (nm) of the shoulders of the feature
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+
+    Returns
+    -------
+    depth : xarray.DataArray
+        lazy float32 (y, x) array of 1 - reflectance / continuum
+    """
+    if (left is None) != (right is None):
+        raise ValueError('Give both shoulders or neither')
+    array = _open_spectra(data, chunk_mb)
+    if left is None:
+        removed = _apply(_continuum_removed, array,
+                         wavelength=array.wavelength.values)
+        depth = 1 - removed.isel(band=_nearest_band(array, center))
+    else:
+        idx = [_nearest_band(array, w) for w in (left, center, right)]
+        bands = _masked(array.isel(band=idx))
+        wl = bands.wavelength.values
+        r_left, r_center, r_right = [bands.isel(band=i) for i in range(3)]
+        fraction = (wl[1] - wl[0]) / (wl[2] - wl[0])
+        continuum = r_left + (r_right - r_left) * fraction
+        depth = 1 - r_center / continuum.where(continuum > 0)
+    depth = depth.drop_vars(['band', 'wavelength'], errors='ignore')
+    depth.attrs = {'center': float(center)}
+    if left is not None:
+        depth.attrs.update(left=float(left), right=float(right))
+    depth.name = 'band_depth'
+    return _with_crs(depth.astype('f4'), array)
+
+
+def vector_normalized(data, chunk_mb=64):
+    """
+    Spectra divided by their Euclidean norm
+
+    Parameters
+    ----------
+    data : str or xarray.DataArray
+        dataset name or (band, y, x) array with a wavelength coordinate
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+
+    Returns
+    -------
+    result : xarray.DataArray
+        lazy float32 (band, y, x) array
+    """
+    return _apply(_vector_normalized, _open_spectra(data, chunk_mb))
+
+
+def savgol_matrix(wavelength, window, order, deriv=0):
+    """
+    (band, band) matrix of Savitzky-Golay fits, see `savgol`
+
+    Parameters
+    ----------
+    wavelength : array-like
+        band wavelengths, in increasing order
+    window, order, deriv : int
+        fit window in bands, polynomial order and derivative order
+
+    Returns
+    -------
+    matrix : numpy.ndarray
+        smoothed spectra are spectra @ matrix.T
+    """
+    wavelength = np.asarray(wavelength, dtype='f8')
+    n_bands = len(wavelength)
+    if not order < window <= n_bands:
+        raise ValueError(f'Window of {window} bands must be more than the '
+                         f'order ({order}) and at most {n_bands}')
+    if deriv > order:
+        raise ValueError(f'Derivative {deriv} is above the order {order}')
+    matrix = np.zeros((n_bands, n_bands))
+    for i in range(n_bands):
+        start = min(max(0, i - window // 2), n_bands - window)
+        offsets = wavelength[start:start + window] - wavelength[i]
+        vander = np.vander(offsets, order + 1, increasing=True)
+        # row k of the solution gives the k-th coefficient from the values
+        coefs = np.linalg.lstsq(vander, np.eye(window), rcond=None)[0]
+        matrix[i, start:start + window] = coefs[deriv] * \
+            math.factorial(deriv)
+    return matrix
+
+
+def match_spectra(dataset, library, metric='sam', top_k=1, chunk_mb=64):
+    """
+    Best matching library spectra of every pixel
+
+    The library is resampled (linearly) to the dataset wavelengths once.
+    Only bands within the wavelength range of every library spectrum are
+    used. Similarities of a chunk of pixels to the whole library are then
+    matrix products:
+
+    - 'sam', spectral angle (radians), lower is better
+    - 'sid', spectral information divergence, lower is better
+    - 'correlation', Pearson correlation, higher is better
+
+    All three ignore the scale of the spectra, so library reflectance (0 to
+    1) can be matched against scaled integer reflectance.
+
+    Parameters
+    ----------
+    dataset : str or xarray.DataArray
+        dataset name or (band, y, x) array with a wavelength coordinate
+    library : dict or pandas.DataFrame
+        {name: (wavelength, reflectance)} or a frame indexed by wavelength
+        with a column per spectrum
+    metric : str, optional
+        'sam', 'sid' or 'correlation'
+    top_k : int, optional
+        number of matches kept for each pixel
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+
+    Returns
+    -------
+    matches : xarray.Dataset
+        lazy (rank, y, x) `match` index into the `library` coordinate (-1
+        for nodata) and `score` of the matches, best first
+    """
+    import xarray
+    _check_metric(metric)
+    array = _open_spectra(dataset, chunk_mb)
+    names, spectra, idx = _resample_library(library,
+                                            array.wavelength.values)
+    top_k = min(top_k, len(names))
+    array = array.isel(band=idx).chunk({'band': -1})
+    match, score = xarray.apply_ufunc(
+        _match, array, kwargs={'library': spectra, 'metric': metric,
+                               'top_k': top_k},
+        input_core_dims=[['band']], output_core_dims=[['rank'], ['rank']],
+        dask='parallelized', output_dtypes=['i4', 'f4'],
+        dask_gufunc_kwargs={'output_sizes': {'rank': top_k}})
+    drop = ['band', 'wavelength']
+    ds = xarray.Dataset(
+        {'match': match.transpose('rank', 'y', 'x').drop_vars(
+            drop, errors='ignore'),
+         'score': score.transpose('rank', 'y', 'x').drop_vars(
+            drop, errors='ignore')},
+        coords={'rank': np.arange(1, top_k + 1), 'library': names})
+    ds.attrs = {'metric': metric, 'n_bands': len(idx)}
+    crs = array.rio.crs
+    return ds if crs is None else ds.rio.write_crs(crs)
+
+
+def similar_pixels(datasets, wavelength, spectrum, n=100, metric='sam',
+                   chunk_mb=64, workers=4, prefetch=4):
+    """
+    The pixels most similar to a spectrum across datasets
+
+    Scores are computed chunk by chunk, as in `match_spectra`, and only the
+    best `n` pixels of each chunk are kept, so memory is bounded whatever
+    the number and size of the datasets.
+
+    Parameters
+    ----------
+    datasets : list
+        dataset names or (band, y, x) arrays with a wavelength coordinate
+    wavelength, spectrum : array-like
+        the query spectrum
+    n : int, optional
+        number of pixels returned
+    metric : str, optional
+        'sam', 'sid' or 'correlation'
+    chunk_mb : int, optional
+        target size of a chunk of float64 spectra
+    workers : int, optional
+        number of threads computing chunks
+    prefetch : int, optional
+        number of chunks computed ahead
+
+    Returns
+    -------
+    pixels : pandas.DataFrame
+        dataset, row, col, x, y and score of the pixels, best first.
+        Datasets given as arrays are numbered in the order given
+    """
+    import pandas as pd
+    _check_metric(metric)
+    if isinstance(datasets, str):
+        datasets = [datasets]
+    if len(datasets) == 0:
+        raise ValueError('No datasets')
+    sign = -1 if metric == 'correlation' else 1
+    best = []
+    for i, data in enumerate(datasets):
+        name = data if isinstance(data, str) else i
+        matches = match_spectra(data, {'query': (wavelength, spectrum)},
+                                metric, 1, chunk_mb)
+        score = matches['score'].isel(rank=0)
+        x = score.x.values
+        y = score.y.values
+        rows = []
+        for (r0, _, c0, _), values in _computed_blocks(score, workers,
+                                                       prefetch):
+            flat = np.where(np.isnan(values), np.inf, sign * values).ravel()
+            keep = _smallest(flat, n)
+            keep = keep[np.isfinite(flat[keep])]
+            r, c = np.unravel_index(keep, values.shape)
+            rows.append(pd.DataFrame({
+                'dataset': name, 'row': r0 + r, 'col': c0 + c,
+                'x': x[c0 + c], 'y': y[r0 + r],
+                'score': values[r, c]}))
+        # the best of the earlier datasets and of each chunk
+        best = pd.concat(best + rows, ignore_index=True)
+        best = [best.iloc[_smallest(sign * best['score'].values, n)]]
+    return best[0].reset_index(drop=True)
+
+
+def write_netcdf(array, fpath, workers=4, prefetch=4):
+    """
+    Compute a lazy array and write it to a netCDF file
+
+    Chunks are computed by a thread pool and written in order by the
+    calling thread, with at most `prefetch` computed chunks waiting, so
+    memory is bounded whatever the size of the array. The file is written
+    next to `fpath` and moved into place when complete.
+
+    Parameters
+    ----------
+    array : xarray.DataArray
+        array with y and x dimensions, e.g. a result of this module. A CRS
+        set with rioxarray is written as its grid mapping
+    fpath : path-like
+        output file
+    workers : int, optional
+        number of computing threads
+    prefetch : int, optional
+        number of chunks computed ahead of the writer
+
+    Returns
+    -------
+    fpath : path-like
+    """
+    lead = [d for d in array.dims if d not in ('y', 'x')]
+    array = array.transpose(*lead, 'y', 'x')
+    tmp_fpath = f'{fpath}.tmp'
+    dst = _create_netcdf(tmp_fpath, array)
+    try:
+        var = dst.variables[array.name or 'data']
+        for (r0, r1, c0, c1), values in _computed_blocks(array, workers,
+                                                         prefetch):
+            var[..., r0:r1, c0:c1] = values
+    except BaseException:
+        dst.close()
+        os.remove(tmp_fpath)
+        raise
+    dst.close()
+    os.replace(tmp_fpath, fpath)
+    return fpath
+
+
+def _smallest(values, n):
+    # indexes of the n smallest values in order, ties in index order. Only
+    # the kept values are sorted
+    n = min(max(n, 0), values.size)
+    if n == 0:
+        return np.arange(0)
+    keep = np.argpartition(values, n - 1)[:n]
+    return keep[np.lexsort((keep, values[keep]))]
+
+
+def _computed_blocks(array, workers, prefetch):
+    # yields ((row start, row end, col start, col end), values) of the
+    # chunks of a (..., y, x) array in order. Chunks are computed by a
+    # thread pool, at most prefetch ahead of the consumer
+    from concurrent.futures import ThreadPoolExecutor
+
+    if array.chunks is None:
+        array = array.chunk()
+    rows = np.cumsum((0,) + array.chunks[-2])
+    cols = np.cumsum((0,) + array.chunks[-1])
+    blocks = [(r0, r1, c0, c1) for r0, r1 in zip(rows[:-1], rows[1:])
+              for c0, c1 in zip(cols[:-1], cols[1:])]
+
+    def compute(block):
+        r0, r1, c0, c1 = block
+        # each worker computes its own chunk, so no nested thread pools
+        values = array[..., r0:r1, c0:c1]
+        return values.compute(scheduler='synchronous').values
+
+    with ThreadPoolExecutor(workers) as pool:
+        todo = iter(blocks)
+        pending = collections.deque(
+            [(x, pool.submit(compute, x)) for x in itertools.islice(
+                todo, prefetch)])
+        try:
+            while pending:
+                block, future = pending.popleft()
+                values = future.result()
+                item = next(todo, None)
+                if item is not None:
+                    pending.append((item, pool.submit(compute, item)))
+                yield tuple(int(x) for x in block), values
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _open_spectra(data, chunk_mb):
+    # (band, y, x) array with a wavelength coordinate and the CRS as a
+    # coordinate, in spatial chunks of about chunk_mb of float64 spectra
+    if isinstance(data, str):
+        # opening is lazy, so the layout is read first to choose the chunks
+        array, _ = _cube_source(data)
+        chunks = _spectral_chunks(array, chunk_mb)
+        array, crs = _cube_source(data, chunks)
+        array = array.chunk(chunks)
+        if crs is not None:
+            array = array.rio.write_crs(crs)
+    else:
+        array = data
+        if 'wavelength' not in array.coords:
+            raise ValueError('Spectra need a wavelength coordinate')
+        array = array.transpose('band', 'y', 'x')
+        array = array.chunk(_spectral_chunks(array, chunk_mb))
+    return array
+
+
+def _spectral_chunks(array, chunk_mb, n_bands=None, itemsize=8):
+    # dask chunks of whole spectra (of n_bands, by default all) of about
+    # chunk_mb, as float64 by default. Chunks are a whole number of storage
+    # chunks when one fits
+    _, height, width = array.shape
+    if n_bands is None:
+        n_bands = array.shape[0]
+    area = max(1, int(chunk_mb * 2 ** 20) // (n_bands * itemsize))
+    cy, cx = _storage_chunks(array)
+    if cx >= width:
+        by, bx = max(1, area // width), width
+    else:
+        by = bx = max(1, int(math.sqrt(area)))
+    if cy * cx <= area:
+        by = math.ceil(by / cy) * cy
+        bx = math.ceil(bx / cx) * cx
+    return {'band': -1, 'y': min(by, height), 'x': min(bx, width)}
+
+
+def _apply(kernel, array, **kwargs):
+    # maps a (..., band) -> (..., band) kernel over the chunks of a
+    # (band, y, x) array
+    import rioxarray  # noqa: F401, registers the rio accessor
+    import xarray
+    array = array.chunk({'band': -1})
+    result = xarray.apply_ufunc(
+        kernel, array, kwargs=kwargs, input_core_dims=[['band']],
+        output_core_dims=[['band']], dask='parallelized',
+        output_dtypes=['f4'], keep_attrs=False)
+    result.name = kernel.__name__.lstrip('_')
+    return _with_crs(result.transpose('band', 'y', 'x'), array)
+
+
+def _with_crs(result, array):
+    # array operations drop the attributes of the CRS coordinate
+    crs = array.rio.crs
+    return result if crs is None else result.rio.write_crs(crs)
+
+
+def _masked(array):
+    # float array with nodata pixels as NaN
+    array = array.astype('f8')
+    nodata = (array == 0).all('band') | array.isnull().any('band')
+    return array.where(~nodata)
+
+
+def _nearest_band(array, wavelength):
+    return int(np.abs(array.wavelength.values - wavelength).argmin())
+
+
+def _valid_spectra(spectra):
+    # (pixels, band) float64 spectra of a (..., band) block and the mask of
+    # the pixels that are not nodata
+    spectra = spectra.reshape(-1, spectra.shape[-1]).astype('f8')
+    valid = np.isfinite(spectra).all(axis=1) & (spectra != 0).any(axis=1)
+    return spectra, valid
+
+
+def _continuum_removed(spectra, wavelength):
+    shape = spectra.shape
+    spectra, valid = _valid_spectra(spectra)
+    order = np.argsort(wavelength, kind='stable')
+    x = np.asarray(wavelength, dtype='f8')[order]
+    y = spectra[valid][:, order]
+    continuum = _hull_continuum(x, y)
+    out = np.full(spectra.shape, np.nan, dtype='f4')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        removed = np.where(continuum > 0, y / continuum, np.nan)
+    out[np.ix_(valid, order)] = removed
+    return out.reshape(shape)
+
+
+def _hull_continuum(x, y):
+    # upper convex hull of each row of y over x, interpolated at x. The hull
+    # vertices of every row are kept in a stack and each band is pushed
+    # after popping the vertices it makes concave, for all rows at once
+    n, m = y.shape
+    if n == 0 or m < 3:
+        return y.copy()
+    stack = np.zeros((n, m), dtype=np.intp)
+    top = np.ones(n, dtype=np.intp)
+    rows = np.arange(n)
+    for j in range(1, m):
+        active = rows[top >= 2]
+        while active.size:
+            a = stack[active, top[active] - 2]
+            b = stack[active, top[active] - 1]
+            cross = (x[b] - x[a]) * (y[active, j] - y[active, a]) - \
+                (y[active, b] - y[active, a]) * (x[j] - x[a])
+            active = active[cross >= 0]
+            top[active] -= 1
+            active = active[top[active] >= 2]
+        stack[rows, top] = j
+        top += 1
+
+    vertex = np.zeros((n, m), dtype=bool)
+    in_stack = np.arange(m) < top[:, None]
+    vertex[np.repeat(rows, top), stack[in_stack]] = True
+    idx = np.arange(m)
+    left = np.maximum.accumulate(np.where(vertex, idx, 0), axis=1)
+    right = np.minimum.accumulate(
+        np.where(vertex, idx, m - 1)[:, ::-1], axis=1)[:, ::-1]
+    y_left = np.take_along_axis(y, left, axis=1)
+    y_right = np.take_along_axis(y, right, axis=1)
+    span = x[right] - x[left]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(span > 0, (x - x[left]) / span, 0)
+    return y_left + (y_right - y_left) * fraction
+
+
+def _matmul(spectra, matrix):
+    shape = spectra.shape
+    spectra, valid = _valid_spectra(spectra)
+    out = np.full(spectra.shape, np.nan, dtype='f4')
+    out[valid] = spectra[valid] @ matrix.T
+    return out.reshape(shape)
+
+
+def _vector_normalized(spectra):
+    shape = spectra.shape
+    spectra, valid = _valid_spectra(spectra)
+    out = np.full(spectra.shape, np.nan, dtype='f4')
+    norm = np.sqrt((spectra[valid] ** 2).sum(axis=1, keepdims=True))
+    out[valid] = spectra[valid] / norm
+    return out.reshape(shape)
+
+
+def _check_metric(metric):
+    if metric not in MATCH_METRICS:
+        raise ValueError(f'metric {metric} not recognised')
+
+
+def _resample_library(library, wavelength):
+    # names, the (spectrum, band) library at the dataset wavelengths and the
+    # positions of the bands covered by every spectrum
+    if hasattr(library, 'columns'):
+        library = {name: (library.index.values, library[name].values)
+                   for name in library.columns}
+    if len(library) < 1:
+        raise ValueError('The library is empty')
+    wavelength = np.asarray(wavelength, dtype='f8')
+    covered = np.ones(len(wavelength), dtype=bool)
+    spectra = []
+    for wl, values in library.values():
+        wl = np.asarray(wl, dtype='f8')
+        order = np.argsort(wl)
+        covered &= (wavelength >= wl.min()) & (wavelength <= wl.max())
+        spectra.append(np.interp(wavelength, wl[order],
+                                 np.asarray(values, dtype='f8')[order]))
+    idx = np.flatnonzero(covered)
+    if len(idx) < 2:
+        raise ValueError('The library covers fewer than 2 dataset bands')
+    return list(library), np.array(spectra)[:, idx], idx
+
+
+def _match(spectra, library, metric, top_k):
+    # library indexes and scores of the top_k matches of (..., band) spectra
+    shape = spectra.shape[:-1]
+    spectra, valid = _valid_spectra(spectra)
+    scores = _similarity(spectra[valid], library, metric)
+    if metric == 'correlation':
+        scores = -scores
+    order = np.argsort(np.where(np.isnan(scores), np.inf, scores),
+                       axis=1, kind='stable')[:, :top_k]
+    match = np.full((len(spectra), top_k), -1, dtype='i4')
+    score = np.full((len(spectra), top_k), np.nan, dtype='f4')
+    match[valid] = order
+    score[valid] = np.take_along_axis(scores, order, axis=1)
+    if metric == 'correlation':
+        score = -score
+    return (match.reshape(shape + (top_k,)),
+            score.reshape(shape + (top_k,)))
+
+
+def _similarity(x, s, metric):
+    # (pixels, spectra) scores of (pixels, band) x against (spectra, band) s
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'correlation':
+            x = x - x.mean(axis=1, keepdims=True)
+            s = s - s.mean(axis=1, keepdims=True)
+        if metric in ('sam', 'correlation'):
+            cos = (x @ s.T) / np.outer(np.linalg.norm(x, axis=1),
+                                       np.linalg.norm(s, axis=1))
+            if metric == 'correlation':
+                return cos
+            return np.arccos(np.clip(cos, -1, 1))
+        # sum (p - q) (log p - log q) of the spectra as distributions
+        p = np.clip(x, _SID_EPS, None)
+        q = np.clip(s, _SID_EPS, None)
+        p = p / p.sum(axis=1, keepdims=True)
+        q = q / q.sum(axis=1, keepdims=True)
+        log_p = np.log(p)
+        log_q = np.log(q)
+        return ((p * log_p).sum(axis=1)[:, None] + (q * log_q).sum(axis=1)
+                - p @ log_q.T - log_p @ q.T)
+
+
+def _create_netcdf(fpath, array):
+    # empty netCDF for an array with its 1-D coordinates, attributes and
+    # grid mapping. The data is chunked by image tiles with deflate
+    from netCDF4 import Dataset
+    import rioxarray  # noqa: F401, registers the rio accessor
+    dst = Dataset(fpath, 'w', format='NETCDF4')
+    try:
+        for dim, size in array.sizes.items():
+            dst.createDimension(dim, size)
+        for name, coord in array.coords.items():
+            if coord.ndim != 1 or coord.dtype.kind not in 'biuf':
+                continue
+            var = dst.createVariable(name, coord.dtype, coord.dims)
+            var.setncatts(_nc_attrs(coord.attrs))
+            var[:] = coord.values
+        dtype = array.dtype
+        chunks = (1,) * (array.ndim - 2) + (
+            min(array.sizes['y'], CHUNK_SIZE), min(array.sizes['x'],
+                                                   CHUNK_SIZE))
+        fill = np.nan if dtype.kind == 'f' else 0
+        var = dst.createVariable(array.name or 'data', dtype, array.dims,
+                                 chunksizes=chunks, zlib=True, shuffle=True,
+                                 fill_value=fill)
+        var.setncatts(_nc_attrs(array.attrs))
+        coordinates = [x for x in dst.variables if x not in array.dims
+                       and x != var.name]
+        crs = array.rio.crs
+        if crs is not None:
+            import pyproj
+            wkt = crs.to_wkt()
+            grid_mapping = dst.createVariable('spatial_ref', 'i4')
+            grid_mapping.setncatts(pyproj.CRS.from_wkt(wkt).to_cf())
+            grid_mapping.setncattr('spatial_ref', wkt)
+            grid_mapping.setncattr('GeoTransform', ' '.join(
+                [repr(x) for x in array.rio.transform().to_gdal()]))
+            var.setncattr('grid_mapping', 'spatial_ref')
+            coordinates.append('spatial_ref')
+        if coordinates:
+            var.setncattr('coordinates', ' '.join(coordinates))
+    except BaseException:
+        dst.close()
+        os.remove(fpath)
+        raise
+    return dst
+
+
+def _nc_attrs(attrs):
+    # the attributes netCDF can store
+    return {k: v for k, v in attrs.items() if k not in ('_FillValue',
+                                                        'grid_mapping')
+            and isinstance(v, (str, int, float, np.number, np.ndarray))}
@@ -1,7 +1,10 @@
 """
 Tools for preprocessing datasets prior to ingestion
 """
-from .config import get_config
+from .config import get_config, USER_PATH
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
 import os
 
 
@@ -42,6 +45,111 @@ def find_dataset_files(dir, recipe_name, config=None):
     return {'data_path': data_matches}
 
 
+def find_all_dataset_files(dir, config=None, index_path=None,
+                           max_workers=None):
+    """
+    Returns filepath dictionaries for every recipe in the config, matched in
+    a single scan of the directory tree.
+
+    Parameters
+    ----------
+    dir : str
+        Path to root directory, containing the files
+
+    config : dict, optional
+        Default reads from config file
+
+    index_path : str, optional
+        Path of the scan index. Defaults to the `scan_index_path` config
+        entry or ~/.hsman/scan_index.json. Directories whose mtime matches
+        the index are not listed again.
+
+    max_workers : int, optional
+        Number of threads used to list directories in parallel
+
+    Returns
+    -------
+    datasets : dict
+        a dict of recipe name to a dict with a data_path entry. Recipes with
+        no matching files are omitted.
+    """
+    config = get_config(config)
+    recipes = {}
+    for recipe_name, recipe in config['raster_dataset_recipes'].items():
+        recipes[recipe_name] = _clean_ds(recipe)
+
+    if index_path is None:
+        index_path = config.get('scan_index_path',
+                                os.path.join(USER_PATH, 'scan_index.json'))
+
+    files = scan_directory(dir, index_path, max_workers)
+
+    out = {}
+    for recipe_name, params in recipes.items():
+        matches = _match_files(files,
+                               params['data_flag'],
+                               params['data_suffix'])
+        if len(matches) > 0:
+            out[recipe_name] = {'data_path': matches}
+    return out
+
+
+def scan_directory(dir, index_path=None, max_workers=None):
+    """
+    Returns a sorted list of all file paths below a directory.
+
+    Directories are listed with `os.scandir`, one tree level at a time in a
+    thread pool. If an index path is supplied, the listing of each directory
+    is stored against its mtime and reused on later scans if the directory
+    has not changed.
+
+    Parameters
+    ----------
+    dir : str
+        Path to root directory
+
+    index_path : str, optional
+        Path to a JSON scan index. No index is used by default.
+
+    max_workers : int, optional
+        Number of threads used to list directories in parallel
+
+    Returns
+    -------
+    files : list
+        absolute paths of all files found
+    """
+    root = os.path.abspath(dir)
+    index = _load_scan_index(index_path)
+    new_index = {}
+    files = []
+    pending = [root]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(pending) > 0:
+            listings = pool.map(lambda x: _list_directory(x, index), pending)
+            pending = []
+            for path, listing in listings:
+                if listing is None:
+                    continue
+                new_index[path] = listing
+                files += [os.path.join(path, x) for x in listing['files']]
+                pending += [os.path.join(path, x) for x in listing['dirs']]
+
+    n_reused = sum([index.get(k) is v for k, v in new_index.items()])
+    logging.debug('Scanned {} directories ({} unchanged)'.format(
+        len(new_index), n_reused))
+
+    if index_path is not None:
+        # keep entries for other trees sharing the index
+        prefix = os.path.join(root, '')
+        for k, v in index.items():
+            if not (k == root or k.startswith(prefix)):
+                new_index[k] = v
+        _save_scan_index(new_index, index_path)
+
+    return sorted(files)
+
+
 def generate_coverage_id(dataset_name, recipe_name):
     """
     Generate a coverage ID from dataset and recipe name
@@ -77,20 +185,76 @@ def _clean_ds(ds):
 
 def _search_directory(dir, tag, ext):
     # searches directory tree for any files containing tag
+    return _match_files(scan_directory(dir), tag, ext)
+
+
+def _match_files(files, tag, ext):
+    # groups any file paths containing tag by mission
     matches = {}
-    for root, _, files in os.walk(dir):
-        for file in files:
-            if (tag in file) & file.endswith(ext):
-                m = _get_mission(file)
-                try:
-                    matches[m].append(os.path.abspath(
-                        os.path.join(root, file)))
-                except KeyError:
-                    matches[m] = [os.path.abspath(
-                        os.path.join(root, file))]
+    for fpath in files:
+        file = os.path.basename(fpath)
+        if (tag in file) & file.endswith(ext):
+            m = _get_mission(file)
+            try:
+                matches[m].append(fpath)
+            except KeyError:
+                matches[m] = [fpath]
     return matches
 
 
+def _list_directory(path, index):
+    # returns (path, listing) where listing holds the directory mtime and
+    # the names of files and subdirectories. Reuses the index entry if the
+    # directory mtime is unchanged
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None
+    cached = index.get(path)
+    if cached is not None and cached['mtime'] == mtime:
+        return path, cached
+
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                # symlinked directories are not followed (as os.walk)
+                if is_dir and not entry.is_symlink():
+                    dirs.append(entry.name)
+                elif not is_dir:
+                    files.append(entry.name)
+    except OSError:
+        logging.debug('Could not list {}'.format(path))
+        return path, None
+    return path, {'mtime': mtime, 'files': files, 'dirs': dirs}
+
+
+def _load_scan_index(index_path):
+    if index_path is None:
+        return {}
+    try:
+        with open(index_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_scan_index(index, index_path):
+    # write to a temporary file first so the index is never left truncated
+    tmp_path = index_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        logging.warning('Scan index not saved to {}'.format(index_path))
+
+
 def _get_mission(x):
     # returns the mission from path string
     f = os.path.basename(x)
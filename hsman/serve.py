@@ -0,0 +1,550 @@
+"""Submodule for serving store datasets as XYZ map tiles on localhost
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .api import open_dataset
+from .compress import is_compressed
+from .config import get_data_path, get_datasets, get_scratch_path
+
+TILE_SIZE = 256
+# half the circumference of the web mercator sphere
+ORIGIN_SHIFT = math.pi * 6378137
+HOST = '127.0.0.1'
+# seconds the dataset list and dataset versions are reused before being
+# read again from the store
+STORE_TTL = 5
+
+
+class TileRequestError(ValueError):
+    """Raised for tile parameters that cannot be satisfied by a dataset,
+    e.g. band numbers out of range"""
+
+
+class TileCache:
+    """Bounded in-memory LRU tile cache backed by a bounded disk cache
+
+    Parameters
+    ----------
+    path : path-like, optional
+        directory of the disk cache. No disk cache if None
+    memory_mb : float, optional
+        maximum size of the in-memory cache
+    disk_mb : float, optional
+        maximum size of the disk cache. The least recently written tiles are
+        removed first
+    """
+    def __init__(self, path=None, memory_mb=256, disk_mb=2048):
+        self.path = path
+        self.memory_bytes = memory_mb * 1e6
+        self.disk_bytes = disk_mb * 1e6
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            except KeyError:
+                pass
+        if self.path is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.path is None:
+            return
+        fpath = self._disk_path(key)
+        with open(fpath + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fpath + '.tmp', fpath)
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum([os.path.getsize(x)
+                                       for x in self._disk_files()])
+            else:
+                self._disk_size += len(data)
+            if self._disk_size > self.disk_bytes:
+                self._prune_disk()
+
+    def _put_memory(self, key, data):
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+
+    def _disk_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, name + '.png')
+
+    def _disk_files(self):
+        return [os.path.join(self.path, x) for x in os.listdir(self.path)
+                if x.endswith('.png')]
+
+    def _prune_disk(self):
+        # remove the oldest tiles until the cache is 80% of its limit
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        for fpath in files:
+            if self._disk_size <= 0.8 * self.disk_bytes:
+                break
+            try:
+                self._disk_size -= os.path.getsize(fpath)
+                os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+
+class TileRenderer:
+    """Renders web mercator PNG tiles from store datasets
+
+    Parameters
+    ----------
+    cache : TileCache, optional
+        tile cache, by default in memory only
+    """
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else TileCache()
+        self._sources = {}
+        self._stretch = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def tile(self, dataset, z, x, y, bands=None, wavelengths=None,
+             vmin=None, vmax=None):
+        """Returns a PNG tile
+
+        Parameters
+        ----------
+        dataset : str
+            dataset name
+        z, x, y : int
+            XYZ tile address
+        bands : list, optional
+            1 or 3 band numbers (1-based) for a grey or RGB composite
+        wavelengths : list, optional
+            1 or 3 wavelengths (nm). The nearest bands are used
+        vmin, vmax : list, optional
+            stretch range per band. By default the 2-98% range of each band
+        """
+        # the version keeps tiles of a dataset ingested again apart
+        key = (dataset, self._version(dataset), z, x, y, _key(bands),
+               _key(wavelengths), _key(vmin), _key(vmax))
+        data = self.cache.get(key)
+        if data is None:
+            data = self._render(dataset, z, x, y, bands, wavelengths, vmin,
+                                vmax)
+            self.cache.put(key, data)
+        return data
+
+    def tilejson(self, dataset, base_url):
+        """Returns a TileJSON description of a dataset"""
+        source = self._source(dataset)
+        return {'tilejson': '2.2.0',
+                'name': dataset,
+                'tiles': [f'{base_url}/{dataset}/{{z}}/{{x}}/{{y}}.png'],
+                'bounds': list(source['bounds']),
+                'minzoom': 0,
+                'maxzoom': source['maxzoom'],
+                'wavelengths': source['wavelengths']}
+
+    def _render(self, dataset, z, x, y, bands, wavelengths, vmin, vmax):
+        source = self._source(dataset)
+        layers = self._select(source, bands, wavelengths)
+        bounds = _tile_bounds(z, x, y)
+        planes = []
+        valid = np.ones((TILE_SIZE, TILE_SIZE), dtype=bool)
+        for i, (path, index) in enumerate(layers):
+            data, mask = _read_tile(path, index, bounds, source['nodata'])
+            lo, hi = self._band_stretch(path, index, source['nodata'],
+                                        source['version'])
+            if vmin is not None:
+                lo = vmin[min(i, len(vmin) - 1)]
+            if vmax is not None:
+                hi = vmax[min(i, len(vmax) - 1)]
+            scaled = (data.astype('f8') - lo) / max(hi - lo, 1e-12)
+            planes.append((np.clip(scaled, 0, 1) * 255).astype('u1'))
+            valid &= mask
+        if len(planes) == 1:
+            planes = planes * 3
+        alpha = (valid * 255).astype('u1')
+        return encode_png(np.stack(planes + [alpha], axis=-1))
+
+    def _source(self, dataset):
+        # file paths, band wavelengths and bounds of a dataset, opened once
+        # per version
+        version = self._version(dataset)
+        with self._lock:
+            source = self._sources.get(dataset)
+            if source is not None and source['version'] == version:
+                return source
+        paths = open_dataset(dataset, mode='path')
+        if isinstance(paths, list):
+            if is_compressed(paths):
+                raise ValueError(f'{dataset} is compressed and has no band '
+                                 'files to serve')
+            ds = open_dataset(dataset, mode='hsi')
+            data_path = os.path.dirname(paths[0])
+            layers = [(os.path.join(data_path, f'band_{int(b)}_merged.nc'), 1)
+                      for b in ds.band.values]
+            layers = [(f'netcdf:{p}:reflectance', i) for p, i in layers]
+            wavelengths = [float(x) for x in ds.wavelength.values]
+            nodata = 0
+        else:
+            import rasterio
+            with rasterio.open(paths) as src:
+                count = src.count
+                nodata = src.nodata
+            layers = [(paths, i + 1) for i in range(count)]
+            wavelengths = None
+        bounds, maxzoom = _geographic_bounds(layers[0][0])
+        source = {'layers': layers, 'wavelengths': wavelengths,
+                  'nodata': nodata, 'bounds': bounds, 'maxzoom': maxzoom,
+                  'version': version}
+        with self._lock:
+            self._sources[dataset] = source
+        return source
+
+    def _version(self, dataset):
+        # dataset_version, read again at most every STORE_TTL seconds
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(dataset)
+        if cached is not None and now - cached[0] < STORE_TTL:
+            return cached[1]
+        version = dataset_version(dataset)
+        with self._lock:
+            self._versions[dataset] = (now, version)
+        return version
+
+    def _select(self, source, bands, wavelengths):
+        layers = source['layers']
+        if wavelengths is not None:
+            if source['wavelengths'] is None:
+                raise TileRequestError('dataset has no wavelengths')
+            if len(wavelengths) not in [1, 3]:
+                raise TileRequestError('1 or 3 wavelengths required')
+            wl = np.array(source['wavelengths'])
+            return [layers[int(np.abs(wl - w).argmin())] for w in wavelengths]
+        if bands is None:
+            bands = [1, 2, 3] if len(layers) >= 3 else [1]
+        if len(bands) not in [1, 3]:
+            raise TileRequestError('1 or 3 bands required')
+        if not all([1 <= b <= len(layers) for b in bands]):
+            raise TileRequestError(f'bands must be in 1..{len(layers)}')
+        return [layers[b - 1] for b in bands]
+
+    def _band_stretch(self, path, index, nodata, version=None):
+        # 2-98% range of a band from a reduced resolution read
+        key = (path, index, version)
+        with self._lock:
+            if key in self._stretch:
+                return self._stretch[key]
+        import rasterio
+        with rasterio.open(path) as src:
+            scale = max(1, max(src.width, src.height) // 1024)
+            data = src.read(index, out_shape=(max(1, src.height // scale),
+                                              max(1, src.width // scale)))
+        if nodata is not None:
+            data = data[data != nodata]
+        if data.size == 0:
+            stretch = (0, 1)
+        else:
+            stretch = tuple(float(x) for x in np.percentile(data, [2, 98]))
+        with self._lock:
+            self._stretch[key] = stretch
+        return stretch
+
+
+def dataset_version(dataset):
+    """Version of a dataset, which changes when it is ingested again
+
+    Returns
+    -------
+    version : tuple
+        inode and modification time of the DATA folder, which is created at
+        ingest and changes whenever files are added, replaced or removed
+    """
+    st = os.stat(os.path.join(get_data_path(), dataset, 'DATA'))
+    return st.st_ino, st.st_mtime_ns
+
+
+def encode_png(array):
+    """Encode an 8-bit (height, width, channels) array as PNG bytes
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        uint8 array with 1 (grey), 3 (RGB) or 4 (RGBA) channels
+
+    Returns
+    -------
+    png : bytes
+    """
+    if array.ndim == 2:
+        array = array[:, :, None]
+    height, width, channels = array.shape
+    colour_type = {1: 0, 3: 2, 4: 6}[channels]
+    # each scanline is prefixed with filter type 0
+    raw = np.concatenate([np.zeros((height, 1), dtype='u1'),
+                          array.reshape(height, -1).astype('u1')], axis=1)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                       colour_type, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+
+def serve(port=8000, workers=4, memory_mb=256, disk_mb=2048,
+          cache_path=None, allow_origin=None):
+    """Run the tile server on localhost until interrupted
+
+    Tiles are served at http://127.0.0.1:PORT/DATASET/{z}/{x}/{y}.png with
+    optional `bands`, `wavelengths`, `vmin` and `vmax` query parameters
+    (comma separated). /datasets lists datasets and
+    /DATASET/tilejson.json describes one. The store is listed again at most
+    every STORE_TTL seconds, so new or re-ingested datasets are served
+    after that delay.
+
+    Parameters
+    ----------
+    port : int, optional
+        port to listen on
+    workers : int, optional
+        number of tiles rendered concurrently
+    memory_mb, disk_mb : float, optional
+        sizes of the in-memory and on-disk tile caches
+    cache_path : path-like, optional
+        disk cache directory, by default tiles/ in the scratch directory
+    allow_origin : str, optional
+        origin of a web map allowed to read responses across origins
+        (CORS), e.g. 'http://localhost:3000'. By default no other origin
+        can read them
+    """
+    if cache_path is None:
+        cache_path = os.path.join(get_scratch_path(), 'tiles')
+    renderer = TileRenderer(TileCache(cache_path, memory_mb, disk_mb))
+    server = TileServer(renderer, port, workers, allow_origin)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        logging.info('Tile server stopped')
+
+
+class TileServer:
+    """Minimal asynchronous HTTP server for tiles, bound to localhost.
+    Rendering runs in a thread pool and concurrent requests for the same
+    tile share one render. Only `allow_origin`, if given, may read
+    responses from other origins."""
+    def __init__(self, renderer, port=8000, workers=4, allow_origin=None):
+        self.renderer = renderer
+        self.port = port
+        self.allow_origin = allow_origin
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._datasets = None
+        self._datasets_time = None
+
+    async def run(self):
+        server = await asyncio.start_server(self._handle, HOST, self.port)
+        logging.info(f'Serving tiles at http://{HOST}:{self.port}/')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # skip the headers
+            while (await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                status, ctype, body = 405, 'text/plain', b'GET only'
+            else:
+                status, ctype, body = await self._route(parts[1])
+        except Exception as e:
+            logging.exception('Tile request failed')
+            status, ctype, body = 500, 'text/plain', str(e).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  405: 'Method Not Allowed', 500: 'Internal Server Error'}
+        header = (f'HTTP/1.1 {status} {reason[status]}\r\n'
+                  f'Content-Type: {ctype}\r\n'
+                  f'Content-Length: {len(body)}\r\n')
+        if self.allow_origin is not None:
+            header += f'Access-Control-Allow-Origin: {self.allow_origin}\r\n'
+        header += 'Connection: close\r\n\r\n'
+        writer.write(header.encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, target):
+        url = urllib.parse.urlsplit(target)
+        path = [urllib.parse.unquote(x) for x in url.path.split('/') if x]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        loop = asyncio.get_running_loop()
+
+        datasets = await self._store_datasets()
+        if path == ['datasets']:
+            body = json.dumps(sorted(datasets)).encode()
+            return 200, 'application/json', body
+        # names come from the URL, so only store datasets reach the paths
+        if len(path) < 1 or path[0] not in datasets:
+            return 404, 'text/plain', b'Not found'
+
+        if len(path) == 2 and path[1] == 'tilejson.json':
+            base = f'http://{HOST}:{self.port}'
+            info = await loop.run_in_executor(
+                self._pool, self.renderer.tilejson, path[0], base)
+            return 200, 'application/json', json.dumps(info).encode()
+
+        if len(path) == 4 and path[3].endswith('.png'):
+            try:
+                z, x = int(path[1]), int(path[2])
+                y = int(path[3][:-4])
+                kwargs = {k: _parse_list(query.get(k), t) for k, t in
+                          [('bands', int), ('wavelengths', float),
+                           ('vmin', float), ('vmax', float)]}
+            except ValueError:
+                return 400, 'text/plain', b'Invalid tile request'
+            key = (path[0], z, x, y, repr(sorted(kwargs.items())))
+            future = self._pending.get(key)
+            if future is None:
+                future = loop.run_in_executor(
+                    self._pool, lambda: self.renderer.tile(
+                        path[0], z, x, y, **kwargs))
+                self._pending[key] = future
+                future.add_done_callback(
+                    lambda _: self._pending.pop(key, None))
+            try:
+                return 200, 'image/png', await asyncio.shield(future)
+            except TileRequestError as e:
+                return 400, 'text/plain', str(e).encode()
+            except (FileNotFoundError, KeyError, IndexError, ValueError):
+                return 404, 'text/plain', b'Tile not found'
+
+        return 404, 'text/plain', b'Not found'
+
+    async def _store_datasets(self):
+        # datasets of the store, listed again at most every STORE_TTL
+        # seconds and off the event loop, as listing may be slow (e.g. NFS)
+        now = time.monotonic()
+        if self._datasets_time is None or \
+                now - self._datasets_time >= STORE_TTL:
+            loop = asyncio.get_running_loop()
+            self._datasets = await loop.run_in_executor(self._pool,
+                                                        get_datasets)
+            self._datasets_time = now
+        return self._datasets
+
+
+def _read_tile(path, index, bounds, nodata):
+    # read one band into the tile grid, using the overview level closest to
+    # (but not coarser than) the tile resolution
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_bounds
+    from rasterio.vrt import WarpedVRT
+
+    resolution = (bounds[2] - bounds[0]) / TILE_SIZE
+    overview_level = _overview_level(path, index, resolution)
+    transform = from_bounds(*bounds, TILE_SIZE, TILE_SIZE)
+    with rasterio.open(path, overview_level=overview_level) as src:
+        if nodata is None:
+            nodata = src.nodata
+        options = {'crs': 'EPSG:3857', 'transform': transform,
+                   'width': TILE_SIZE, 'height': TILE_SIZE,
+                   'resampling': Resampling.bilinear}
+        if nodata is None:
+            with WarpedVRT(src, add_alpha=True, **options) as vrt:
+                data = vrt.read(index)
+                mask = vrt.read(vrt.count) > 0
+        else:
+            with WarpedVRT(src, src_nodata=nodata, nodata=nodata,
+                           **options) as vrt:
+                data = vrt.read(index)
+                mask = data != nodata
+    return data, mask
+
+
+def _overview_level(path, index, resolution):
+    import rasterio
+    from rasterio.warp import transform_bounds
+    with rasterio.open(path) as src:
+        factors = src.overviews(index)
+        if len(factors) == 0:
+            return None
+        # approximate source resolution in web mercator metres
+        b = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        src_res = (b[2] - b[0]) / src.width
+    level = None
+    for i, factor in enumerate(factors):
+        if src_res * factor <= resolution:
+            level = i
+    return level
+
+
+def _geographic_bounds(path):
+    # lon/lat bounds and the zoom at which tiles reach native resolution
+    import rasterio
+    from rasterio.warp import transform_bounds
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+        b = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        res = (b[2] - b[0]) / src.width
+    maxzoom = int(math.ceil(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * res))))
+    return bounds, max(0, min(maxzoom, 24))
+
+
+def _tile_bounds(z, x, y):
+    # web mercator bounds (left, bottom, right, top) of an XYZ tile
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    return (x * size - ORIGIN_SHIFT,
+            ORIGIN_SHIFT - (y + 1) * size,
+            (x + 1) * size - ORIGIN_SHIFT,
+            ORIGIN_SHIFT - y * size)
+
+
+def _parse_list(value, dtype):
+    if value is None or value == '':
+        return None
+    return [dtype(x) for x in value.split(',')]
+
+
+def _key(x):
+    return None if x is None else tuple(x)
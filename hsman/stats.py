@@ -0,0 +1,226 @@
+"""Submodule for per-band statistics and histograms accumulated at ingest
+"""
+
+import json
+import os
+
+import numpy as np
+
+STATS_NAME = 'band_stats.json'
+PERCENTILES = [1, 2, 5, 25, 50, 75, 95, 98, 99]
+# bins of the stored histograms
+HIST_BINS = 256
+# bins of the accumulator for floating point and wide integer data
+FINE_BINS = 4096
+
+
+class BandStats:
+    """Streaming statistics of one band
+
+    Chunks of the band are passed to `update` as they are written. Count,
+    min, max, mean and standard deviation are exact. 8 and 16 bit integer
+    data are counted per value, so percentiles and histograms are exact
+    too. Other data types use a histogram of FINE_BINS bins that doubles its
+    range as needed, and percentiles are interpolated within a bin.
+
+    Parameters
+    ----------
+    nodata : number, optional
+        value excluded from the statistics (NaN is always excluded)
+    """
+    def __init__(self, nodata=0):
+        self.nodata = nodata
+        self.count = 0
+        self.nodata_count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.mean = 0.0
+        self._m2 = 0.0
+        # exact value counts and the value of the first count
+        self._counts = None
+        self._offset = 0
+        # adaptive histogram with lower edge and bin width
+        self._hist = None
+        self._lo = None
+        self._width = None
+
+    def update(self, data):
+        """Add a chunk of band data"""
+        data = np.asarray(data).ravel()
+        if data.dtype.kind == 'f':
+            valid = ~np.isnan(data)
+        else:
+            valid = np.ones(data.shape, dtype=bool)
+        if self.nodata is not None:
+            valid &= data != self.nodata
+        values = data[valid]
+        self.nodata_count += data.size - values.size
+        if values.size == 0:
+            return
+
+        # combine mean and sum of squares with the chunk's (Chan et al.)
+        n = values.size
+        mean = values.mean(dtype='f8')
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+
+        if values.dtype.kind in 'iu' and values.dtype.itemsize <= 2:
+            if self._counts is None:
+                info = np.iinfo(values.dtype)
+                self._offset = info.min
+                self._counts = np.zeros(info.max - info.min + 1, 'i8')
+            self._counts += np.bincount(values.astype('i4') - self._offset,
+                                        minlength=len(self._counts))
+        else:
+            self._update_histogram(values.astype('f8'))
+
+    def to_dict(self):
+        """Returns the statistics as a JSON serialisable dictionary"""
+        out = {'count': int(self.count),
+               'nodata_count': int(self.nodata_count)}
+        if self.count == 0:
+            return out
+        out.update({'min': self.min,
+                    'max': self.max,
+                    'mean': self.mean,
+                    'std': float(np.sqrt(self._m2 / self.count))})
+        out['percentiles'] = dict(zip([str(p) for p in PERCENTILES],
+                                      self._percentiles()))
+        hist, hist_range = self._histogram()
+        out['histogram'] = [int(x) for x in hist]
+        out['histogram_range'] = hist_range
+        return out
+
+    def _update_histogram(self, values):
+        lo, hi = values.min(), values.max()
+        if self._hist is None:
+            self._lo = lo
+            self._width = (hi - lo) / FINE_BINS
+            if self._width == 0:
+                self._width = max(abs(lo) * 1e-6, 1e-12)
+            self._hist = np.zeros(FINE_BINS, 'i8')
+        while lo < self._lo or hi > self._lo + self._width * FINE_BINS:
+            # merge pairs of bins and extend the range towards the data
+            merged = self._hist.reshape(-1, 2).sum(axis=1)
+            self._hist = np.zeros(FINE_BINS, 'i8')
+            self._width *= 2
+            if lo < self._lo:
+                self._hist[FINE_BINS // 2:] = merged
+                self._lo -= self._width * (FINE_BINS // 2)
+            else:
+                self._hist[:FINE_BINS // 2] = merged
+        idx = ((values - self._lo) / self._width).astype('i8')
+        np.clip(idx, 0, FINE_BINS - 1, out=idx)
+        self._hist += np.bincount(idx, minlength=FINE_BINS)
+
+    def _percentiles(self):
+        targets = np.array(PERCENTILES) / 100 * self.count
+        if self._counts is not None:
+            cum = np.cumsum(self._counts)
+            idx = np.searchsorted(cum, targets)
+            return [int(x) for x in idx + self._offset]
+        cum = np.cumsum(self._hist)
+        idx = np.searchsorted(cum, targets)
+        before = np.where(idx > 0, cum[idx - 1], 0)
+        frac = (targets - before) / np.maximum(self._hist[idx], 1)
+        values = self._lo + (idx + frac) * self._width
+        return [float(x) for x in np.clip(values, self.min, self.max)]
+
+    def _histogram(self):
+        # HIST_BINS equal bins from min to max (max + 1 for integers)
+        if self._counts is not None:
+            lo, hi = int(self.min), int(self.max) + 1
+            counts = self._counts[lo - self._offset:hi - self._offset]
+            centres = np.arange(lo, hi)
+        else:
+            lo, hi = self.min, self.max
+            centres = self._lo + (np.arange(FINE_BINS) + 0.5) * self._width
+            counts = self._hist
+        hist, _ = np.histogram(np.clip(centres, lo, hi), bins=HIST_BINS,
+                               range=(lo, hi), weights=counts)
+        return hist, [lo, hi]
+
+
+def stats_attrs(stats):
+    """NetCDF attributes for a band from `BandStats.to_dict` output"""
+    # all float64, as netCDF3 files have no 64 bit integer attributes
+    attrs = {}
+    for k in ['count', 'nodata_count', 'min', 'max', 'mean', 'std']:
+        if k in stats:
+            attrs[f'stats_{k}'] = np.float64(stats[k])
+    if 'percentiles' in stats:
+        attrs['stats_percentile_levels'] = np.array(PERCENTILES, 'f8')
+        attrs['stats_percentiles'] = np.array(
+            list(stats['percentiles'].values()), 'f8')
+        attrs['stats_histogram'] = np.array(stats['histogram'], 'f8')
+        attrs['stats_histogram_range'] = np.array(stats['histogram_range'],
+                                                  'f8')
+    return attrs
+
+
+def stats_from_attrs(attrs):
+    """Inverse of `stats_attrs`"""
+    stats = {}
+    for k in ['count', 'nodata_count', 'min', 'max', 'mean', 'std']:
+        if f'stats_{k}' in attrs:
+            stats[k] = np.asarray(attrs[f'stats_{k}']).item()
+    for k in ['count', 'nodata_count']:
+        if k in stats:
+            stats[k] = int(stats[k])
+    if 'stats_percentiles' in attrs:
+        stats['percentiles'] = {
+            str(int(p)): np.asarray(v).item() for p, v in
+            zip(attrs['stats_percentile_levels'], attrs['stats_percentiles'])}
+        stats['histogram'] = [int(x) for x in attrs['stats_histogram']]
+        stats['histogram_range'] = [np.asarray(x).item() for x in
+                                    attrs['stats_histogram_range']]
+    return stats
+
+
+def write_band_stats(dataset_path, bands):
+    """Write the statistics of every band to METADATA/band_stats.json
+
+    Parameters
+    ----------
+    dataset_path : path-like
+        path of the dataset folder in the store
+    bands : dict
+        band number to `BandStats.to_dict` output, optionally with a
+        wavelength
+
+    Returns
+    -------
+    path : str
+    """
+    fpath = os.path.join(dataset_path, 'METADATA', STATS_NAME)
+    content = {'percentile_levels': PERCENTILES, 'histogram_bins': HIST_BINS,
+               'bands': {str(k): v for k, v in bands.items()}}
+    with open(fpath + '.tmp', 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(fpath + '.tmp', fpath)
+    return fpath
+
+
+def read_band_stats(dataset_path):
+    """Read METADATA/band_stats.json of a dataset
+
+    Returns
+    -------
+    bands : dict
+        band number (int) to statistics
+
+    Raises
+    ------
+    FileNotFoundError
+        if the dataset has no statistics file
+    """
+    fpath = os.path.join(dataset_path, 'METADATA', STATS_NAME)
+    with open(fpath) as f:
+        content = json.load(f)
+    return {int(k): v for k, v in content['bands'].items()}
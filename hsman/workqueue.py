@@ -0,0 +1,328 @@
+"""Submodule for a SQLite work queue on a shared filesystem
+
+Coordinators add jobs and any number of workers, on any node that sees the
+queue file, claim and run them. There is no broker: claims are serialised
+by SQLite's file lock, and a claim is a lease that the worker renews with
+heartbeats. Jobs of a dead worker are claimed again once their lease
+expires. Lease times are compared between nodes, so their clocks must be
+synchronised (e.g. NTP).
+
+Jobs belong to a group and have a stage. A job is only claimed when every
+job of its group with a lower stage is done, e.g. an ingest's band jobs
+(stage 1) run after its preparation (stage 0) and before its final job
+(stage 2).
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from typing import NamedTuple
+
+from .config import get_config, get_scratch_path
+
+QUEUE_NAME = 'ingest_queue.sqlite'
+DEFAULT_LEASE = 300
+DEFAULT_ATTEMPTS = 3
+JOB_STATES = ['pending', 'running', 'done', 'failed']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    stage INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, grp, stage);
+"""
+
+
+class Job(NamedTuple):
+    """A claimed job"""
+    id: int
+    kind: str
+    group: str
+    stage: int
+    payload: dict
+    attempts: int
+
+
+class WorkQueue:
+    """Jobs in a SQLite file shared by coordinators and workers
+
+    Every call opens its own connection, so one queue can be used from
+    several threads and processes.
+
+    Parameters
+    ----------
+    path : path-like
+        queue file, created if it does not exist
+    lease : float, optional
+        seconds a claim lasts without a heartbeat
+    max_attempts : int, optional
+        claims of a job before it is failed
+    """
+    def __init__(self, path, lease=DEFAULT_LEASE,
+                 max_attempts=DEFAULT_ATTEMPTS):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self._transaction() as db:
+            for statement in _SCHEMA.split(';'):
+                db.execute(statement)
+
+    def add(self, jobs, group):
+        """Add the jobs of a group
+
+        Parameters
+        ----------
+        jobs : list
+            (kind, payload, stage) tuples. Payloads must be JSON
+            serialisable (numpy values are converted)
+        group : str
+            group name, e.g. the dataset path
+
+        Returns
+        -------
+        ids : list
+        """
+        now = time.time()
+        ids = []
+        with self._transaction() as db:
+            for kind, payload, stage in jobs:
+                cursor = db.execute(
+                    'INSERT INTO jobs (kind, grp, stage, payload, created, '
+                    'updated) VALUES (?, ?, ?, ?, ?, ?)',
+                    (kind, group, stage, _dumps(payload), now, now))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def claim(self, worker):
+        """Claim the next job that is ready to run
+
+        Pending jobs and running jobs with an expired lease can be claimed.
+        Expired jobs that have used all their attempts are failed, as are
+        the pending jobs of a group after one of its jobs failed.
+
+        Returns
+        -------
+        job : Job or None
+            None if no job is ready
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'failed', updated = ?, "
+                "error = 'lease expired ' || attempts || ' times' "
+                "WHERE state = 'running' AND lease_expires < ? "
+                "AND attempts >= ?", (now, now, self.max_attempts))
+            db.execute(
+                "UPDATE jobs SET state = 'failed', updated = ?, "
+                "error = 'an earlier stage failed' "
+                "WHERE state = 'pending' AND EXISTS (SELECT 1 FROM jobs d "
+                "WHERE d.grp = jobs.grp AND d.stage < jobs.stage "
+                "AND d.state = 'failed')", (now,))
+            row = db.execute(
+                "SELECT id, kind, grp, stage, payload, attempts FROM jobs "
+                "WHERE (state = 'pending' OR (state = 'running' "
+                "AND lease_expires < ?)) AND NOT EXISTS (SELECT 1 FROM jobs d "
+                "WHERE d.grp = jobs.grp AND d.stage < jobs.stage "
+                "AND d.state != 'done') ORDER BY stage DESC, id LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?", (worker, now + self.lease, now, row[0]))
+        return Job(row[0], row[1], row[2], row[3], json.loads(row[4]),
+                   row[5] + 1)
+
+    def heartbeat(self, job, worker):
+        """Renew the lease of a job
+
+        Returns
+        -------
+        owned : bool
+            False if the job was claimed by another worker after the lease
+            expired
+        """
+        return self._update(
+            job, worker, "lease_expires = ?", (time.time() + self.lease,))
+
+    def complete(self, job, worker, result=None):
+        """Mark a job done with a JSON serialisable result
+
+        Returns
+        -------
+        owned : bool
+            False, and the result is discarded, if the job was claimed by
+            another worker after the lease expired
+        """
+        return self._update(job, worker, "state = 'done', result = ?",
+                            (_dumps(result),))
+
+    def fail(self, job, worker, error):
+        """Record the error of a job. It is tried again until it has used
+        all its attempts"""
+        state = 'failed' if job.attempts >= self.max_attempts else 'pending'
+        return self._update(job, worker, "state = ?, error = ?",
+                            (state, str(error)))
+
+    def results(self, group, kind=None):
+        """Results of the done jobs of a group, as a list of dictionaries
+        with the job kind, payload and result"""
+        query = "SELECT kind, payload, result FROM jobs WHERE grp = ? " \
+            "AND state = 'done'"
+        args = [group]
+        if kind is not None:
+            query += " AND kind = ?"
+            args.append(kind)
+        with self._transaction() as db:
+            rows = db.execute(query + " ORDER BY id", args).fetchall()
+        return [{'kind': k, 'payload': json.loads(p),
+                 'result': json.loads(r)} for k, p, r in rows]
+
+    def counts(self):
+        """Number of jobs in each state"""
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        counts = {x: 0 for x in JOB_STATES}
+        counts.update(dict(rows))
+        return counts
+
+    def errors(self):
+        """(id, kind, group, error) of the failed jobs"""
+        with self._transaction() as db:
+            return db.execute(
+                "SELECT id, kind, grp, error FROM jobs "
+                "WHERE state = 'failed' ORDER BY id").fetchall()
+
+    def _update(self, job, worker, assignments, args):
+        # updates a job only while this worker holds it
+        with self._transaction() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET {assignments}, updated = ? WHERE id = ? "
+                "AND worker = ? AND state = 'running'",
+                tuple(args) + (time.time(), job.id, worker))
+            return cursor.rowcount == 1
+
+    def _transaction(self):
+        return _Transaction(self.path)
+
+
+class _Transaction:
+    # a connection with an immediate (write locked) transaction, committed
+    # on exit. The rollback journal is kept as WAL needs shared memory,
+    # which network filesystems do not provide
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.path, timeout=60,
+                                  isolation_level=None)
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.db.close()
+
+
+def run_worker(queue, handlers, worker=None, poll=10, heartbeat=None,
+               max_jobs=None):
+    """Claim and run jobs until the queue has nothing left to do
+
+    Parameters
+    ----------
+    queue : WorkQueue
+    handlers : dict
+        job kind to a function of (job, queue) that returns the job result
+    worker : str, optional
+        worker name, by default host:pid
+    poll : float, optional
+        seconds to wait when no job is ready but others are still running
+    heartbeat : float, optional
+        seconds between heartbeats, by default a third of the lease
+    max_jobs : int, optional
+        stop after this many jobs
+
+    Returns
+    -------
+    n_jobs : int
+        number of jobs this worker completed
+    """
+    if worker is None:
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+    if heartbeat is None:
+        heartbeat = queue.lease / 3
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        job = queue.claim(worker)
+        if job is None:
+            counts = queue.counts()
+            if counts['pending'] + counts['running'] == 0:
+                break
+            time.sleep(poll)
+            continue
+        logging.info(f'{worker} running job {job.id} ({job.kind}, '
+                     f'attempt {job.attempts})')
+        stop = threading.Event()
+        beats = threading.Thread(target=_heartbeat,
+                                 args=(queue, job, worker, heartbeat, stop),
+                                 daemon=True)
+        beats.start()
+        try:
+            result = handlers[job.kind](job, queue)
+        except Exception as e:
+            logging.error(f'Job {job.id} ({job.kind}) failed: {e}')
+            queue.fail(job, worker, traceback.format_exc())
+            continue
+        finally:
+            stop.set()
+            beats.join()
+        if queue.complete(job, worker, result):
+            n_jobs += 1
+        else:
+            logging.warning(f'Lost the lease of job {job.id}, its result '
+                            'was discarded')
+    return n_jobs
+
+
+def queue_path():
+    """Path of the ingest queue, the 'queue_path' config key or a file in
+    the scratch directory, which must then be shared by every node"""
+    return get_config().get('queue_path',
+                            os.path.join(get_scratch_path(), QUEUE_NAME))
+
+
+def _heartbeat(queue, job, worker, interval, stop):
+    while not stop.wait(interval):
+        if not queue.heartbeat(job, worker):
+            logging.warning(f'Job {job.id} was claimed by another worker')
+            return
+
+
+def _dumps(value):
+    # JSON with numpy scalars and arrays as plain values
+    def default(x):
+        if hasattr(x, 'tolist'):
+            return x.tolist()
+        raise TypeError(f'{type(x)} is not JSON serialisable')
+    return json.dumps(value, default=default)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for hsman ingest and read paths.
+
+Generates synthetic flightlines and images, ingests them into a throwaway
+store, times the ingest, open and read paths and writes the results to
+results/<version>.json. Pass --compare with an earlier results file to flag
+regressions, e.g.
+
+    python test/benchmark/run_benchmarks.py --preset small \
+        --compare test/benchmark/results/0.1.8.json
+"""
+import click
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import yaml
+
+from synthetic import generate_flightlines, generate_image
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+PRESETS = {
+    'small': {'samples': 100, 'lines': 200, 'bands': 16, 'flightlines': 2},
+    'medium': {'samples': 900, 'lines': 2000, 'bands': 64, 'flightlines': 3},
+    # a HySpex VNIR-1800 mission
+    'production': {'samples': 1800, 'lines': 10000, 'bands': 186,
+                   'flightlines': 4},
+}
+
+
+@click.command()
+@click.option('--preset', type=click.Choice(list(PRESETS)), default='small')
+@click.option('--samples', type=int, default=None)
+@click.option('--lines', type=int, default=None)
+@click.option('--bands', type=int, default=None)
+@click.option('--flightlines', type=int, default=None)
+@click.option('--overlap', type=float, default=0.2)
+@click.option('--interleave', type=click.Choice(['bsq', 'bil', 'bip']),
+              default='bil')
+@click.option('--image-size', type=int, default=4000)
+@click.option('--repeat', type=int, default=3,
+              help='Repeats of the read benchmarks (fastest is kept)')
+@click.option('--workdir', default=None, type=click.Path(file_okay=False),
+              help='Scratch directory (default: new temporary directory)')
+@click.option('--output', default=None, type=click.Path(dir_okay=False),
+              help='Results file (default: results/<version>.json)')
+@click.option('--compare', default=None, type=click.Path(exists=True),
+              help='Earlier results file to compare against')
+@click.option('--threshold', type=float, default=0.1,
+              help='Relative slowdown reported as a regression')
+def main(preset, samples, lines, bands, flightlines, overlap, interleave,
+         image_size, repeat, workdir, output, compare, threshold):
+    params = dict(PRESETS[preset])
+    for k, v in [('samples', samples), ('lines', lines), ('bands', bands),
+                 ('flightlines', flightlines)]:
+        if v is not None:
+            params[k] = v
+    params.update({'overlap': overlap, 'interleave': interleave,
+                   'image_size': image_size})
+
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='hsman_bench_')
+    try:
+        results = run(params, workdir, repeat)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'version': _version(),
+              'git': _git_revision(),
+              'date': datetime.datetime.now().isoformat(),
+              'params': params,
+              'results': results}
+    if output is None:
+        name = report['version']
+        if name == 'dev':
+            name = f'dev-{report["git"]}'
+        output = os.path.join(HERE, 'results', f'{name}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f'Results written to {output}')
+
+    for name, r in results.items():
+        click.echo('{:<28} {:>10.3f} s'.format(name, r['seconds']))
+
+    if compare is not None:
+        with open(compare) as f:
+            old = json.load(f)
+        regressions = compare_results(old, report, threshold)
+        for name, ratio in regressions.items():
+            click.echo('REGRESSION {:<28} {:.0%} slower'.format(name,
+                                                                ratio - 1))
+        if len(regressions) > 0:
+            raise SystemExit(1)
+
+
+def run(params, workdir, repeat=3):
+    """
+    Generate data, ingest into a throwaway store and time every benchmark
+
+    Returns
+    -------
+    results : dict
+        benchmark name to timing dictionary
+    """
+    _isolate_store(workdir)
+    # hsman reads its config from $HOME so is imported after isolating
+    import hsman
+    from hsman import ingest
+
+    src = os.path.join(workdir, 'SOURCE')
+    os.makedirs(src, exist_ok=True)
+    flightlines = generate_flightlines(src,
+                                       n_flightlines=params['flightlines'],
+                                       samples=params['samples'],
+                                       lines=params['lines'],
+                                       bands=params['bands'],
+                                       overlap=params['overlap'],
+                                       interleave=params['interleave'])
+    image = generate_image(src, params['image_size'], params['image_size'])
+    source_bytes = sum([os.path.getsize(x) for x in flightlines])
+
+    results = {}
+
+    t = _timeit(lambda: ingest.ingest_hsi(flightlines, 'BENCH01-A_VNIR',
+                                          profile=True), 1)
+    results['ingest_hsi'] = dict(t, mb_per_s=source_bytes / 1e6
+                                 / t['seconds'])
+    t = _timeit(lambda: ingest.ingest_image(image, 'BENCH01-A_RGB'), 1)
+    results['ingest_image'] = dict(t, mb_per_s=os.path.getsize(image) / 1e6
+                                   / t['seconds'])
+
+    results['open_dataset_hsi'] = _timeit(
+        lambda: hsman.open_dataset('BENCH01-A_VNIR'), repeat)
+    results['open_dataset_rgb'] = _timeit(
+        lambda: hsman.open_dataset('BENCH01-A_RGB', mode='rgb'), repeat)
+
+    inventory = os.path.join(workdir, 'STORE', '.inventory.gpkg')
+
+    def cold():
+        if os.path.exists(inventory):
+            os.remove(inventory)
+        hsman.get_datasets()
+    results['get_datasets_cold'] = _timeit(cold, repeat)
+    results['get_datasets_warm'] = _timeit(hsman.get_datasets, repeat)
+
+    ds = hsman.open_dataset('BENCH01-A_VNIR')
+    var = ds['reflectance']
+    ny, nx = len(ds.y), len(ds.x)
+    results['read_single_band'] = _timeit(
+        lambda: var.isel(band=0).values, repeat)
+    results['read_pixel_spectrum'] = _timeit(
+        lambda: var.isel(x=nx // 2, y=ny // 2).values, repeat)
+    results['read_window_all_bands'] = _timeit(
+        lambda: var.isel(x=slice(nx // 2, nx // 2 + 64),
+                         y=slice(ny // 2, ny // 2 + 64)).values, repeat)
+    rgb = hsman.open_dataset('BENCH01-A_RGB', mode='rgb')
+    results['read_rgb_window'] = _timeit(
+        lambda: rgb.isel(x=slice(0, 512), y=slice(0, 512)).values, repeat)
+    return results
+
+
+def compare_results(old, new, threshold=0.1):
+    """
+    Returns the benchmarks that are slower in `new` by more than threshold
+
+    Returns
+    -------
+    regressions : dict
+        benchmark name to slowdown ratio (new/old)
+    """
+    if old.get('params') != new.get('params'):
+        click.echo('Warning: benchmark parameters differ between results')
+    out = {}
+    for name, r in new['results'].items():
+        try:
+            ratio = r['seconds'] / old['results'][name]['seconds']
+        except (KeyError, ZeroDivisionError):
+            continue
+        if ratio > 1 + threshold:
+            out[name] = ratio
+    return out
+
+
+def _timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'seconds': min(times), 'all_seconds': times}
+
+
+def _isolate_store(workdir):
+    # point hsman at a config with a store and scratch inside workdir
+    home = os.path.join(workdir, 'HOME')
+    os.makedirs(os.path.join(home, '.hsman'), exist_ok=True)
+    default = os.path.join(HERE, '..', '..', 'hsman', 'default_config.yaml')
+    with open(default) as f:
+        config = yaml.safe_load(f)
+    config['hsman_data_path'] = os.path.join(workdir, 'STORE')
+    config['scratch_directory'] = [os.path.join(workdir, 'SCRATCH')]
+    with open(os.path.join(home, '.hsman', 'config.yaml'), 'w') as f:
+        yaml.dump(config, f)
+    os.makedirs(config['hsman_data_path'], exist_ok=True)
+    os.environ['HOME'] = home
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('hsman')
+    except Exception:
+        return 'dev'
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Synthetic data generators for the benchmark suite
+"""
+import math
+import os
+import numpy as np
+
+CRS_WKT = ('PROJCS["WGS_1984_UTM_Zone_30N",GEOGCS["GCS_WGS_1984",'
+           'DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+           'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],'
+           'PROJECTION["Transverse_Mercator"],'
+           'PARAMETER["False_Easting",500000.0],'
+           'PARAMETER["False_Northing",0.0],'
+           'PARAMETER["Central_Meridian",-3.0],'
+           'PARAMETER["Scale_Factor",0.9996],'
+           'PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]')
+
+ENVI_DTYPES = {'uint8': 1, 'int16': 2, 'int32': 3, 'float32': 4,
+               'float64': 5, 'uint16': 12}
+
+
+def generate_flightlines(dst, n_flightlines=2, samples=100, lines=200,
+                         bands=186, overlap=0.2, rotation=35.0,
+                         pixel_size=0.32, interleave='bsq', dtype='uint16',
+                         mission='BENCH-A-20220101', flag='VNIR_bench',
+                         seed=0):
+    """
+    Write rotated ENVI flightlines (.img + .hdr) side by side across track.
+
+    Parameters
+    ----------
+    dst : path-like
+        output directory
+    n_flightlines : int
+        number of flightlines
+    samples, lines, bands : int
+        size of each flightline (cross-track, along-track, spectral)
+    overlap : float
+        fraction of each swath overlapping the next
+    rotation : float
+        map info rotation in degrees
+    pixel_size : float
+        ground sample distance in metres
+    interleave : str
+        one of bsq, bil, bip
+    dtype : str
+        numpy dtype name
+    mission : str
+        mission prefix of the file names
+    flag : str
+        data flag included in the file names
+    seed : int
+        random seed for the synthetic spectra
+
+    Returns
+    -------
+    paths : list
+        paths of the .img files
+    """
+    rng = np.random.default_rng(seed)
+    wavelengths = np.linspace(400, 1000, bands)
+    # a smooth vegetation-like spectrum with a red edge
+    base = 1000 + 3000 / (1 + np.exp(-(wavelengths - 715) / 15))
+    # next swath starts along the cross-track direction
+    cos_a = math.cos(math.radians(rotation))
+    sin_a = math.sin(math.radians(rotation))
+    step = samples * (1 - overlap) * pixel_size
+    x0, y0 = 656430.406, 5767668.630
+
+    paths = []
+    for i in range(n_flightlines):
+        name = f'{mission}_{flag}_{i:03d}'
+        img_path = os.path.join(dst, name + '.img')
+        hdr_path = os.path.join(dst, name + '.hdr')
+        easting = x0 + i * step * cos_a
+        northing = y0 + i * step * sin_a
+        _write_envi_image(img_path, samples, lines, bands, interleave,
+                          dtype, base, rng)
+        _write_envi_header(hdr_path, samples, lines, bands, interleave,
+                           dtype, wavelengths, easting, northing,
+                           pixel_size, rotation)
+        paths.append(img_path)
+    return paths
+
+
+def generate_image(dst, width=2000, height=2000, count=3, dtype='uint8',
+                   tiled=False, name='BENCH-A-20220101_IXA180_mos.tif',
+                   seed=0):
+    """
+    Write a striped (untiled) GeoTIFF like a delivered orthomosaic.
+
+    Returns
+    -------
+    path : str
+        path of the GeoTIFF
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    fpath = os.path.join(dst, name)
+    profile = {'driver': 'GTiff', 'width': width, 'height': height,
+               'count': count, 'dtype': dtype, 'crs': 'epsg:32630',
+               'transform': from_origin(656430.0, 5767668.0, 0.05, 0.05),
+               'tiled': tiled}
+    with rasterio.open(fpath, 'w', **profile) as f:
+        block = 256
+        for row in range(0, height, block):
+            h = min(block, height - row)
+            data = rng.integers(0, 255, (count, h, width)).astype(dtype)
+            f.write(data, window=((row, row + h), (0, width)))
+    return fpath
+
+
+def _write_envi_image(fpath, samples, lines, bands, interleave, dtype,
+                      base, rng):
+    # write in blocks of lines so memory stays bounded at any size
+    shape = {'bsq': (bands, lines, samples),
+             'bil': (lines, bands, samples),
+             'bip': (lines, samples, bands)}[interleave]
+    out = np.memmap(fpath, dtype=np.dtype(dtype).newbyteorder('<'),
+                    mode='w+', shape=shape)
+    block = 256
+    for row in range(0, lines, block):
+        h = min(block, lines - row)
+        # (bands, h, samples) cube with spatial texture
+        scale = rng.uniform(0.5, 1.5, (1, h, samples))
+        cube = (base[:, None, None] * scale).astype(dtype)
+        if interleave == 'bsq':
+            out[:, row:row + h, :] = cube
+        elif interleave == 'bil':
+            out[row:row + h] = cube.transpose(1, 0, 2)
+        else:
+            out[row:row + h] = cube.transpose(1, 2, 0)
+    out.flush()
+    del out
+
+
+def _write_envi_header(fpath, samples, lines, bands, interleave, dtype,
+                       wavelengths, easting, northing, pixel_size, rotation):
+    wl = ', '.join(['{:.6f}'.format(x) for x in wavelengths])
+    bn = ', '.join(['Band {:03d}({:.5f})'.format(i + 1, x)
+                    for i, x in enumerate(wavelengths)])
+    text = [
+        'ENVI',
+        'description = {Synthetic hsman benchmark flightline}',
+        f'samples = {samples}',
+        f'lines   = {lines}',
+        f'bands   = {bands}',
+        f'data type = {ENVI_DTYPES[dtype]}',
+        f'interleave = {interleave}',
+        'file type = ENVI Standard',
+        'header offset = 0',
+        'byte order = 0',
+        (f'map info = {{UTM, 1.000, 1.000, {easting:.3f}, {northing:.3f}, '
+         f'{pixel_size:e}, {pixel_size:e}, 30, North, WGS-84, units=Meters, '
+         f'rotation={rotation:.6f}}}'),
+        f'coordinate system string = {{{CRS_WKT}}}',
+        f'band names = {{{bn}}}',
+        f'wavelength = {{{wl}}}',
+        'wavelength units = Nanometers',
+        'reflectance scale factor = 10000.000000',
+        'data ignore value = 0.000000e+00',
+        'acquisition date = 2022-01-01',
+        'acquisition start time = 11:58:45',
+        'solar zenith = 30.9',
+    ]
+    with open(fpath, 'w') as f:
+        f.write('\n'.join(text) + '\n')
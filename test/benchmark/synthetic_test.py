@@ -0,0 +1,32 @@
+from synthetic import generate_flightlines, generate_image
+from hsman.ingest import _get_common_idx, _get_file_metadata
+import numpy as np
+import rasterio
+
+
+def test_generate_flightlines(tmp_path):
+    paths = generate_flightlines(tmp_path, n_flightlines=3, samples=20,
+                                 lines=30, bands=8, interleave='bil')
+    records = _get_file_metadata(paths)
+    assert [x.interleave for x in records] == ['bil'] * 3
+    assert records[0].bands == 8
+    idx, wl = _get_common_idx(records)
+    assert idx.shape == (3, 8)
+    # overlapping swaths are offset across track
+    assert records[1].geotransform[0] > records[0].geotransform[0]
+
+
+def test_generate_flightlines_interleave(tmp_path):
+    bsq, = generate_flightlines(tmp_path, 1, 20, 30, 8, interleave='bsq',
+                                flag='a')
+    bip, = generate_flightlines(tmp_path, 1, 20, 30, 8, interleave='bip',
+                                flag='b')
+    with rasterio.open(bsq) as a, rasterio.open(bip) as b:
+        assert np.array_equal(a.read(), b.read())
+
+
+def test_generate_image(tmp_path):
+    fpath = generate_image(tmp_path, 300, 200)
+    with rasterio.open(fpath) as f:
+        assert f.shape == (200, 300)
+        assert f.count == 3
@@ -0,0 +1,165 @@
+from hsman import api
+from hsman.api import iter_tiles, _tile_blocks
+import numpy as np
+from pytest import importorskip
+
+from sample_data import generate_cube
+
+
+def _source(name):
+    # (band, y, x) array stored in 64 x 64 chunks, with a nodata corner
+    data = np.arange(4 * 300 * 200, dtype='u2').reshape(4, 300, 200) + 1
+    data[:, :100, :100] = 0
+    array = generate_cube(data, 1000., 2000., (1., -1.),
+                          wavelength=[450., 550., 650., 750.])
+    array = array.chunk({'band': 1, 'y': 64, 'x': 64})
+    array.encoding['chunksizes'] = (1, 64, 64)
+    return array, None
+
+
+def test_tile_blocks():
+    blocks = _tile_blocks((4, 300, 200), (64, 64), 32, 2, block_mb=0.1)
+    # whole chunks that cover the array once
+    covered = np.zeros((300, 200), int)
+    for r0, r1, c0, c1 in blocks:
+        assert r0 % 64 == 0 and c0 % 64 == 0
+        covered[r0:r1, c0:c1] += 1
+    assert (covered == 1).all()
+    # rows of contiguous files are read whole, in whole strides
+    blocks = _tile_blocks((4, 300, 200), (1, 200), 32, 2, block_mb=0.1)
+    assert all([b[2:] == (0, 200) for b in blocks])
+    assert blocks[0][:2] == (0, 96)
+    # blocks are whole chunks and whole strides
+    blocks = _tile_blocks((4, 1000, 700), (64, 64), 32, 2, block_mb=0.1,
+                          stride=40)
+    assert len(blocks) == 12
+    assert all([b[0] % 320 == 0 and b[2] % 320 == 0 for b in blocks])
+
+
+def test_iter_tiles(monkeypatch):
+    monkeypatch.setattr(api, '_cube_source', _source)
+    kwargs = dict(size=32, wavelengths=[550, 740], block_mb=0.1, workers=2,
+                  prefetch=2)
+    tiles = list(iter_tiles('TEST', shuffle=False, nodata_filter=None,
+                            **kwargs))
+    array = _source('TEST')[0]
+    # blocks of 192 (3 chunks) rows and columns. The rows give 6 + 3 tile
+    # positions and the 8 columns of the last block none
+    assert len(tiles) == 9 * 6
+    for tile in tiles[:5]:
+        expected = array.isel(band=[1, 3], y=slice(tile.row, tile.row + 32),
+                              x=slice(tile.col, tile.col + 32))
+        assert np.array_equal(tile.data, expected.values)
+        assert np.array_equal(tile.x, expected.x.values)
+        assert list(tile.wavelength) == [550, 750]
+
+    # the corner is nodata
+    filtered = list(iter_tiles('TEST', shuffle=False, **kwargs))
+    assert len(filtered) == len(tiles) - 9
+
+    # shuffling is reproducible and differs between epochs
+    def order(**kw):
+        return [(t.row, t.col) for t in iter_tiles('TEST', **kwargs, **kw)]
+    assert order(seed=1) == order(seed=1)
+    assert order(seed=1) != order(seed=1, epoch=1)
+    assert sorted(order(seed=1)) == sorted([(t.row, t.col)
+                                            for t in filtered])
+
+    # with a stride that is not a multiple of the chunks, the tiles are
+    # still one stride grid over the whole array
+    strided = iter_tiles('TEST', shuffle=False, nodata_filter=None,
+                         stride=40, **kwargs)
+    assert sorted([(t.row, t.col) for t in strided]) == \
+        [(r, c) for r in range(0, 269, 40) for c in range(0, 169, 40)]
+
+
+def _inventory():
+    # footprints of four datasets, as returned by get_datasets
+    import geopandas
+    import pandas as pd
+    from shapely.geometry import box
+    names = ['SITEA20200101_VNIR', 'SITEA20200101_SWIR',
+             'SITEB20210601_VNIR', 'SITEB20210601_RGB']
+    return geopandas.GeoDataFrame(
+        {'dataset': names,
+         'date': pd.to_datetime(['2020-01-01', '2020-01-01', '2021-06-01',
+                                 '2021-06-01'])},
+        geometry=[box(-3, 52, -2.9, 52.1), box(-3, 52, -2.9, 52.1),
+                  box(1, 50, 1.2, 50.1), box(1, 50, 1.2, 50.1)],
+        crs='epsg:4326')
+
+
+def _view_inventory(monkeypatch):
+    # patched inventory that counts its reads, and its version
+    calls = []
+    version = [0]
+
+    def get_datasets():
+        calls.append(1)
+        return _inventory()
+    monkeypatch.setattr(api, 'get_datasets', get_datasets)
+    monkeypatch.setattr(api, '_inventory_version', lambda: version[0])
+    monkeypatch.setattr(api, '_VIEW_CACHE', {})
+    return calls, version
+
+
+def test_view_layers(monkeypatch):
+    _view_inventory(monkeypatch)
+
+    def names(layers):
+        return sorted([p[2] for _, points in layers.values()
+                       for p in points])
+    assert len(names(api._view_layers())) == 4
+    layers = api._view_layers(bbox=(-3.5, 51.5, -2.5, 52.5))
+    assert sorted(layers) == ['SWIR', 'VNIR']
+    assert names(layers) == ['SITEA20200101_SWIR', 'SITEA20200101_VNIR']
+    assert names(api._view_layers(start='2021-01-01')) == \
+        ['SITEB20210601_RGB', 'SITEB20210601_VNIR']
+    assert names(api._view_layers(end='2020-12-31', types=['VNIR'])) == \
+        ['SITEA20200101_VNIR']
+    # centroids are [lat, lon, name]
+    lat, lon, _ = api._view_layers(types=['RGB'])['RGB'][1][0]
+    assert np.isclose(lat, 50.05) and np.isclose(lon, 1.1)
+
+
+def test_view_layers_escape(monkeypatch):
+    _view_inventory(monkeypatch)
+    inventory = _inventory()
+    inventory.loc[0, 'dataset'] = '<img src=x onerror=alert(1)>_VNIR'
+    monkeypatch.setattr(api, 'get_datasets', lambda: inventory)
+    points = api._view_layers(types=['VNIR'])['VNIR'][1]
+    assert sorted([p[2] for p in points]) == \
+        ['&lt;img src=x onerror=alert(1)&gt;_VNIR', 'SITEB20210601_VNIR']
+
+
+def test_view_cache(monkeypatch):
+    calls, version = _view_inventory(monkeypatch)
+    layers = api._view_layers(types=['VNIR'])
+    assert api._view_layers(types=['VNIR']) is layers
+    assert len(calls) == 1
+    # other filters or a new inventory version are recomputed
+    api._view_layers(types=['SWIR'])
+    assert len(calls) == 2
+    version[0] += 1
+    assert api._view_layers(types=['SWIR']) is not layers
+    assert len(calls) == 3
+    assert len(api._VIEW_CACHE) == 1
+
+
+def test_view_datasets(monkeypatch):
+    importorskip('folium')
+    from folium import GeoJson
+    from folium.plugins import FastMarkerCluster
+    _view_inventory(monkeypatch)
+    m = api.view_datasets(types=['VNIR', 'RGB'])
+    children = list(m._children.values())
+    footprints = [c for c in children if isinstance(c, GeoJson)]
+    clusters = [c for c in children if isinstance(c, FastMarkerCluster)]
+    # each type has a footprint layer and a cluster of its centroids
+    assert [c.layer_name for c in footprints] == ['Vis-NIR (Hyspex)',
+                                                 'RGB aerial']
+    assert [c.layer_name for c in clusters] == \
+        ['Vis-NIR (Hyspex) (centres)', 'RGB aerial (centres)']
+    assert sorted([row[2] for row in clusters[0].data]) == \
+        ['SITEA20200101_VNIR', 'SITEB20210601_VNIR']
+    assert len(footprints[1].data['features']) == 1
@@ -0,0 +1,73 @@
+from hsman import compress
+from hsman.compress import compress_bands, open_compressed, \
+    quantization_step
+from netCDF4 import Dataset
+from pytest import raises
+import numpy as np
+import os
+
+from sample_data import generate_band_files, generate_cube
+
+
+def _band_files(tmp_path, dtype='u2', n_bands=12, shape=(300, 200)):
+    # low rank spectra plus noise, with a nodata corner, in the layout of
+    # the ingested band files
+    rng = np.random.default_rng(0)
+    endmembers = rng.uniform(500, 4000, (3, n_bands))
+    abundance = rng.dirichlet(np.ones(3), shape)
+    data = abundance @ endmembers + rng.normal(0, 20, shape + (n_bands,))
+    data = np.moveaxis(data, -1, 0).astype(dtype)
+    data[:, :20, :30] = 0
+    cube = generate_cube(data, wavelength=400. + np.arange(n_bands))
+    return generate_band_files(tmp_path, cube, attrs={'sensor': 'TEST'}), data
+
+
+def test_compress_lossless(tmp_path):
+    paths, data = _band_files(tmp_path)
+    dst = os.path.join(tmp_path, 'TEST_pca.nc')
+    assert compress_bands(paths, dst, n_components=3,
+                          max_memory_mb=1) == 0
+    ds = open_compressed(dst, chunks={'band': 5})
+    assert ds.reflectance.dtype == data.dtype
+    assert ds.reflectance.attrs['sensor'] == 'TEST'
+    assert ds.rio.crs.to_epsg() == 32630
+    assert list(ds.wavelength.values) == [400 + i for i in range(12)]
+    with Dataset(paths[0]) as src:
+        assert np.array_equal(ds.y.values, src.variables['y'][:])
+    assert np.array_equal(ds.reflectance.values, data)
+    assert np.array_equal(ds.reflectance.isel(band=5).values, data[5])
+
+
+def test_compress_overflow(tmp_path, monkeypatch):
+    # types from the sample that are too narrow fall back to int32
+    paths, data = _band_files(tmp_path, n_bands=4)
+    dst = os.path.join(tmp_path, 'TEST_pca.nc')
+    monkeypatch.setattr(compress, '_int_type', lambda x: 'i1')
+    compress_bands(paths, dst, n_components=2)
+    with Dataset(dst) as ds:
+        assert ds.variables['scores'].dtype == 'i4'
+    assert np.array_equal(open_compressed(dst).reflectance.values, data)
+
+
+def test_compress_lossy(tmp_path):
+    paths, data = _band_files(tmp_path)
+    lossless = os.path.join(tmp_path, 'lossless_pca.nc')
+    lossy = os.path.join(tmp_path, 'lossy_pca.nc')
+    compress_bands(paths, lossless, n_components=3)
+    assert compress_bands(paths, lossy, max_error=10, n_components=3) <= 10
+    out = open_compressed(lossy).reflectance.values
+    assert np.abs(out.astype('f8') - data).max() <= 10
+    assert (out[:, :20, :30] == 0).all()
+    assert os.path.getsize(lossy) < os.path.getsize(lossless) / 2
+
+
+def test_compress_float(tmp_path):
+    paths, data = _band_files(tmp_path, dtype='f4', n_bands=4)
+    dst = os.path.join(tmp_path, 'TEST_pca.nc')
+    with raises(ValueError):
+        compress_bands(paths, dst)
+    compress_bands(paths, dst, max_error=0.5)
+    out = open_compressed(dst).reflectance.values
+    assert np.abs(out - data).max() <= 0.5 + 1e-3
+    assert quantization_step('u2', 2.5) == 5
+    assert quantization_step('f4', 2.5) == 5.0
@@ -0,0 +1,36 @@
+from hsman.config import get_config
+import os
+import subprocess
+import sys
+
+
+def test_get_config_cache(tmp_path):
+    fpath = os.path.join(str(tmp_path), 'config.yaml')
+    with open(fpath, 'w') as f:
+        f.write('hsman_data_path: ~/a/\n')
+    a = get_config(fpath)
+    # returned copies can be changed without touching the cache
+    a['hsman_data_path'] = 'changed'
+    assert get_config(fpath)['hsman_data_path'] == '~/a/'
+    with open(fpath, 'w') as f:
+        f.write('hsman_data_path: ~/bb/\n')
+    assert get_config(fpath)['hsman_data_path'] == '~/bb/'
+
+
+def test_import_side_effects(tmp_path):
+    # importing must not read config, create files or load the api
+    code = ('import sys, hsman, hsman.config, hsman.scrape; '
+            'assert "hsman.api" not in sys.modules; '
+            'assert "geopandas" not in sys.modules')
+    env = dict(os.environ, HOME=str(tmp_path))
+    subprocess.run([sys.executable, '-c', code], check=True, env=env)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_lazy_submodules():
+    import hsman
+    modules = sorted([os.path.splitext(x)[0]
+                      for x in os.listdir(os.path.dirname(hsman.__file__))
+                      if x.endswith('.py') and not x.startswith('_')])
+    assert sorted(hsman._SUBMODULES) == modules
+    assert hsman.manifest.Manifest is not None
@@ -0,0 +1,86 @@
+from hsman import export, grid
+from hsman.export import export_datasets
+import numpy as np
+from pytest import importorskip
+import os
+import rasterio
+import rioxarray  # noqa: F401
+import xarray
+
+from sample_data import generate_cube
+
+# centre of the test dataset, in lon/lat
+LON, LAT = -7.47441, 0.01804
+
+
+def _source(name, chunks=None):
+    # (band, y, x) 2 m UTM dataset with 6 bands, in the requested chunks
+    data = np.arange(6 * 700 * 600, dtype='u2').reshape(6, 700, 600) + 1
+    array = generate_cube(data, 1001., 2699.,
+                          wavelength=400. + 100 * np.arange(6))
+    if chunks is not None:
+        array = array.chunk(chunks)
+    return array, rasterio.crs.CRS.from_epsg(32630)
+
+
+def test_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, '_cube_source', _source)
+    source = _source('TEST')[0]
+    nc, = export_datasets(tmp_path, ['TEST'], wavelengths=[510, 790],
+                          block_mb=1)
+    tif, = export_datasets(tmp_path, 'TEST', bands=[2, 5], format='gtiff',
+                           block_mb=1)
+    assert sorted(os.listdir(tmp_path)) == ['TEST.nc', 'TEST.tif']
+    expected = source.sel(band=[2, 5]).values
+
+    with xarray.open_dataset(nc, mask_and_scale=False) as ds:
+        assert ds.rio.crs.to_epsg() == 32630
+        assert list(ds.wavelength.values) == [500, 800]
+        assert np.array_equal(ds.reflectance.values, expected)
+        assert ds.reflectance.encoding['zlib']
+    with rasterio.open(tif) as src:
+        assert src.block_shapes[0] == (512, 512)
+        assert src.compression.value == 'DEFLATE'
+        assert src.descriptions == ('500 nm', '800 nm')
+        assert src.transform.c == 1000 and src.transform.f == 2700
+        assert np.array_equal(src.read(), expected)
+
+
+def test_export_subset(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, '_cube_source', _source)
+    monkeypatch.setattr(grid, 'grid_cache_path', lambda: tmp_path / 'cache')
+    source = _source('TEST')[0]
+    bbox = (LON - 0.001, LAT - 0.001, LON + 0.001, LAT + 0.001)
+    clipped = export.export_array('TEST', bbox=bbox)
+    # about 220 m, at 2 m pixels
+    assert 105 < clipped.sizes['x'] < 115 and 105 < clipped.sizes['y'] < 115
+    x0 = int(np.flatnonzero(source.x == clipped.x[0])[0])
+    y0 = int(np.flatnonzero(source.y == clipped.y[0])[0])
+    assert np.array_equal(clipped.values, source.isel(
+        y=slice(y0, y0 + clipped.sizes['y']),
+        x=slice(x0, x0 + clipped.sizes['x'])).values)
+
+    path, = export_datasets(tmp_path / 'out', ['TEST'], bbox=bbox,
+                            resolution=4, bands=[1], format='gtiff')
+    with rasterio.open(path) as src:
+        assert src.res == (4, 4)
+        assert src.transform.c % 4 == 0
+        data = src.read(1)
+    assert 50 < data.shape[1] < 60
+    assert (data > 0).all()
+
+
+def test_export_zarr(tmp_path, monkeypatch):
+    importorskip('zarr')
+    monkeypatch.setattr(export, '_cube_source', _source)
+    source = _source('TEST')[0]
+    for _ in range(2):
+        # a second export replaces the first
+        path, = export_datasets(tmp_path, 'TEST', bands=[3], format='zarr',
+                                block_mb=1)
+    assert os.listdir(tmp_path) == ['TEST.zarr']
+    with xarray.open_zarr(path, mask_and_scale=False) as ds:
+        assert ds.reflectance.encoding['chunks'] == (1, 512, 512)
+        assert ds.rio.crs.to_epsg() == 32630
+        assert np.array_equal(ds.reflectance.values,
+                              source.sel(band=[3]).values)
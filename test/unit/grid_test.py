@@ -0,0 +1,82 @@
+from hsman import grid as _grid
+from hsman.grid import target_grid, index_maps, regrid, source_bounds
+import numpy as np
+import os
+
+from sample_data import generate_cube
+
+
+def _source():
+    # 10 x 8 source at 2 m with y ascending, as written by the netCDF driver
+    data = np.arange(80, dtype='f4').reshape(1, 10, 8)
+    return generate_cube(data, 1001., 1981., (2., 2.))
+
+
+def test_target_grid():
+    grid = target_grid((1001, 1981, 1017, 1999), 'epsg:32630', 4)
+    assert grid.bounds == (1000, 1980, 1020, 2000)
+    assert (grid.width, grid.height) == (5, 5)
+    assert grid.x[0] == 1002 and grid.y[0] == 1998
+
+
+def test_index_maps(tmp_path):
+    source = _source()
+    bounds = source_bounds(source.x.values, source.y.values)
+    assert bounds == (1000, 1980, 1016, 2000)
+    grid = target_grid(bounds, 'epsg:32630', 4)
+    rows, cols = index_maps('TEST', source.x.values, source.y.values,
+                            'epsg:32630', grid, cache_dir=tmp_path)
+    assert rows.ndim == 1 and cols.ndim == 1
+    # target pixel centres fall between source pixels and round up
+    assert list(cols) == [1, 3, 5, 7]
+    assert list(rows) == [9, 7, 5, 3, 1]
+    assert len(os.listdir(tmp_path)) == 1
+    # cached maps are returned for the same grids
+    cached = index_maps('TEST', source.x.values, source.y.values,
+                        'epsg:32630', grid, cache_dir=tmp_path)
+    assert np.array_equal(cached[0], rows)
+
+    out = regrid(source, rows, cols, grid)
+    assert out.shape == (1, 5, 4)
+    assert out.values[0, 0, 0] == source.values[0, 9, 1]
+    assert np.array_equal(out.y, grid.y)
+
+
+def test_index_maps_reprojected(tmp_path):
+    source = _source()
+    # the source is near x=-672730, y=2017 in the neighbouring UTM zone
+    grid = target_grid((-672750, 2000, -672710, 2040), 'epsg:32631', 2)
+    rows, cols = index_maps('TEST', source.x.values, source.y.values,
+                            'epsg:32630', grid, cache_dir=tmp_path)
+    assert rows.shape == cols.shape == (grid.height, grid.width)
+    assert ((rows < 0) == (cols < 0)).all()
+    assert 0 < (rows >= 0).sum() < rows.size
+    out = regrid(source, rows, cols, grid)
+    assert np.isnan(out.values[:, rows < 0]).all()
+    assert np.array_equal(out.values[0][rows >= 0],
+                          source.values[0][rows[rows >= 0],
+                                           cols[cols >= 0]])
+
+
+def test_index_maps_read_only(tmp_path, monkeypatch):
+    # maps are cached in scratch if the store cache cannot be written, and
+    # not cached at all if nothing can be
+    source = _source()
+    grid = target_grid((1000, 1980, 1016, 2000), 'epsg:32630', 4)
+    (tmp_path / 'store').write_text('not a directory')
+    monkeypatch.setattr(_grid, 'grid_cache_path',
+                        lambda: str(tmp_path / 'store' / 'grids'))
+    monkeypatch.setattr(_grid, 'get_scratch_path',
+                        lambda: str(tmp_path / 'scratch'))
+    rows, cols = index_maps('TEST', source.x.values, source.y.values,
+                            'epsg:32630', grid)
+    assert len(os.listdir(tmp_path / 'scratch' / 'grids')) == 1
+    cached = index_maps('TEST', source.x.values, source.y.values,
+                        'epsg:32630', grid)
+    assert np.array_equal(cached[0], rows)
+
+    monkeypatch.setattr(_grid, 'get_scratch_path',
+                        lambda: str(tmp_path / 'store'))
+    uncached = index_maps('TEST', source.x.values, source.y.values,
+                          'epsg:32630', grid)
+    assert np.array_equal(uncached[1], cols)
@@ -1,12 +1,24 @@
 from hsman.ingest import _get_common_idx, _make_dataset_folder, \
 _get_collect_time, _unrotate_hsi, _get_other_metadata, _merge_band, \
-ingest_hsi, ingest_image
+ingest_hsi, ingest_image, _get_file_metadata, _read_gdal_metadata, \
+_transfer_file, _mosaic_band, _select_bands, _average_bands, \
+_deinterleave_envi, enqueue_hsi, enqueue_image, _transfer_copies, \
+JOB_HANDLERS
+from hsman.workqueue import WorkQueue, run_worker
 
-from sample_data import generate_rotated_raster, generate_tif
+from sample_data import generate_rotated_raster, generate_tif, \
+    generate_band_files, generate_cube
 import datetime
+import json
+import time
+import numpy as np
+import rasterio
 import xarray
 import os
-from pytest import raises
+import shutil
+from pytest import mark, raises
+from rasterio.transform import from_origin
+from types import SimpleNamespace
 
 
 def test_get_common_idx(tmp_path):
@@ -89,6 +101,306 @@ def test_ingest_hsi(tmp_path):
     assert oct(status.st_mode)[-3:] == '555'
 
 
+def test_enqueue_hsi(tmp_path):
+    ds1 = generate_rotated_raster(tmp_path, True)
+    ds2 = generate_rotated_raster(tmp_path, False)
+    queue = WorkQueue(os.path.join(tmp_path, 'queue.sqlite'))
+    dst = enqueue_hsi(queue, [ds1, ds2], 'TEST01', bin_factor=2)
+    assert os.path.exists(os.path.join(dst, 'DATA'))
+    assert queue.counts()['pending'] == 5
+    job = queue.claim('test')
+    assert job.kind == 'hsi_prepare' and job.group == dst
+    queue.complete(job, 'test', {'paths': job.payload['paths']})
+    job = queue.claim('test')
+    assert job.kind == 'hsi_band' and job.payload['new_band'] == 1
+    # band indexes of each file, binned in pairs
+    assert len(job.payload['band']) == 2
+    assert len(job.payload['band'][0]) == 2
+    assert len(job.payload['metadata']['source_wavelengths']) == 2
+
+
+def _fake_merge_band(file_paths, dst, band, meta, new_band_wavelength,
+                     new_band_index=None, profiler=None, mosaic=None,
+                     stats=None):
+    # a band file like _merge_band's, without the GDAL command line tools
+    data = np.full((1, 20, 10), 100 * new_band_index, 'u2')
+    cube = generate_cube(data, bands=[new_band_index],
+                         wavelength=[new_band_wavelength])
+    fpath, = generate_band_files(dst, cube)
+    stats.update(data[0])
+    return fpath
+
+
+def test_distributed_hsi(tmp_path, monkeypatch):
+    from hsman import ingest
+    from hsman.manifest import Manifest
+    from hsman.stats import read_band_stats
+    monkeypatch.setattr(ingest, '_merge_band', _fake_merge_band)
+    ds1 = generate_rotated_raster(tmp_path, True)
+    queue = WorkQueue(os.path.join(tmp_path, 'queue.sqlite'), lease=0.5)
+    dst = enqueue_hsi(queue, [ds1], 'TEST01')
+    dst_pca = enqueue_hsi(queue, [ds1], 'TEST02', store={'mode': 'pca'})
+    work_dir = queue.claim('test').payload['work_dir']
+    # the claimed job's lease expires and it is run again
+    time.sleep(0.6)
+    assert run_worker(queue, JOB_HANDLERS) == 10
+    assert queue.counts()['done'] == 10
+
+    assert sorted(os.listdir(os.path.join(dst, 'DATA'))) == \
+        ['band_1_merged.nc', 'band_2_merged.nc', 'band_3_merged.nc']
+    assert len(Manifest.load(dst).files) == 3
+    assert read_band_stats(dst)[2]['mean'] == 200
+    fname = os.path.basename(dst_pca) + '_pca.nc'
+    assert os.listdir(os.path.join(dst_pca, 'DATA')) == [fname]
+    assert list(Manifest.load(dst_pca).files) == [f'DATA/{fname}']
+    assert oct(os.stat(dst).st_mode)[-3:] == '555'
+    assert not os.path.exists(work_dir)
+
+
+def test_enqueue_image(tmp_path):
+    ds = generate_tif(tmp_path)
+    queue = WorkQueue(os.path.join(tmp_path, 'queue.sqlite'))
+    enqueue_image(queue, ds, 'TEST01', transfer_mode='copy')
+    assert run_worker(queue, JOB_HANDLERS) == 1
+    dst = queue.results('image:TEST01')[0]['result']['dataset']
+    assert os.listdir(os.path.join(dst, 'DATA')) == ['test.tif']
+
+
 def test_ingest_image(tmp_path):
+    from hsman.ingest import _image_stats
+    from hsman.stats import read_band_stats
     ds = generate_tif(tmp_path)
     ingest_image(ds, 'TEST01')
+    # statistics are read before the source is moved into the store
+    ds = generate_tif(tmp_path)
+    dst = ingest_image(ds, 'TEST02', transfer_mode='move', profile=True)
+    assert not os.path.exists(ds)
+    stored = _image_stats(os.path.join(dst, 'DATA', 'test.tif'))
+    assert read_band_stats(dst) == {k: json.loads(json.dumps(v))
+                                    for k, v in stored.items()}
+
+
+@mark.skipif(shutil.which('gdal_translate') is None,
+             reason='needs the GDAL command line tools')
+def test_ingest_image_cog(tmp_path):
+    ds = generate_tif(tmp_path)
+    dst = ingest_image(ds, 'TEST01', image_format='cog')
+    with rasterio.open(os.path.join(dst, 'DATA', 'test.tif')) as f:
+        assert f.profile['tiled']
+        assert f.profile['compress'] == 'deflate'
+
+
+def test_convert_to_cog(tmp_path, monkeypatch):
+    # the fallback is only used without the COG driver, and a failed
+    # conversion leaves no partial output
+    import subprocess
+    from hsman import ingest
+    commands = []
+    has_cog = [True]
+
+    def run(command, record=None):
+        commands.append(command)
+        with open(command[-1], 'w') as f:
+            f.write('partial')
+        if fail:
+            raise subprocess.CalledProcessError(1, command)
+    monkeypatch.setattr(ingest, 'run_command', run)
+    monkeypatch.setattr(ingest, '_gdal_has_driver', lambda x: has_cog[0])
+    monkeypatch.setattr(ingest, 'get_scratch_path',
+                        lambda: str(tmp_path / 'scratch'))
+    for x in ['src', 'out', 'scratch']:
+        os.makedirs(tmp_path / x)
+    src = generate_tif(tmp_path / 'src')
+    dst = str(tmp_path / 'out' / 'out.tif')
+    fail = True
+    with raises(subprocess.CalledProcessError):
+        ingest._convert_to_cog(src, dst)
+    assert os.listdir(tmp_path / 'out') == []
+    assert [c[2] for c in commands] == ['COG']
+
+    has_cog[0] = False
+    fail = False
+    commands.clear()
+    assert ingest._convert_to_cog(src, dst) == dst
+    assert os.listdir(tmp_path / 'out') == ['out.tif']
+    assert os.listdir(tmp_path / 'scratch') == []
+    assert [c[0] for c in commands] == ['gdal_translate', 'gdaladdo',
+                                        'gdal_translate']
+    # the overviews are copied in front of the compressed tiles
+    assert 'COPY_SRC_OVERVIEWS=YES' in commands[2]
+    assert 'PREDICTOR=2' in commands[2]
+
+
+def test_gdal_has_driver(monkeypatch):
+    from hsman import ingest
+    formats = 'Supported Formats:\n  COG -raster- (wv): COG generator\n' \
+        '  GTiff -raster- (rw+vs): GeoTIFF\n'
+    monkeypatch.setattr(ingest.subprocess, 'run',
+                        lambda *a, **kw: SimpleNamespace(stdout=formats))
+    ingest._gdal_has_driver.cache_clear()
+    try:
+        assert ingest._gdal_has_driver('COG')
+        assert ingest._gdal_has_driver('GTiff')
+        assert not ingest._gdal_has_driver('Zarr')
+    finally:
+        ingest._gdal_has_driver.cache_clear()
+
+
+def test_get_file_metadata(tmp_path):
+    rpath = generate_rotated_raster(tmp_path, True)
+    a, = _get_file_metadata([rpath])
+    b = _read_gdal_metadata(rpath)
+    assert a.bands == len(a.wavelengths) == 182
+    assert a.interleave == 'bsq'
+    assert a.crs == b.crs
+    assert a.tags == b.tags
+    assert a.acquisition_time == datetime.datetime(2015, 7, 17, 11, 58, 45)
+    assert np.allclose(a.geotransform, b.geotransform)
+    assert np.allclose(a.wavelengths, b.wavelengths)
+
+
+def test_transfer_file(tmp_path):
+    src = generate_tif(tmp_path)
+    for mode in ['copy', 'hardlink', 'reflink', 'auto']:
+        dst = os.path.join(tmp_path, f'{mode}.tif')
+        used = _transfer_file(src, dst, mode)
+        assert used in [mode, 'copy', 'reflink']
+        with open(src, 'rb') as a, open(dst, 'rb') as b:
+            assert a.read() == b.read()
+    assert _transfer_file(src, os.path.join(tmp_path, 'moved.tif'),
+                          'move') == 'move'
+    assert not os.path.exists(src)
+    with raises(ValueError):
+        _transfer_file(src, os.path.join(tmp_path, 'x.tif'), 'symlink')
+
+
+def test_transfer_copies(tmp_path, monkeypatch):
+    scratch = os.path.join(tmp_path, 'scratch')
+    os.mkdir(scratch)
+    store = os.path.join(tmp_path, 'store', 'not_yet_created')
+    assert not _transfer_copies(scratch, store, 'move')
+    assert not _transfer_copies(scratch, store, 'auto')
+    assert _transfer_copies(scratch, store, 'copy')
+
+    # a store on another filesystem
+    stat = os.stat
+    def fake_stat(path, *args, **kwargs):
+        st = stat(path, *args, **kwargs)
+        if path == scratch:
+            return SimpleNamespace(st_dev=st.st_dev + 1)
+        return st
+    monkeypatch.setattr(os, 'stat', fake_stat)
+    assert _transfer_copies(scratch, store, 'move')
+    assert _transfer_copies(scratch, store, 'hardlink')
+
+
+def test_mosaic_band(tmp_path):
+    # two 20x30 flightlines overlapping by 10 columns
+    paths = []
+    for i, value in enumerate([10, 30]):
+        fpath = os.path.join(tmp_path, f'{i}.tif')
+        with rasterio.open(fpath, 'w', driver='GTiff', width=30, height=20,
+                           count=1, dtype='uint16', crs='epsg:32630',
+                           transform=from_origin(1000 + 40 * i, 2000 - 20 * i,
+                                                 2, 2)) as f:
+            f.write(np.full((20, 30), value, 'u2'), 1)
+        paths.append(fpath)
+    records = [SimpleNamespace(geotransform=[1000 + 40 * i, 2, 0,
+                                             2000 - 20 * i, 0, -2],
+                               samples=30) for i in range(2)]
+    expected = {'first': [10] * 10,
+                'last': [30] * 10,
+                'mean': [20] * 10,
+                'min-angle': [10] * 5 + [30] * 5}
+    for overlap, values in expected.items():
+        out = _mosaic_band(paths, os.path.join(tmp_path, f'{overlap}.nc'),
+                           overlap=overlap, max_memory_mb=1, records=records)
+        with rasterio.open(out) as f:
+            assert f.shape == (30, 50)
+            assert f.transform == from_origin(1000, 2000, 2, 2)
+            data = f.read(1)
+        assert (data[15, 20:30] == values).all()
+        assert (data[5, :30] == 10).all() and (data[5, 30:] == 0).all()
+        assert (data[25, 40:] == 30).all()
+    with raises(ValueError):
+        _mosaic_band(paths, os.path.join(tmp_path, 'x.nc'), overlap='max')
+
+
+def test_select_bands():
+    wavelengths = np.arange(400, 420, 2.)
+    band_idxs = np.array([np.arange(1, 11), np.arange(3, 13)])
+    idxs, wl, src = _select_bands(band_idxs, wavelengths, [402, 416],
+                                  [[408, 410]])
+    assert list(wl) == [402, 404, 406, 412, 414, 416]
+    assert list(idxs[1]) == [4, 5, 6, 9, 10, 11]
+    # bins never span the excluded range, leftovers are dropped
+    idxs, wl, src = _select_bands(band_idxs, wavelengths, [402, 416],
+                                  [[408, 410]], bin_factor=2)
+    assert idxs.shape == (2, 2, 2)
+    assert list(wl) == [403, 413]
+    assert src.tolist() == [[402, 404], [412, 414]]
+    with raises(ValueError):
+        _select_bands(band_idxs, wavelengths, [500, 600])
+
+
+def test_average_bands(tmp_path):
+    src = os.path.join(tmp_path, 'src.tif')
+    with rasterio.open(src, 'w', driver='GTiff', width=4, height=3, count=2,
+                       dtype='uint16', crs='epsg:32630',
+                       transform=from_origin(1000, 2000, 2, 2)) as f:
+        f.write(np.array([np.full((3, 4), 10), np.full((3, 4), 21)]))
+        f.write(np.zeros((1, 4), 'u2'), 2, window=((0, 1), (0, 4)))
+    dst = _average_bands(src, os.path.join(tmp_path, 'dst.tif'),
+                         block_size=2)
+    with rasterio.open(dst) as f:
+        assert f.count == 1
+        data = f.read(1)
+    assert (data[0] == 10).all()
+    assert (data[1:] == 16).all()
+
+
+def test_deinterleave_envi(tmp_path):
+    src = os.path.join(tmp_path, 'src.img')
+    data = np.arange(5 * 7 * 6, dtype='u2').reshape(5, 7, 6)
+    with rasterio.open(src, 'w', driver='ENVI', width=6, height=7, count=5,
+                       dtype='uint16', crs='epsg:32630', interleave='bil',
+                       transform=from_origin(1000, 2000, 2, 2)) as f:
+        f.write(data)
+        f.update_tags(ns='ENVI', wavelength='{400, 410, 420, 430, 440}')
+    record, = _get_file_metadata([src])
+    assert record.interleave == 'bil'
+    os.makedirs(os.path.join(tmp_path, 'out'))
+    new = _deinterleave_envi(record, os.path.join(tmp_path, 'out'),
+                             block_bytes=100)
+    assert new.interleave == 'bsq'
+    new_record, = _get_file_metadata([new.path])
+    assert new_record.interleave == 'bsq'
+    assert new_record.crs == record.crs
+    with rasterio.open(new.path) as f:
+        assert np.array_equal(f.read(), data)
+    # a file of the same name from another directory gets its own copy
+    os.makedirs(os.path.join(tmp_path, 'other'))
+    other = record._replace(path=os.path.join(tmp_path, 'other', 'src.img'))
+    shutil.copy(src, other.path)
+    shutil.copy(os.path.splitext(src)[0] + '.hdr',
+                os.path.splitext(other.path)[0] + '.hdr')
+    other_new = _deinterleave_envi(other, os.path.join(tmp_path, 'out'))
+    assert other_new.path != new.path
+    assert len(os.listdir(os.path.join(tmp_path, 'out'))) == 4
+
+    # only the selected bands are written, keeping their numbers
+    for interleave in ['bil', 'bip']:
+        sel = os.path.join(tmp_path, f'sel_{interleave}.img')
+        with rasterio.open(sel, 'w', driver='ENVI', width=6, height=7,
+                           count=5, dtype='uint16', crs='epsg:32630',
+                           interleave=interleave,
+                           transform=from_origin(1000, 2000, 2, 2)) as f:
+            f.write(data)
+            f.update_tags(ns='ENVI', wavelength='{400, 410, 420, 430, 440}')
+        record, = _get_file_metadata([sel])
+        new = _deinterleave_envi(record, os.path.join(tmp_path, 'out'),
+                                 bands=[4, 2, 2], block_bytes=100)
+        with rasterio.open(new.path) as f:
+            assert f.count == 5
+            assert np.array_equal(f.read([2, 4]), data[[1, 3]])
+            assert not f.read(1).any() and not f.read(5).any()
@@ -0,0 +1,82 @@
+from hsman import manifest as _manifest
+from hsman.manifest import Manifest, copy_and_hash, create_manifest, \
+hash_file, verify_datasets
+import hashlib
+import os
+
+
+def _make_dataset(root):
+    os.makedirs(os.path.join(root, 'DATA'))
+    os.makedirs(os.path.join(root, 'METADATA'))
+    for i in range(3):
+        with open(os.path.join(root, 'DATA', f'band_{i}.nc'), 'wb') as f:
+            f.write(os.urandom(1000 + i))
+    return root
+
+
+def test_copy_and_hash(tmp_path):
+    src = os.path.join(tmp_path, 'a')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(10000))
+    hasher = hashlib.sha256()
+    copy_and_hash(src, os.path.join(tmp_path, 'b'), hasher)
+    assert hasher.hexdigest() == hash_file(src)
+    assert hash_file(os.path.join(tmp_path, 'b')) == hash_file(src)
+
+
+def test_manifest_roundtrip(tmp_path):
+    root = _make_dataset(os.path.join(tmp_path, 'TEST01'))
+    manifest = create_manifest(root)
+    loaded = Manifest.load(root)
+    assert loaded.files == manifest.files
+    assert set(loaded.files) == {f'DATA/band_{i}.nc' for i in range(3)}
+
+
+def test_verify_touched(tmp_path, monkeypatch):
+    # a touched file is hashed once, then skipped by the quick check
+    root = _make_dataset(os.path.join(tmp_path, 'TEST01'))
+    create_manifest(root)
+    monkeypatch.setattr(_manifest, 'get_datasets', lambda: {'TEST01': root})
+    fpath = os.path.join(root, 'DATA', 'band_0.nc')
+    stat = os.stat(fpath)
+    os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert verify_datasets()['TEST01']['DATA/band_0.nc'] == 'ok'
+    entry = Manifest.load(root).files['DATA/band_0.nc']
+    assert entry['mtime_ns'] == stat.st_mtime_ns + 10 ** 9
+    assert verify_datasets()['TEST01']['DATA/band_0.nc'] == 'skipped'
+
+
+def test_verify_saves_updated(tmp_path, monkeypatch):
+    # only manifests with updated entries are written back
+    roots = {name: _make_dataset(os.path.join(tmp_path, name))
+             for name in ['TEST01', 'TEST02']}
+    for root in roots.values():
+        create_manifest(root)
+    monkeypatch.setattr(_manifest, 'get_datasets', lambda: roots)
+    saved = []
+    save = Manifest.save
+
+    def counting_save(self):
+        saved.append(self.dataset_path)
+        return save(self)
+    monkeypatch.setattr(Manifest, 'save', counting_save)
+    fpath = os.path.join(roots['TEST01'], 'DATA', 'band_0.nc')
+    stat = os.stat(fpath)
+    os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    verify_datasets()
+    assert saved == [roots['TEST01']]
+    saved.clear()
+    verify_datasets()
+    assert saved == []
+
+
+def test_verify_removed(tmp_path, monkeypatch):
+    # a file removed after the quick check is reported missing
+    root = _make_dataset(os.path.join(tmp_path, 'TEST01'))
+    create_manifest(root)
+    monkeypatch.setattr(_manifest, 'get_datasets', lambda: {'TEST01': root})
+    monkeypatch.setattr(_manifest, '_quick_check', lambda fpath, entry: None)
+    os.remove(os.path.join(root, 'DATA', 'band_1.nc'))
+    results = verify_datasets()['TEST01']
+    assert results['DATA/band_1.nc'] == 'missing'
+    assert results['DATA/band_0.nc'] == 'ok'
@@ -0,0 +1,73 @@
+from hsman.metrics import IngestProfiler, NullProfiler, run_command
+import json
+import numpy as np
+import os
+from pytest import raises
+import subprocess
+import sys
+import time
+
+
+def test_profiler_report(tmp_path):
+    profiler = IngestProfiler('TEST01')
+    profiler.n_bands = 2
+    profiler.input_bytes = 2000000
+    for band in np.arange(1, 3):
+        with profiler.stage('gdalwarp', band=band, flightline='a.img') as rec:
+            rec['bytes_written'] = 10
+    profiler.finish()
+    summary = profiler.summary()
+    assert summary['stages']['gdalwarp']['count'] == 2
+    assert summary['stages']['gdalwarp']['bytes_written'] == 20
+    assert summary['throughput_mb_per_s'] > 0
+
+    fpath = profiler.write_report(str(tmp_path))
+    with open(fpath) as f:
+        report = json.load(f)
+    assert len(report['records']) == 2
+    assert report['records'][0]['band'] == 1
+
+
+def test_profiler_peak_rss():
+    # peaks are measured per stage, also after a larger earlier peak
+    profiler = IngestProfiler('TEST01')
+    with profiler.stage('large'):
+        data = np.ones(2 ** 28, 'u1')
+        time.sleep(0.2)
+        del data
+    with profiler.stage('small') as rec:
+        data = np.ones(2 ** 26, 'u1')
+        time.sleep(0.2)
+        del data
+        # the child's own peak, not the largest of all children
+        command = [sys.executable, '-c',
+                   'import time; b = b"1" * 2 ** 27; time.sleep(0.2)']
+        run_command(command, rec)
+        run_command([sys.executable, '-c', 'pass'], rec)
+    large, small = profiler.records
+    assert large['peak_rss'] >= small['peak_rss'] + 2 ** 27
+    assert small['peak_rss'] >= 2 ** 26
+    assert 2 ** 27 <= small['child_peak_rss'] < 2 ** 28
+    assert large['child_peak_rss'] == 0
+    summary = profiler.summary()
+    assert summary['stages']['small']['peak_rss'] == small['peak_rss']
+    assert summary['peak_rss'] >= 2 ** 28
+    with raises(subprocess.CalledProcessError):
+        run_command([sys.executable, '-c', 'exit(3)'])
+
+
+def test_profiler_prometheus(tmp_path):
+    profiler = IngestProfiler('TEST01')
+    with profiler.stage('transfer'):
+        pass
+    fpath = profiler.write_prometheus(str(tmp_path))
+    assert os.path.basename(fpath) == 'hsman_ingest_TEST01.prom'
+    with open(fpath) as f:
+        text = f.read()
+    assert 'hsman_ingest_stage_seconds_total{dataset="TEST01",' \
+        'stage="transfer"}' in text
+
+
+def test_null_profiler():
+    with NullProfiler().stage('transfer') as rec:
+        rec['bytes_read'] = 1
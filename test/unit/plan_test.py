@@ -0,0 +1,52 @@
+from hsman.plan import update_calibration, estimate_seconds, \
+    load_calibration, format_plan, _hsi_grid
+from types import SimpleNamespace
+import math
+import os
+
+
+def test_calibration(tmp_path):
+    fpath = os.path.join(tmp_path, 'calibration.json')
+    assert load_calibration(fpath)['runs'] == 0
+    records = [{'stage': 'gdalwarp', 'wall_time': 2.0, 'bytes_read': 10 ** 6},
+               {'stage': 'gdalwarp', 'wall_time': 2.0, 'bytes_read': 10 ** 6},
+               {'stage': 'metadata', 'wall_time': 0.5}]
+    update_calibration(records, fpath)
+    calibration = load_calibration(fpath)
+    assert calibration['runs'] == 1
+    assert calibration['stages']['gdalwarp']['seconds_per_byte'] == 2e-6
+    assert estimate_seconds([('gdalwarp', 1, 10 ** 6), ('metadata', 2, 0)],
+                            calibration) == 3.0
+
+    # a slower run moves the rate part of the way
+    records[0]['wall_time'] = records[1]['wall_time'] = 4.0
+    calibration = update_calibration(records, fpath)
+    assert math.isclose(calibration['stages']['gdalwarp']['seconds_per_byte'],
+                        2.6e-6)
+    # uncalibrated stages use the defaults
+    assert estimate_seconds([('checksum', 1, 5 * 10 ** 8)], calibration) == 1
+
+
+def test_hsi_grid():
+    # 100 x 300 pixels at 0.32 m rotated by 35 degrees, as gdalwarp gives
+    # 254 x 303 pixels at 0.32 m
+    a = math.radians(35)
+    gt = (1000, 0.32 * math.cos(a), 0.32 * math.sin(a),
+          2000, 0.32 * math.sin(a), -0.32 * math.cos(a))
+    record = SimpleNamespace(geotransform=gt, samples=100, lines=300)
+    shifted = SimpleNamespace(geotransform=(gt[0] + 32,) + gt[1:],
+                              samples=100, lines=300)
+    width, height, warped = _hsi_grid([record, shifted])
+    assert warped == [(254, 303), (254, 303)]
+    assert (width, height) == (354, 303)
+
+
+def test_format_plan():
+    row = {'dataset': 'TEST01', 'n_files': 2, 'n_bands': 10,
+           'grid': (100, 200), 'input_bytes': 2 * 10 ** 9,
+           'scratch_bytes': 10 ** 6, 'store_bytes': 400000, 'seconds': 90}
+    text = format_plan([row, dict(row, dataset='TEST02')])
+    lines = text.splitlines()
+    assert len(lines) == 4
+    assert '100x200' in lines[1] and '1.5 min' in lines[1]
+    assert lines[-1].startswith('total') and '4.0 GB' in lines[-1]
@@ -0,0 +1,179 @@
+from hsman import processing
+from hsman.processing import band_depth, continuum_removed, savgol, \
+    savgol_matrix, vector_normalized, write_netcdf, match_spectra, \
+    similar_pixels, _hull_continuum, _similarity, _smallest
+import numpy as np
+import os
+import pandas as pd
+import rioxarray  # noqa: F401
+import xarray
+from pytest import raises
+
+from sample_data import generate_cube
+
+
+def _cube(n_bands=40, shape=(300, 200)):
+    # noisy spectra with an absorption feature at 1000 nm, unevenly spaced
+    # bands and a nodata corner
+    rng = np.random.default_rng(0)
+    wavelength = np.sort(rng.uniform(400, 2500, n_bands))
+    spectra = 3000 + wavelength - 1500 * np.exp(
+        -((wavelength - 1000) / 80) ** 2)
+    data = spectra[:, None, None] + rng.normal(0, 50, (n_bands,) + shape)
+    data = data.astype('u2')
+    data[:, :20, :30] = 0
+    return generate_cube(data, 1000., 2000., wavelength=wavelength,
+                         crs=32630)
+
+
+def _hull(x, y):
+    # upper hull of one spectrum
+    hull = []
+    for p in zip(x, y):
+        while len(hull) > 1 and (hull[-1][0] - hull[-2][0]) * \
+                (p[1] - hull[-2][1]) >= (hull[-1][1] - hull[-2][1]) * \
+                (p[0] - hull[-2][0]):
+            hull.pop()
+        hull.append(p)
+    return np.interp(x, *zip(*hull))
+
+
+def test_hull_continuum():
+    rng = np.random.default_rng(1)
+    x = np.sort(rng.uniform(400, 2500, 50))
+    y = rng.uniform(0, 1, (200, 50))
+    continuum = _hull_continuum(x, y)
+    expected = np.array([_hull(x, row) for row in y])
+    assert np.allclose(continuum, expected)
+
+
+def test_savgol_matrix():
+    # fits reproduce polynomials of their order, at the ends as well
+    wavelength = np.sort(np.random.default_rng(2).uniform(400, 2500, 30))
+    x = wavelength / 1000
+    cubic = x ** 3 - 2 * x
+    assert np.allclose(savgol_matrix(wavelength, 7, 3) @ cubic, cubic)
+    slope = savgol_matrix(wavelength, 7, 3, deriv=1) @ cubic
+    assert np.allclose(slope, (3 * x ** 2 - 2) / 1000)
+
+
+def test_kernels(tmp_path):
+    array = _cube()
+    removed = continuum_removed(array, chunk_mb=1)
+    assert removed.chunks[0] == (40,)
+    assert len(removed.chunks[1]) > 1
+    values = removed.values
+    assert removed.dtype == 'f4'
+    assert np.isnan(values[:, :20, :30]).all()
+    assert not np.isnan(values[:, 20:, 30:]).any()
+    assert np.nanmax(values) == 1
+    assert list(removed.wavelength.values) == list(array.wavelength.values)
+
+    depth = band_depth(array, 1000).values
+    shoulders = band_depth(array, 1000, 800, 1300).values
+    assert 0.25 < np.nanmean(depth) < 0.5
+    assert 0.25 < np.nanmean(shoulders) < 0.5
+    assert np.isnan(depth[:20, :30]).all()
+
+    norm = (vector_normalized(array) ** 2).sum('band', skipna=False)
+    assert np.allclose(norm.values[20:, 30:], 1)
+    smooth = savgol(array, 9, 2)
+    assert smooth.std('band').mean() < array.std('band').mean()
+
+    fpath = os.path.join(tmp_path, 'removed.nc')
+    assert write_netcdf(removed, fpath, workers=2, prefetch=2) == fpath
+    assert os.listdir(tmp_path) == ['removed.nc']
+    out = xarray.open_dataset(fpath)
+    assert out.rio.crs.to_epsg() == 32630
+    assert np.array_equal(out.continuum_removed.values, values,
+                          equal_nan=True)
+    assert np.array_equal(out.wavelength.values, array.wavelength.values)
+
+
+def test_dataset_chunks(monkeypatch):
+    # datasets are opened in chunks of whole spectra of about chunk_mb
+    opened = []
+
+    def source(name, chunks=None):
+        opened.append(chunks)
+        array = _cube().chunk({'band': 1})
+        array.encoding['chunksizes'] = (1, 16, 16)
+        return array, array.rio.crs
+    monkeypatch.setattr(processing, '_cube_source', source)
+    removed = continuum_removed('TEST', chunk_mb=0.5)
+    assert opened == [None, {'band': -1, 'y': 48, 'x': 48}]
+    assert removed.chunks[1][0] == removed.chunks[2][0] == 48
+    assert removed.rio.crs.to_epsg() == 32630
+
+
+def _library(n_spectra=6):
+    # smooth random spectra on a finer grid than the cube
+    rng = np.random.default_rng(3)
+    wavelength = np.linspace(350, 2600, 400)
+    return {f'S{i}': (wavelength, rng.uniform(0.1, 1, 400).cumsum() / 200)
+            for i in range(n_spectra)}
+
+
+def test_similarity():
+    rng = np.random.default_rng(4)
+    x = rng.uniform(0.1, 1, (5, 20))
+    s = rng.uniform(0.1, 1, (3, 20))
+    for i in range(5):
+        for j in range(3):
+            a, b = x[i], s[j]
+            angle = np.arccos(a @ b / np.linalg.norm(a) / np.linalg.norm(b))
+            p, q = a / a.sum(), b / b.sum()
+            sid = (p * np.log(p / q)).sum() + (q * np.log(q / p)).sum()
+            assert np.isclose(_similarity(x, s, 'sam')[i, j], angle)
+            assert np.isclose(_similarity(x, s, 'sid')[i, j], sid)
+            assert np.isclose(_similarity(x, s, 'correlation')[i, j],
+                              np.corrcoef(a, b)[0, 1])
+
+
+def test_match_spectra():
+    cube = _cube()
+    library = _library()
+    wavelength = cube.wavelength.values
+    spectra = np.array([np.interp(wavelength, *x) for x in library.values()])
+    # pixels are scaled library spectra plus noise
+    rng = np.random.default_rng(5)
+    truth = rng.integers(0, len(spectra), cube.shape[1:])
+    scale = rng.uniform(5000, 10000, cube.shape[1:] + (1,))
+    data = spectra[truth] * scale + rng.normal(0, 5, scale.shape)
+    cube = cube.copy(data=np.moveaxis(data, -1, 0).astype('u2'))
+    cube[:, :20, :30] = 0
+
+    for metric in ['sam', 'sid', 'correlation']:
+        matches = match_spectra(cube, library, metric, top_k=2, chunk_mb=1)
+        assert matches.match.chunks is not None
+        matches = matches.compute()
+        assert matches.rio.crs.to_epsg() == 32630
+        best = matches.match.values[0]
+        assert (best[:20, :30] == -1).all()
+        assert (best[20:, 30:] == truth[20:, 30:]).all()
+        score = matches.score.values[:, 20:, 30:]
+        if metric == 'correlation':
+            assert (score[0] >= score[1]).all()
+        else:
+            assert (score[0] <= score[1]).all()
+    frame = pd.DataFrame({k: v[1] for k, v in library.items()},
+                         index=library['S0'][0])
+    matches = match_spectra(cube, frame)
+    assert list(matches.library.values) == list(library)
+    assert (matches.match.values[0, 20:, 30:] == truth[20:, 30:]).all()
+
+    pixels = similar_pixels([cube, cube], *library['S2'], n=10, chunk_mb=1)
+    assert len(pixels) == 10
+    assert (truth[pixels.row, pixels.col] == 2).all()
+    assert (np.diff(pixels.score) >= 0).all()
+    assert set(pixels.dataset) == {0, 1}
+    assert (pixels.x == cube.x.values[pixels.col]).all()
+    with raises(ValueError):
+        similar_pixels([], *library['S2'])
+
+
+def test_smallest():
+    values = np.array([5., 1., np.inf, 3., 1., 0.])
+    assert list(_smallest(values, 3)) == [5, 1, 4]
+    assert list(_smallest(values, 10)) == [5, 1, 4, 3, 0, 2]
+    assert len(_smallest(values, 0)) == 0
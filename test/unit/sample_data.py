@@ -21,3 +21,51 @@ def generate_tif(dst):
     img_dst = os.path.join(dst, 'test.tif')
     shutil.copy(os.path.join(HERE, 'test.tif'), img_dst)
     return img_dst
+
+
+def generate_cube(data, x0=1001., y0=1999., res=(2., -2.), bands=None,
+                  wavelength=None, crs=None):
+    # (band, y, x) DataArray of data with the pixel centre (x0, y0) first
+    # and y descending unless res[1] is positive
+    import numpy as np
+    import rioxarray  # noqa: F401
+    import xarray
+    n_bands, height, width = data.shape
+    coords = {'band': np.arange(1, n_bands + 1) if bands is None else bands,
+              'y': y0 + res[1] * np.arange(height),
+              'x': x0 + res[0] * np.arange(width)}
+    if wavelength is not None:
+        coords['wavelength'] = ('band', np.asarray(wavelength))
+    array = xarray.DataArray(data, dims=('band', 'y', 'x'), coords=coords)
+    if crs is not None:
+        array = array.rio.write_crs(crs)
+    return array
+
+
+def generate_band_files(dst, cube, crs='epsg:32630', attrs=None):
+    # one netCDF per band of a north-up generate_cube array, with the
+    # variables of the ingested band files
+    from hsman.ingest import _create_mosaic_netcdf
+    from rasterio.crs import CRS
+    from rasterio.transform import from_origin
+    x, y = cube.x.values, cube.y.values
+    res = float(x[1] - x[0])
+    transform = from_origin(x[0] - res / 2, y[0] + res / 2, res, res)
+    paths = []
+    for band in cube.band.values:
+        values = cube.sel(band=band)
+        fpath = os.path.join(dst, f'band_{band}_merged.nc')
+        with _create_mosaic_netcdf(fpath, CRS.from_user_input(crs), transform,
+                                   len(x), len(y), cube.dtype) as ds:
+            # rows are written top-down, so y is too
+            ds.variables['y'][:] = y
+            ds.variables['Band1'][:] = values.values
+            ds.renameVariable('Band1', 'reflectance')
+            ds.createDimension('band', 1)
+            ds.createVariable('band', 'i4', ('band',))[:] = [band]
+            ds.createVariable('wavelength', 'f8', ('band',))[:] = \
+                [values.wavelength.values]
+            for key, value in (attrs or {}).items():
+                ds.variables['reflectance'].setncattr(key, value)
+        paths.append(fpath)
+    return paths
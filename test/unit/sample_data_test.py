@@ -1,4 +1,6 @@
-from sample_data import generate_rotated_raster
+from sample_data import generate_rotated_raster, generate_band_files, \
+    generate_cube
+import numpy as np
 import xarray
 import math
 import rasterio
@@ -36,3 +38,17 @@ def _is_rotated(fpath):
             return True
         else:
             return False
+
+
+def test_generate_band_files(tmp_path):
+    # the band files have the values of the cube at its coordinates
+    data = np.arange(2 * 5 * 4, dtype='u2').reshape(2, 5, 4) + 1
+    cube = generate_cube(data, wavelength=[500., 600.])
+    paths = generate_band_files(tmp_path, cube)
+    for band, fpath in zip(cube.band.values, paths):
+        with xarray.open_dataset(fpath) as ds:
+            assert list(ds.wavelength.values) == \
+                [cube.wavelength.sel(band=band)]
+            assert np.array_equal(ds.reflectance.sel(y=cube.y, x=cube.x),
+                                  cube.sel(band=band))
+
@@ -0,0 +1,69 @@
+from hsman.scrape import find_all_dataset_files, find_dataset_files, \
+scan_directory
+import json
+import os
+
+
+def _make_tree(root):
+    files = ['M1-A-20220101_VNIR_a.img',
+             'M1-A-20220101_SWIR_a.img',
+             'sub/M2-B-20220102_VNIR_b.img',
+             'sub/deeper/M2-B-20220102_IXA180_dsm.tif',
+             'sub/deeper/notes.txt']
+    for f in files:
+        fpath = os.path.join(root, f)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        open(fpath, 'w').close()
+    return [os.path.join(root, f) for f in files]
+
+
+def _config():
+    return {'raster_dataset_recipes': {
+        'VNIR': {'name': 'VNIR', 'data_flag': 'VNIR', 'data_suffix': 'img',
+                 'ingest_type': 'hsi'},
+        'DSM': {'name': 'DSM', 'data_flag': 'IXA180_dsm',
+                'data_suffix': 'tif', 'ingest_type': 'image'},
+        'RGB': {'name': 'RGB', 'data_flag': 'IXA180_mos',
+                'data_suffix': 'tif', 'ingest_type': 'image'}}}
+
+
+def test_scan_directory(tmp_path):
+    files = _make_tree(str(tmp_path))
+    assert scan_directory(str(tmp_path)) == sorted(files)
+
+
+def test_scan_index_reuse(tmp_path, monkeypatch):
+    root = os.path.join(str(tmp_path), 'tree')
+    index_path = os.path.join(str(tmp_path), 'index.json')
+    files = _make_tree(root)
+    assert scan_directory(root, index_path) == sorted(files)
+    with open(index_path) as f:
+        assert os.path.join(root, 'sub', 'deeper') in json.load(f)
+
+    # directories whose mtime is unchanged are not listed again
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    assert scan_directory(root, index_path) == sorted(files)
+    assert listed == []
+    # a new file in an existing directory is found on the next scan, which
+    # lists only that directory
+    new_file = os.path.join(root, 'sub', 'M3-C-20220103_VNIR_c.img')
+    open(new_file, 'w').close()
+    assert new_file in scan_directory(root, index_path)
+    assert listed == [os.path.join(root, 'sub')]
+
+
+def test_find_all_dataset_files(tmp_path):
+    _make_tree(str(tmp_path))
+    index_path = os.path.join(str(tmp_path), 'index.json')
+    out = find_all_dataset_files(str(tmp_path), _config(), index_path)
+    assert set(out) == {'VNIR', 'DSM'}
+    assert set(out['VNIR']['data_path']) == {'M1-A-20220101',
+                                             'M2-B-20220102'}
+    assert out == {k: find_dataset_files(str(tmp_path), k, _config())
+                   for k in out}
@@ -0,0 +1,131 @@
+from hsman import serve
+from hsman.serve import TileCache, TileRenderer, TileRequestError, \
+    TileServer, dataset_version, encode_png, _tile_bounds, ORIGIN_SHIFT
+import asyncio
+import numpy as np
+from pytest import raises
+import struct
+import zlib
+
+
+def test_encode_png():
+    array = np.arange(4 * 5 * 4, dtype='u1').reshape(4, 5, 4)
+    png = encode_png(array)
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', png[16:24])
+    assert (width, height) == (5, 4)
+    # decode the single IDAT chunk and drop the filter bytes
+    idat = png.index(b'IDAT')
+    length = struct.unpack('>I', png[idat - 4:idat])[0]
+    raw = np.frombuffer(zlib.decompress(png[idat + 4:idat + 4 + length]),
+                        dtype='u1').reshape(4, -1)
+    assert np.array_equal(raw[:, 1:].reshape(4, 5, 4), array)
+
+
+def test_tile_bounds():
+    assert np.allclose(_tile_bounds(0, 0, 0), [-ORIGIN_SHIFT, -ORIGIN_SHIFT,
+                                               ORIGIN_SHIFT, ORIGIN_SHIFT])
+    left, bottom, right, top = _tile_bounds(1, 1, 0)
+    assert left == 0 and bottom == 0 and top == ORIGIN_SHIFT
+
+
+def test_tile_cache(tmp_path):
+    cache = TileCache(str(tmp_path), memory_mb=2.5e-6, disk_mb=1)
+    cache.put('a', b'12')
+    cache.put('b', b'34')
+    # 'a' is evicted from memory but still on disk
+    assert 'a' not in cache._memory
+    assert cache.get('a') == b'12'
+    assert cache.get('c') is None
+
+
+class _Renderer:
+    # records the tiles requested from the server
+    def __init__(self):
+        self.calls = []
+
+    def tile(self, dataset, z, x, y, **kwargs):
+        self.calls.append(dataset)
+        if kwargs['bands'] == [0]:
+            raise TileRequestError('bands must be in 1..4')
+        return b'png'
+
+
+def _request(server, target):
+    # the status and header lines of a GET response
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(f'GET {target} HTTP/1.1\r\n\r\n'.encode())
+        reader.feed_eof()
+        writer = _Writer()
+        await server._handle(reader, writer)
+        return writer.data.split(b'\r\n\r\n')[0].decode().split('\r\n')
+    return asyncio.run(run())
+
+
+class _Writer:
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_server_routes(monkeypatch):
+    listed = []
+
+    def get_datasets():
+        listed.append(1)
+        return {'TEST': '/x/TEST'}
+    monkeypatch.setattr(serve, 'get_datasets', get_datasets)
+    renderer = _Renderer()
+    server = TileServer(renderer)
+    lines = _request(server, '/TEST/1/0/0.png')
+    assert lines[0] == 'HTTP/1.1 200 OK'
+    assert not any([x.startswith('Access-Control') for x in lines])
+    # names outside the store never reach the renderer
+    for target in ['/..%2F..%2Fetc/1/0/0.png', '/../1/0/0.png',
+                   '/OTHER/tilejson.json']:
+        assert _request(server, target)[0] == 'HTTP/1.1 404 Not Found'
+    assert renderer.calls == ['TEST']
+    assert _request(server, '/TEST/1/0/0.png?bands=0')[0] == \
+        'HTTP/1.1 400 Bad Request'
+    # the store is listed once per STORE_TTL, not per request
+    assert len(listed) == 1
+    monkeypatch.setattr(serve, 'STORE_TTL', 0)
+    _request(server, '/TEST/1/0/0.png')
+    assert len(listed) == 2
+
+    server = TileServer(renderer, allow_origin='http://localhost:3000')
+    lines = _request(server, '/TEST/1/0/0.png')
+    assert 'Access-Control-Allow-Origin: http://localhost:3000' in lines
+
+
+def test_dataset_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(serve, 'get_data_path', lambda: str(tmp_path))
+    data = tmp_path / 'TEST' / 'DATA'
+    data.mkdir(parents=True)
+    version = dataset_version('TEST')
+    assert dataset_version('TEST') == version
+    # ingesting again replaces the DATA folder
+    data.rename(tmp_path / 'TEST' / 'OLD')
+    data.mkdir()
+    assert dataset_version('TEST') != version
+
+
+def test_select_bands():
+    renderer = TileRenderer()
+    source = {'layers': [('a', 1), ('a', 2), ('a', 3)],
+              'wavelengths': [500., 600., 700.]}
+    assert renderer._select(source, [3, 1, 2], None) == \
+        [('a', 3), ('a', 1), ('a', 2)]
+    assert renderer._select(source, None, [690]) == [('a', 3)]
+    for bands in [[0], [-1], [4], [1, 2]]:
+        with raises(TileRequestError):
+            renderer._select(source, bands, None)
@@ -0,0 +1,61 @@
+from hsman.stats import BandStats, stats_attrs, stats_from_attrs, \
+    write_band_stats, read_band_stats, HIST_BINS, PERCENTILES
+import numpy as np
+import os
+
+
+def _update_in_chunks(stats, data, n=7):
+    for chunk in np.array_split(data, n):
+        stats.update(chunk)
+    return stats.to_dict()
+
+
+def test_band_stats_integer():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 10000, (300, 200)).astype('u2')
+    out = _update_in_chunks(BandStats(nodata=0), data)
+    valid = data[data != 0].astype('f8')
+    assert out['count'] == valid.size
+    assert out['nodata_count'] == data.size - valid.size
+    assert out['min'] == valid.min() and out['max'] == valid.max()
+    assert np.isclose(out['mean'], valid.mean())
+    assert np.isclose(out['std'], valid.std())
+    # integer percentiles are exact
+    expected = np.percentile(valid, PERCENTILES, method='inverted_cdf')
+    assert list(out['percentiles'].values()) == list(expected)
+    assert len(out['histogram']) == HIST_BINS
+    assert sum(out['histogram']) == valid.size
+
+
+def test_band_stats_float():
+    rng = np.random.default_rng(1)
+    data = rng.normal(0.3, 0.1, (300, 200)).astype('f4')
+    data[:10] = np.nan
+    # later chunks extend the range of the histogram in both directions
+    data[-1, 0], data[-1, 1] = -5, 5
+    out = _update_in_chunks(BandStats(nodata=None), data)
+    valid = data[~np.isnan(data)].astype('f8')
+    assert out['count'] == valid.size
+    assert np.isclose(out['mean'], valid.mean())
+    assert np.isclose(out['std'], valid.std())
+    width = (valid.max() - valid.min()) / 4096 * 2
+    expected = np.percentile(valid, PERCENTILES)
+    assert np.allclose(list(out['percentiles'].values()), expected,
+                       atol=width)
+    assert sum(out['histogram']) == valid.size
+    assert out['histogram_range'] == [-5, 5]
+
+
+def test_band_stats_empty():
+    stats = BandStats()
+    stats.update(np.zeros((4, 4), 'u2'))
+    assert stats.to_dict() == {'count': 0, 'nodata_count': 16}
+
+
+def test_stats_attrs_and_file(tmp_path):
+    data = np.arange(100, dtype='u2').reshape(10, 10)
+    out = _update_in_chunks(BandStats(), data)
+    assert stats_from_attrs(stats_attrs(out)) == out
+    os.makedirs(os.path.join(tmp_path, 'METADATA'))
+    write_band_stats(tmp_path, {1: out})
+    assert read_band_stats(tmp_path) == {1: out}
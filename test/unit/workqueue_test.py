@@ -0,0 +1,81 @@
+from hsman.workqueue import WorkQueue, run_worker
+import multiprocessing
+import os
+import time
+
+
+def _square(job, queue):
+    # logs every run, so jobs run more than once can be found
+    with open(job.payload['log'], 'a') as f:
+        f.write(f'{job.id}\n')
+    time.sleep(0.01)
+    return job.payload['x'] ** 2
+
+
+def _total(job, queue):
+    return sum([x['result'] for x in queue.results(job.group, 'square')])
+
+
+def _broken(job, queue):
+    raise RuntimeError('broken job')
+
+
+HANDLERS = {'square': _square, 'total': _total, 'broken': _broken}
+
+
+def _worker(path):
+    run_worker(WorkQueue(path), HANDLERS, poll=0.05)
+
+
+def test_workers(tmp_path):
+    path = os.path.join(tmp_path, 'queue.sqlite')
+    log = os.path.join(tmp_path, 'runs.log')
+    queue = WorkQueue(path)
+    for group in range(3):
+        queue.add([('square', {'x': x, 'log': log}, 1) for x in range(10)]
+                  + [('total', {}, 2)], group=str(group))
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=_worker, args=(path,)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(60)
+        assert w.exitcode == 0
+
+    assert queue.counts() == {'pending': 0, 'running': 0, 'done': 33,
+                              'failed': 0}
+    # every job was claimed by exactly one worker
+    with open(log) as f:
+        runs = f.read().split()
+    assert len(runs) == len(set(runs)) == 30
+    # the totals ran after all the squares of their group
+    for group in range(3):
+        assert queue.results(str(group), 'total')[0]['result'] == 285
+
+
+def test_lease_expiry(tmp_path):
+    queue = WorkQueue(os.path.join(tmp_path, 'queue.sqlite'), lease=0.2)
+    queue.add([('square', {'x': 2}, 0)], group='a')
+    job = queue.claim('a')
+    assert queue.claim('b') is None
+    assert queue.heartbeat(job, 'a')
+    time.sleep(0.3)
+    # worker a stopped heartbeating, so b takes the job over
+    retry = queue.claim('b')
+    assert retry.id == job.id and retry.attempts == 2
+    assert not queue.heartbeat(job, 'a')
+    assert not queue.complete(job, 'a', 4)
+    assert queue.complete(retry, 'b', 4)
+    assert queue.results('a')[0]['result'] == 4
+
+
+def test_failed_jobs(tmp_path):
+    queue = WorkQueue(os.path.join(tmp_path, 'queue.sqlite'),
+                      max_attempts=2)
+    queue.add([('broken', {}, 0), ('total', {}, 1)], group='a')
+    assert run_worker(queue, HANDLERS, poll=0.01) == 0
+    assert queue.counts()['failed'] == 2
+    errors = queue.errors()
+    assert 'broken job' in errors[0][3]
+    assert errors[1][3] == 'an earlier stage failed'